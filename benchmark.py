@@ -0,0 +1,416 @@
+# benchmark.py
+# מדידת ביצועים מקומית, בלי טלגרם: ה-handlers האמיתיים של bot.py רצים מול לקוח מדומה
+# שמגיש קבצי וידאו סינתטיים ברוחב פס מוגדר ורושם כל עריכה ושליחה.
+#
+#   python benchmark.py --jobs 20 --concurrency 4 --bandwidth 8 --profile encode --output bench.json
+#
+# התוצאה נכתבת כ-JSON כדי שאפשר יהיה להשוות בין ריצות.
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+CHUNK_SIZE = 512 * 1024  # כמו גודל החלק של pyrogram בהעלאה
+STREAM_CHUNK = 1024 * 1024  # גודל החלק של client.stream_media
+
+# פרופילי קלט: איזה מסלול המרה כל אחד מפעיל, ואיזה פורמט העלאה נבחר
+PROFILES = {
+    # mpeg4 ב-mkv - המרה מלאה ל-H.264
+    "encode": {"upload": "video", "ext": "mkv", "args": ["-c:v", "mpeg4", "-q:v", "5", "-c:a", "mp2"]},
+    # H.264 + AAC ב-mkv - העתקת הזרמים למיכל mp4
+    "remux": {"upload": "video", "ext": "mkv", "args": ["-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac"]},
+    # mp4 מוכן להזרמה - נשלח כמו שהוא
+    "passthrough": {"upload": "video", "ext": "mp4",
+                    "args": ["-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac", "-movflags", "+faststart"]},
+    # שליחה כמסמך - הורדה והעלאה בלבד
+    "file": {"upload": "file", "ext": "mkv", "args": ["-c:v", "mpeg4", "-q:v", "5", "-c:a", "mp2"]},
+}
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def summarize(values: List[float]) -> Dict:
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 50),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+def generate_media(path: str, profile: str, duration: float, resolution: str):
+    subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+         "-f", "lavfi", "-i", f"testsrc2=size={resolution}:rate=30:duration={duration}",
+         "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+         "-shortest", *PROFILES[profile]["args"], path],
+        check=True
+    )
+
+class FakeMessage:
+    _ids = itertools.count(1)
+
+    def __init__(self, client: "FakeClient", chat_id: int, text: str = None, video=None, document=None, audio=None):
+        self.id = next(self._ids)
+        self.chat = SimpleNamespace(id=chat_id)
+        self.from_user = SimpleNamespace(id=chat_id)
+        self.text = text
+        self.video = video
+        self.document = document
+        self.audio = audio
+        self.photo = None
+        self.media_group_id = None
+        self._client = client
+        client.messages[(chat_id, self.id)] = self
+
+    async def reply_text(self, text, **kwargs):
+        return await self._client.send_message(self.chat.id, text, **kwargs)
+
+    async def edit_text(self, text, **kwargs):
+        self._client.events["edit"] += 1
+        self.text = text
+        return self
+
+    async def delete(self):
+        self._client.events["delete"] += 1
+        self._client.messages.pop((self.chat.id, self.id), None)
+
+class FakeCallbackQuery:
+    def __init__(self, user_id: int, data: str, message: FakeMessage):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.data = data
+        self.message = message
+
+    async def answer(self, text=None, show_alert=False):
+        self.message._client.events["answer"] += 1
+
+class FakeClient:
+    # מחליף את pyrogram.Client במתודות שה-handlers משתמשים בהן.
+    # כל העברה (הורדה או העלאה) מוגבלת ל-bandwidth בייטים לשנייה
+    def __init__(self, bandwidth: float):
+        self.bandwidth = bandwidth
+        self.media: Dict[str, str] = {}  # file_id -> נתיב מקומי
+        self.messages: Dict[tuple, FakeMessage] = {}
+        self.events = Counter()
+        self.sent: Dict[int, List[str]] = defaultdict(list)  # chat_id -> file_ids שנשלחו
+        self.transferred = Counter()
+        self.uploaded = set()  # file_ids של תוצרים שכבר "הועלו"
+        self._file_ids = itertools.count(1)
+
+    def add_media(self, chat_id: int, path: str, kind: str, duration: float) -> FakeMessage:
+        number = next(self._file_ids)
+        media = SimpleNamespace(
+            file_id=f"input_{number}",
+            file_unique_id=f"unique_{number}",
+            file_name=os.path.basename(path),
+            file_size=os.path.getsize(path),
+            duration=int(duration),
+            mime_type="video/x-matroska",
+        )
+        self.media[media.file_id] = path
+        if kind == "video":
+            return FakeMessage(self, chat_id, video=media)
+        return FakeMessage(self, chat_id, document=media)
+
+    async def _transfer(self, size: int, direction: str, progress, progress_args):
+        current = 0
+        while current < size:
+            chunk = min(CHUNK_SIZE, size - current)
+            await asyncio.sleep(chunk / self.bandwidth)
+            current += chunk
+            self.transferred[direction] += chunk
+            if progress:
+                await progress(current, size, *progress_args)
+
+    async def get_messages(self, chat_id, message_ids):
+        if isinstance(message_ids, list):
+            return [self.messages.get((chat_id, message_id)) for message_id in message_ids]
+        return self.messages.get((chat_id, message_ids))
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        return await self.messages[(chat_id, message_id)].edit_text(text, **kwargs)
+
+    async def send_message(self, chat_id, text, reply_to_message_id=None, reply_markup=None, **kwargs):
+        self.events["send_message"] += 1
+        return FakeMessage(self, chat_id, text=text)
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        self.events["send_photo"] += 1
+        return FakeMessage(self, chat_id)
+
+    async def download_media(self, file_id, file_name=None, progress=None, progress_args=()):
+        source = self.media[file_id]
+        target = os.path.abspath(file_name or os.path.join("downloads", file_id))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        await self._transfer(os.path.getsize(source), "download", progress, progress_args)
+        shutil.copyfile(source, target)
+        self.events["download"] += 1
+        return target
+
+    async def stream_media(self, message, limit=0, offset=0):
+        # כמו pyrogram: חלקים של 1MB, offset ו-limit נמדדים בחלקים
+        media = message.video or message.document
+        with open(self.media[media.file_id], "rb") as source:
+            source.seek(offset * STREAM_CHUNK)
+            count = 0
+            while not limit or count < limit:
+                chunk = source.read(STREAM_CHUNK)
+                if not chunk:
+                    break
+                await asyncio.sleep(len(chunk) / self.bandwidth)
+                self.transferred["download"] += len(chunk)
+                count += 1
+                yield chunk
+        self.events["download"] += 1
+
+    async def _send_media(self, kind, chat_id, media, progress, progress_args, file_name=None):
+        if media in self.uploaded:
+            # שליחה חוזרת לפי file_id (מטמון) - בלי העברה
+            file_id = media
+            self.events[f"resend_{kind}"] += 1
+        else:
+            await self._transfer(os.path.getsize(media), "upload", progress, progress_args)
+            file_id = f"output_{next(self._file_ids)}"
+            self.uploaded.add(file_id)
+            self.events[f"send_{kind}"] += 1
+        self.sent[chat_id].append(file_id)
+        sent = SimpleNamespace(file_id=file_id, file_unique_id=file_id, file_name=file_name)
+        if kind == "video":
+            return FakeMessage(self, chat_id, video=sent)
+        if kind == "audio":
+            return FakeMessage(self, chat_id, audio=sent)
+        return FakeMessage(self, chat_id, document=sent)
+
+    async def send_video(self, chat_id, video, progress=None, progress_args=(), **kwargs):
+        return await self._send_media("video", chat_id, video, progress, progress_args)
+
+    async def send_document(self, chat_id, document, progress=None, progress_args=(), file_name=None, **kwargs):
+        return await self._send_media("document", chat_id, document, progress, progress_args, file_name)
+
+    async def send_audio(self, chat_id, audio, progress=None, progress_args=(), file_name=None, **kwargs):
+        return await self._send_media("audio", chat_id, audio, progress, progress_args, file_name)
+
+def record_stages(scheduler, samples: Dict[str, List[float]]):
+    # עוטף את scheduler.stage כדי לשמור כל זמן שלב (ההיסטוגרמה של metrics שומרת רק דליים)
+    original = scheduler.stage
+
+    @asynccontextmanager
+    async def stage(name, ticket, on_wait=None):
+        async with original(name, ticket, on_wait):
+            started = time.perf_counter()
+            try:
+                yield
+            finally:
+                samples[name].append(time.perf_counter() - started)
+
+    scheduler.stage = stage
+
+async def run_job(bot, client: FakeClient, user_id: int, media_path: str, profile: str, duration: float) -> float:
+    # אותו רצף שמשתמש עובר: שליחת קובץ → "המשך ללא שינוי" → בחירת פורמט
+    started = time.perf_counter()
+    message = client.add_media(user_id, media_path, PROFILES[profile]["upload"], duration)
+    await bot.handle_file(client, message)
+    # ההודעה עם הכפתורים היא ה-active_task של המשתמש, בדיוק כמו בשיחה אמיתית
+    prompt = client.messages[(user_id, bot.sessions.field(user_id, "active_task"))]
+    await bot.rename_choice(client, FakeCallbackQuery(user_id, "rename_no", prompt))
+    choice = client.messages[(user_id, bot.sessions.field(user_id, "active_task"))]
+    await bot.upload_file(client, FakeCallbackQuery(user_id, f"upload_{PROFILES[profile]['upload']}", choice))
+    return time.perf_counter() - started
+
+async def run_jobs(bot, scheduler, args, media_path: str) -> Dict:
+    client = FakeClient(args.bandwidth * 1024 * 1024)
+    stage_samples: Dict[str, List[float]] = defaultdict(list)
+    record_stages(scheduler, stage_samples)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies: List[float] = []
+    failures = 0
+
+    async def one(index: int):
+        nonlocal failures
+        user_id = 1_000_000 + index
+        async with semaphore:
+            elapsed = await run_job(bot, client, user_id, media_path, args.profile, args.duration)
+        if client.sent.get(user_id):
+            latencies.append(elapsed)
+        else:
+            failures += 1
+
+    cpu_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(args.jobs)))
+    wall = time.perf_counter() - started
+    cpu_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    ffmpeg_cpu = (children_after.ru_utime - children_before.ru_utime) + (children_after.ru_stime - children_before.ru_stime)
+    bot_cpu = (cpu_after.ru_utime - cpu_before.ru_utime) + (cpu_after.ru_stime - cpu_before.ru_stime)
+    video_jobs = len(latencies) if PROFILES[args.profile]["upload"] == "video" else 0
+    encoded_minutes = video_jobs * args.duration / 60
+    return {
+        "jobs": {
+            "completed": len(latencies),
+            "failed": failures,
+            "wall_seconds": wall,
+            "jobs_per_minute": len(latencies) / wall * 60 if wall else None,
+        },
+        "job_latency": summarize(latencies),
+        "stages": {name: summarize(values) for name, values in sorted(stage_samples.items())},
+        "telegram": {
+            "events": dict(client.events),
+            "bytes": dict(client.transferred),
+            "progress_edits": bot.renderer.edits,
+        },
+        "cpu": {
+            "bot_seconds": bot_cpu,
+            "ffmpeg_seconds": ffmpeg_cpu,
+            "encoded_minutes": encoded_minutes,
+            "ffmpeg_seconds_per_encoded_minute": ffmpeg_cpu / encoded_minutes if encoded_minutes else None,
+        },
+    }
+
+def bench_database(database_module, sizes: List[int], workdir: str, iterations: int) -> Dict:
+    # עלות פעולות מסד הנתונים ביחס לגודל טבלת המשתמשים
+    results = {}
+    columns = database_module.USER_COLUMNS
+    for size in sizes:
+        path = os.path.join(workdir, f"bench_users_{size}.db")
+        database = database_module.Database(path)
+        now = time.time()
+        rows = []
+        for uid in range(1, size + 1):
+            # עמודות שלא מפורטות כאן (למשל כאלה שנוספו לטבלה מאוחר יותר) נשארות NULL
+            values = {
+                "last_action_time": now - random.random() * 86400,
+                "premium_until": now + 3600 if uid % 20 == 0 else None,
+                "actions_count": random.randint(0, 50),
+            }
+            rows.append((uid, *(values.get(column) for column in columns)))
+        placeholders = ", ".join("?" * (len(columns) + 1))
+        with database.batch():
+            database.conn.executemany(
+                f"INSERT INTO users (user_id, {', '.join(columns)}) VALUES ({placeholders})", rows
+            )
+        ids = [random.randint(1, size) for _ in range(iterations)]
+
+        def timed(operation, count=iterations) -> float:
+            started = time.perf_counter()
+            for index in range(count):
+                operation(ids[index % len(ids)])
+            return (time.perf_counter() - started) / count * 1e6
+
+        def record_action(uid):
+            with database.batch():
+                database.set_last_action_time(uid, time.time())
+                database.add_action_count(uid)
+
+        results[str(size)] = {
+            "get_premium_until_us": timed(database.get_premium_until),
+            "get_last_action_time_us": timed(database.get_last_action_time),
+            "set_last_action_time_us": timed(lambda uid: database.set_last_action_time(uid, time.time())),
+            "add_action_count_us": timed(database.add_action_count),
+            "record_action_batch_us": timed(record_action),
+            "get_user_us": timed(database.get_user),
+            "aggregates_us": timed(lambda uid: database.aggregates()),
+            "premium_users_us": timed(lambda uid: database.premium_users(time.time()), count=20),
+            "get_all_users_us": timed(lambda uid: database.get_all_users(), count=3),
+        }
+        database.conn.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    return results
+
+def prepare_environment(workdir: str):
+    # הבוט קורא את ההגדרות בזמן import - מפנים את כל הקבצים שלו לתיקייה זמנית
+    os.environ.update(
+        DB_PATH=os.path.join(workdir, "data.db"),
+        LEGACY_JSON_PATH=os.path.join(workdir, "data.json"),
+        JOBS_DB_PATH=os.path.join(workdir, "jobs.db"),
+        WORKERS="0",
+        STREAM_PIPELINE="0",
+        # ללקוח המדומה אין sessions של MTProto - ההעלאה עוברת דרך send_video/send_document
+        TRANSFER_MIN_SIZE=str(1 << 62),
+    )
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+
+def ffmpeg_version() -> Optional[str]:
+    try:
+        output = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout
+    except OSError:
+        return None
+    return output.splitlines()[0] if output else None
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark for the converter bot")
+    parser.add_argument("--jobs", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=4, help="jobs submitted at once")
+    parser.add_argument("--bandwidth", type=float, default=8.0, help="MB/s per simulated transfer")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="encode")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of generated video")
+    parser.add_argument("--resolution", default="1280x720")
+    parser.add_argument("--db-sizes", default="1000,10000,100000")
+    parser.add_argument("--db-iterations", type=int, default=2000)
+    parser.add_argument("--skip-jobs", action="store_true", help="only run the database benchmark")
+    parser.add_argument("--output", help="JSON output path (default: stdout)")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    prepare_environment(workdir)
+    report = {"config": vars(args)}
+    try:
+        bot = importlib.import_module("bot")
+        database_module = importlib.import_module("database")
+        scheduler = importlib.import_module("scheduler").scheduler
+
+        report["environment"] = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "ffmpeg": ffmpeg_version(),
+        }
+        if not args.skip_jobs:
+            media_path = os.path.join(workdir, f"input.{PROFILES[args.profile]['ext']}")
+            generate_media(media_path, args.profile, args.duration, args.resolution)
+            report["media"] = {"path": os.path.basename(media_path), "bytes": os.path.getsize(media_path)}
+            report.update(asyncio.get_event_loop().run_until_complete(run_jobs(bot, scheduler, args, media_path)))
+        sizes = [int(size) for size in args.db_sizes.split(",") if size]
+        report["database"] = bench_database(database_module, sizes, workdir, args.db_iterations)
+    except Exception as e:
+        # תוצאות החלקים שכבר רצו (למשל העבודות) נשמרות גם כשחלק מאוחר יותר נכשל
+        report["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        write_report(report, output)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def write_report(report: Dict, output: Optional[str]):
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,38 @@
 # bot.py
+import io
 import os
 import re
 import time
-import subprocess
+import asyncio
 import logging
+from typing import Dict, Optional, Tuple
 from pyrogram import Client, filters
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from pyrogram.enums import ParseMode
+from pyrogram.errors import MessageNotModified
 
-from config import API_ID, API_HASH, BOT_TOKEN, ADMIN_ID, WAIT_TIME
+from config import (
+    API_ID, API_HASH, BOT_TOKEN, ADMIN_ID, WAIT_TIME, WORKERS, MAX_QUEUED_JOBS, DOWNLOAD_SLOTS, TRANSFER_PARALLELISM,
+    BATCH_WINDOW, BATCH_MAX_FILES, SAMPLING_MAX_SECONDS
+)
 from database import db
-from utils import humanbytes, progress_bar, generate_thumbnail, parse_duration, get_storage_usage
+from sessions import sessions
+from cache import result_cache
+from thumbnails import thumbnails
+from progress import renderer
+from scheduler import scheduler, Ticket, QueueFull, PREMIUM_LANE, FREE_LANE
+from pipeline import (
+    RESUME_TEXT, JobAborted, UnsupportedFile, JobCancelled, JobSpec, Reporter, LocalReporter,
+    execute_job, job_control
+)
+from jobqueue import jobqueue, LOCAL_WORKER, ERROR_UNSUPPORTED, ERROR_ABORTED, ERROR_STORAGE
+from metrics import registry, watchdog
+from storage import storage, StorageFull, job_size
+from premiums import premium_expiry
+from broadcast import broadcaster
+from tracing import trace_store
+from sampling import sampler, SamplerBusy
+from utils import humanbytes, parse_duration
 
 logging.basicConfig(
     level=logging.INFO,
@@ -19,24 +41,40 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # יצירת תיקיות נחוצות
-os.makedirs("downloads", exist_ok=True)
 os.makedirs("thumbnails", exist_ok=True)
 
-app = Client("file_converter_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+# כל מקטע בהורדה מקבילית הוא זרם נפרד של pyrogram, ומספר הזרמים בו-זמנית מוגבל ב-max_concurrent_transmissions
+app = Client("file_converter_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN,
+             max_concurrent_transmissions=DOWNLOAD_SLOTS * TRANSFER_PARALLELISM)
 
-# משתנים לעדכון התקדמות וביטול תהליכים
-LAST_UPDATE = {}
-MIN_UPDATE_INTERVAL = 5  # שניות
-MIN_PERCENT_CHANGE = 10  # אחוז
-CANCEL_TASKS = {}  # מילון לביטול פעולות לפי משתמש
+JOB_POLL_INTERVAL = 1.0  # שניות בין סריקות של תור העבודות (מצב תהליכים נפרדים)
+JOB_MESSAGES = {}  # job_id -> הודעת ההתקדמות של העבודה
+STORAGE_FULL_TEXT = "🚦 אין כרגע מקום פנוי בשרת, נסה שוב בעוד כמה דקות."
+CANCELLED_TEXT = "❌ הפעולה בוטלה!"
+BATCH_PROMPT_DELAY = 1.0  # שניות - קבצי אלבום מגיעים כמה בשנייה, הודעת הבחירה נערכת פעם אחת אחריהם
+BATCH_PROMPTS: Dict[int, asyncio.Task] = {}  # user_id -> עדכון מתוזמן של הודעת הבחירה של האצווה
+UPLOAD_TYPE_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🎥 וידאו", callback_data="upload_video"),
+        InlineKeyboardButton("📁 קובץ", callback_data="upload_file")
+    ],
+    [
+        InlineKeyboardButton("🎵 אודיו", callback_data="upload_audio"),
+        InlineKeyboardButton("🎥+🎵 וידאו ואודיו", callback_data="upload_both")
+    ]
+])
+
+def is_premium(user_id: int) -> bool:
+    premium_until = db.get_premium_until(user_id)
+    return bool(premium_until and premium_until > time.time())
 
 # פונקציה לבדוק אם המשתמש רשאי לבצע פעולה
 def can_user_act(user_id: int) -> (bool, int):
-    premium_until = db.get_premium_until(user_id)
     now = time.time()
-    if premium_until and premium_until > now:
+    user = db.get_user(user_id)  # שאילתה אחת לפרימיום ולזמן הפעולה האחרונה
+    if user.get("premium_until", 0) > now:
         return True, 0
-    last_action = db.get_last_action_time(user_id)
+    last_action = user.get("last_action_time")
     if last_action and now - last_action < WAIT_TIME:
         remaining = int(WAIT_TIME - (now - last_action))
         return False, remaining
@@ -45,11 +83,14 @@ def can_user_act(user_id: int) -> (bool, int):
 # הודעת /start משודרגת
 @app.on_message(filters.command("start"))
 async def start(client: Client, message: Message):
+    db.register(message.from_user.id)
     welcome_text = (
         "👋 **ברוכים הבאים לבוט הממיר הקבצים!**\n\n"
         "שלח קובץ או וידאו, ושנה את שמו לפי הצורך. הבוט מציג התקדמות עם אחוזים, מהירות וזמן משוער.\n\n"
         "אפשרויות נוספות:\n"
         "• `/my_plan` – בדיקת תוכנית המשתמש\n"
+        "• שליחת אלבום או כמה קבצים ברצף – בחירה אחת לכולם והודעת התקדמות אחת\n"
+        "• פורמט \"אודיו\" – רצועת הקול בלבד (M4A), לבד או יחד עם הווידאו\n"
         "• שליחת תמונה לשמירת תמונת ממוזערת\n\n"
         "בהצלחה!"
     )
@@ -58,11 +99,21 @@ async def start(client: Client, message: Message):
 @app.on_message(filters.command("cancel"))
 async def cancel_command(client: Client, message: Message):
     user_id = message.from_user.id
-    active = db.get_active_task(user_id)
-    CANCEL_TASKS[user_id] = True  # סימון ביטול תהליך
-    if active:
-        db.delete_active_task(user_id)
-        await message.reply_text("❌ הפעולה בוטלה!", reply_to_message_id=message.id)
+    active = sessions.field(user_id, "active_task")
+    sessions.update(user_id, batch=None)
+    # כל העבודות של המשתמש; כפתור הביטול בהודעת ההתקדמות מבטל רק את העבודה שלה
+    jobs = jobqueue.active_for_user(user_id)
+    for job_id in jobs:
+        status = cancel_job(job_id)
+        if status is None:
+            continue
+        try:
+            await client.edit_message_text(status[0], status[1], CANCELLED_TEXT)
+        except Exception as e:
+            logger.error(f"שגיאה בעדכון הודעת עבודה {job_id} שבוטלה: {e}")
+    if active or jobs:
+        sessions.update(user_id, active_task=None)
+        await message.reply_text(CANCELLED_TEXT, reply_to_message_id=message.id)
     else:
         await message.reply_text("⚠️ אין פעולה פעילה לביטול", reply_to_message_id=message.id)
 
@@ -82,32 +133,49 @@ async def view_thumb(client: Client, message: Message):
 @app.on_message(filters.command("del_thumb"))
 async def del_thumb(client: Client, message: Message):
     db.delete_thumbnail(message.from_user.id)
+    thumbnails.invalidate_custom(message.from_user.id)
     await message.reply_text("✅ התמונה הממוזערת נמחקה", reply_to_message_id=message.id)
 
 @app.on_message(filters.photo)
 async def save_thumbnail(client: Client, message: Message):
     db.save_thumbnail(message.from_user.id, message.photo.file_id)
+    thumbnails.invalidate_custom(message.from_user.id)
     await message.reply_text("✅ תמונה ממוזערת נשמרה בהצלחה", reply_to_message_id=message.id)
 
 @app.on_message(filters.document | filters.video)
 async def handle_file(client: Client, message: Message):
     user_id = message.from_user.id
+    if joins_batch(user_id, message):
+        # אותה עבודה - בלי בדיקת זמן המתנה ובלי הודעת בחירה נוספת
+        batch = sessions.field(user_id, "batch") + [message.id]
+        if len(batch) > BATCH_MAX_FILES:
+            # לא פותחים אצווה חדשה מתחת להודעת הבחירה של הקודמת - הכפתורים שלה היו חלים על החדשה
+            await message.reply_text(
+                f"📦 אפשר לעבד עד {BATCH_MAX_FILES} קבצים יחד. בחר פורמט לקבצים שכבר נשלחו, "
+                f"ושלח את הקובץ הזה שוב אחרי שהעיבוד יתחיל.",
+                reply_to_message_id=message.id
+            )
+            return
+        file_size = max(sessions.field(user_id, "file_size") or 0, media_size(message))
+        sessions.update(user_id, batch=batch, batch_at=time.monotonic(), new_name=None, file_size=file_size)
+        refresh_batch_prompt(client, user_id)
+        return
+
     can_act, remaining = can_user_act(user_id)
     if not can_act:
         await message.reply_text(f"⚠️ המתן עוד {remaining} שניות לפני ביצוע פעולה חדשה.", reply_to_message_id=message.id)
         return
 
-    # סימון הפעולה כפעילה
-    db.set_original_message(user_id, message.id)
-    db.delete_active_task(user_id)
-    CANCEL_TASKS[user_id] = False  # אתחול ביטול
-
     # אם לא קיים שם חדש (לא בחרו לשנות), נשמור את השם המקורי של הקובץ
-    if not db.get_new_name(user_id):
+    new_name = sessions.field(user_id, "new_name")
+    if not new_name:
         if message.document and message.document.file_name:
-            db.save_new_name(user_id, message.document.file_name)
+            new_name = message.document.file_name
         elif message.video and message.video.file_name:
-            db.save_new_name(user_id, message.video.file_name)
+            new_name = message.video.file_name
+    sessions.update(user_id, original_msg_id=message.id, active_task=None, new_name=new_name,
+                    batch=[message.id], batch_group=message.media_group_id, batch_at=time.monotonic(),
+                    file_size=media_size(message))
 
     keyboard = InlineKeyboardMarkup([
         [
@@ -121,12 +189,53 @@ async def handle_file(client: Client, message: Message):
         reply_markup=keyboard,
         reply_to_message_id=message.id
     )
-    db.add_active_task(user_id, msg.id)
+    sessions.update(user_id, active_task=msg.id)
+    if len(sessions.field(user_id, "batch", [])) > 1:
+        refresh_batch_prompt(client, user_id)  # קבצים שהצטרפו בזמן שההודעה נשלחה
+
+def media_size(message: Message) -> int:
+    media = message.video or message.document
+    return (media.file_size if media else None) or 0
+
+def joins_batch(user_id: int, message: Message) -> bool:
+    # קובץ שמגיע לפני שנבחר פורמט לקבצים הקודמים מצטרף אליהם: מאותו אלבום,
+    # או תוך BATCH_WINDOW שניות מהקובץ הקודם
+    batch = sessions.field(user_id, "batch")
+    if not batch or sessions.field(user_id, "waiting_for_name", False):
+        return False
+    if message.media_group_id and message.media_group_id == sessions.field(user_id, "batch_group"):
+        return True
+    return time.monotonic() - sessions.field(user_id, "batch_at", 0.0) <= BATCH_WINDOW
+
+def refresh_batch_prompt(client: Client, user_id: int):
+    task = BATCH_PROMPTS.get(user_id)
+    if task is None or task.done():
+        BATCH_PROMPTS[user_id] = asyncio.ensure_future(show_batch_prompt(client, user_id))
+
+async def show_batch_prompt(client: Client, user_id: int):
+    # הודעת הבחירה של הקובץ הראשון הופכת לבחירה אחת לכל האצווה (בלי שינוי שם)
+    await asyncio.sleep(BATCH_PROMPT_DELAY)
+    BATCH_PROMPTS.pop(user_id, None)
+    batch = sessions.field(user_id, "batch")
+    prompt_id = sessions.field(user_id, "active_task")
+    if not batch or len(batch) < 2 or prompt_id is None:
+        return
+    try:
+        await client.edit_message_text(
+            chat_id=user_id,
+            message_id=prompt_id,
+            text=f"📦 התקבלו {len(batch)} קבצים - הם יעובדו יחד, לפי הסדר.\n\nבחר פורמט העלאה:",
+            reply_markup=UPLOAD_TYPE_KEYBOARD
+        )
+    except MessageNotModified:
+        pass
+    except Exception as e:
+        logger.error(f"שגיאה בעדכון הודעת הבחירה של אצווה: {e}")
 
 @app.on_callback_query(filters.regex(r"^rename_(yes|no)"))
 async def rename_choice(client: Client, query: CallbackQuery):
     user_id = query.from_user.id
-    original_msg_id = db.get_original_message(user_id)
+    original_msg_id = sessions.field(user_id, "original_msg_id")
     action = query.data.split("_")[1]
     
     try:
@@ -134,176 +243,114 @@ async def rename_choice(client: Client, query: CallbackQuery):
     except Exception as e:
         logger.error(f"שגיאה במחיקת הודעה: {e}")
     
-    db.delete_active_task(user_id)
+    # הבחירה נעשתה עבור קובץ אחד - קבצים שיגיעו מעכשיו פותחים בחירה חדשה
+    sessions.update(user_id, active_task=None, batch=None)
     
     if action == "yes":
-        db.set_waiting_for_name(user_id, True)
+        sessions.update(user_id, waiting_for_name=True)
         sent_msg = await client.send_message(
             chat_id=user_id,
             text="✍️ שלח את השם החדש עבור הקובץ:",
             reply_to_message_id=original_msg_id
         )
-        db.add_active_task(user_id, sent_msg.id)
+        sessions.update(user_id, active_task=sent_msg.id)
     else:
         await ask_upload_type(client, original_msg_id, user_id)
 
 async def ask_upload_type(client: Client, original_msg_id: int, user_id: int):
-    keyboard = InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("🎥 וידאו", callback_data="upload_video"),
-            InlineKeyboardButton("📁 קובץ", callback_data="upload_file")
-        ]
-    ])
-    
     msg = await client.send_message(
         chat_id=user_id,
         text="📤 בחר פורמט העלאה:",
-        reply_markup=keyboard,
+        reply_markup=UPLOAD_TYPE_KEYBOARD,
         reply_to_message_id=original_msg_id
     )
-    db.add_active_task(user_id, msg.id)
+    sessions.update(user_id, active_task=msg.id)
 
 @app.on_message(filters.text & ~filters.regex(r'^/') & filters.private)
 async def handle_new_name(client: Client, message: Message):
     user_id = message.from_user.id
-    original_msg_id = db.get_original_message(user_id)
+    original_msg_id = sessions.field(user_id, "original_msg_id")
     
-    if db.is_waiting_for_name(user_id):
+    if sessions.field(user_id, "waiting_for_name", False):
         try:
             await message.delete()
         except Exception:
             pass
         
         new_name = message.text.strip()
-        db.save_new_name(user_id, new_name)
-        db.set_waiting_for_name(user_id, False)
+        sessions.update(user_id, new_name=new_name, waiting_for_name=False)
         
         await ask_upload_type(client, original_msg_id, user_id)
 
-async def progress_callback(current: int, total: int, start_time: float, message: Message, action: str):
-    try:
-        user_id = message.chat.id
-        # בדיקת ביטול – אם המשתמש ביקש ביטול, נזרוק חריגה
-        if CANCEL_TASKS.get(user_id, False):
-            raise Exception("Cancelled by user")
-
-        now = time.time()
-        should_update = False
-        if user_id not in LAST_UPDATE:
-            should_update = True
-        else:
-            time_diff = now - LAST_UPDATE[user_id]["time"]
-            percent_diff = ((current/total)*100) - LAST_UPDATE[user_id]["percent"]
-            if time_diff >= MIN_UPDATE_INTERVAL or percent_diff >= MIN_PERCENT_CHANGE:
-                should_update = True
-        
-        if should_update:
-            progress = await progress_bar(current, total, start_time)
-            text = (
-                f"**{'⬇️ מוריד' if action == 'download' else '⬆️ מעלה'} את הקובץ**\n\n"
-                f"**גודל קובץ:** `{humanbytes(total)}`\n"
-                f"{progress}"
-            )
-            
-            await message.edit_text(
-                text,
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ בטל", callback_data="cancel")]]),
-                parse_mode=ParseMode.MARKDOWN
-            )
-            LAST_UPDATE[user_id] = {
-                "time": now,
-                "percent": (current/total)*100
-            }
-    except Exception as e:
-        logger.error(f"שגיאה בעדכון התקדמות: {e}")
-        raise e  # כדי לאפס את התהליך במקרה של ביטול
-
-@app.on_callback_query(filters.regex(r"^upload_(video|file)"))
+@app.on_callback_query(filters.regex(r"^upload_(video|file|audio|both)"))
 async def upload_file(client: Client, query: CallbackQuery):
     user_id = query.from_user.id
-    original_msg_id = db.get_original_message(user_id)
+    original_msg_id = sessions.field(user_id, "original_msg_id")
     upload_type = query.data.split("_")[1]
+    # וידאו ואודיו: עבודת וידאו שמפיקה גם רצועת אודיו באותה הרצה של ffmpeg
+    with_audio = upload_type == "both"
+    if with_audio:
+        upload_type = "video"
+    # האצווה נסגרת עם הבחירה; קובץ בודד רץ כמו קודם
+    batch = sessions.field(user_id, "batch") or []
+    batch = batch if len(batch) > 1 else None
+    sessions.update(user_id, batch=None)
     
     # נערוך את הודעת הבחירה
     progress_msg = query.message
     try:
-        await progress_msg.edit_text("⬇️ מתחיל בהורדה...", parse_mode=ParseMode.MARKDOWN)
+        text = f"📦 מתחיל לעבד {len(batch)} קבצים..." if batch else "⬇️ מתחיל בהורדה..."
+        await progress_msg.edit_text(text, parse_mode=ParseMode.MARKDOWN)
     except Exception as e:
         logger.error(f"שגיאה בעדכון הודעת התקדמות: {e}")
-    
+
+    spec = JobSpec(
+        user_id=user_id,
+        original_msg_id=original_msg_id,
+        upload_type=upload_type,
+        new_name=None if batch else sessions.field(user_id, "new_name"),
+        premium=is_premium(user_id),
+        batch=batch,
+        with_audio=with_audio,
+        file_size=sessions.field(user_id, "file_size")
+    )
+
     try:
-        original_msg = await client.get_messages(chat_id=user_id, message_ids=original_msg_id)
-        file = original_msg.video or original_msg.document
-        if not file:
-            return await query.answer("❌ קובץ לא נתמך", show_alert=True)
-        
-        start_time = time.time()
-        # הורדת הקובץ
-        download_path = await client.download_media(
-            file.file_id,
-            file_name=f"downloads/{file.file_id}",
-            progress=progress_callback,
-            progress_args=(start_time, progress_msg, "download")
-        )
-        
-        # בדיקה במידה והמשתמש ביטל במהלך ההורדה
-        if CANCEL_TASKS.get(user_id, False):
-            await progress_msg.edit_text("❌ הפעולה בוטלה!")
-            os.remove(download_path)
+        if WORKERS:
+            # העבודה עוברת לתהליכי ה-worker; ההתקדמות מוצגת ע"י monitor_jobs
+            if not enqueue_job(spec, progress_msg):
+                await progress_msg.edit_text("🚦 השרת עמוס כרגע, נסה שוב בעוד כמה דקות.")
             return
-        
-        new_name = db.get_new_name(user_id)
-        output_path = None
-        
-        if upload_type == "video":
-            thumb_path = db.get_thumbnail(user_id) or generate_thumbnail(download_path, user_id)
-            output_path = f"converted_{file.file_id}.mp4"
-            try:
-                # המרת וידאו באמצעות re-encoding (ניתן להתאים את הפרמטרים)
-                subprocess.run([
-                    "ffmpeg",
-                    "-i", download_path,
-                    "-c:v", "libx264",
-                    "-crf", "23",
-                    "-preset", "veryfast",
-                    "-c:a", "aac",
-                    "-b:a", "128k",
-                    output_path
-                ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            except subprocess.CalledProcessError as e:
-                logger.error(f"שגיאה בהמרת וידאו: {e}")
-                await client.send_message(chat_id=user_id, text="❌ אירעה שגיאה בהמרת הווידאו", reply_to_message_id=original_msg_id)
-                return
-            
-            await client.send_video(
-                chat_id=user_id,
-                video=output_path,
-                thumb=thumb_path,
-                caption=f"📁 שם קובץ: `{new_name}`" if new_name else None,
-                progress=progress_callback,
-                progress_args=(start_time, progress_msg, "upload"),
-                reply_to_message_id=original_msg_id
-            )
-        else:
-            await client.send_document(
-                chat_id=user_id,
-                document=download_path,
-                file_name=new_name if new_name else None,
-                progress=progress_callback,
-                progress_args=(start_time, progress_msg, "upload"),
-                reply_to_message_id=original_msg_id
-            )
-        
-        # ניקוי קבצים
-        os.remove(download_path)
-        if output_path and os.path.exists(output_path):
-            os.remove(output_path)
-        
-        # עדכון זמן הפעולה וספירת פעולות (למשתמש לא פרימיום)
-        db.set_last_action_time(user_id, time.time())
-        db.add_action_count(user_id)
+
+        # בקרת כניסה: כשהתורים מלאים לא מתחילים עבודה חדשה
+        try:
+            ticket = scheduler.admit(user_id, spec.premium, job_size(spec.file_size, upload_type, with_audio))
+        except QueueFull:
+            await progress_msg.edit_text("🚦 השרת עמוס כרגע, נסה שוב בעוד כמה דקות.")
+            return
+
+        job_id = jobqueue.enqueue(
+            spec.to_dict(),
+            PREMIUM_LANE if spec.premium else FREE_LANE,
+            progress_msg.chat.id,
+            progress_msg.id,
+            worker=LOCAL_WORKER
+        )
+        await run_local_job(client, job_id, spec, LocalReporter(progress_msg, user_id, job_id), ticket)
+        renderer.finish(progress_msg)
         await progress_msg.delete()
         
+    except UnsupportedFile:
+        await query.answer("❌ קובץ לא נתמך", show_alert=True)
+    except StorageFull as e:
+        logger.warning(f"אין מקום לעבודה של {user_id}: {e}")
+        await progress_msg.edit_text(STORAGE_FULL_TEXT)
+    except JobCancelled:
+        # עדכון התקדמות מהעבודה עצמה יכול היה להגיע אחרי הודעת הביטול - כותבים אותה שוב
+        renderer.finish(progress_msg)
+        await edit_cancelled(progress_msg)
+    except JobAborted:
+        pass
     except Exception as e:
         logger.error(f"שגיאה בהעלאה: {e}")
         try:
@@ -311,21 +358,204 @@ async def upload_file(client: Client, query: CallbackQuery):
         except Exception:
             pass
     finally:
-        db.delete_active_task(user_id)
-        db.delete_new_name(user_id)
-        if user_id in LAST_UPDATE:
-            del LAST_UPDATE[user_id]
-        if user_id in CANCEL_TASKS:
-            CANCEL_TASKS.pop(user_id)
+        sessions.update(user_id, active_task=None, new_name=None)
+        if not WORKERS:
+            renderer.finish(progress_msg)
+
+async def run_local_job(client: Client, job_id: int, spec: JobSpec, reporter: Reporter, ticket: Ticket):
+    # עבודה בתהליך של הבוט נשמרת בטבלת העבודות עם השלב ונקודת החידוש שלה,
+    # כדי שאם התהליך נופל באמצע היא תמשיך בהפעלה הבאה (resume_local_jobs)
+    try:
+        file_id = await job_control.run(
+            job_id, execute_job(client, spec, reporter, ticket, jobqueue.checkpoint(job_id))
+        )
+    except asyncio.CancelledError:
+        raise  # נשארת running - תמשיך בהפעלה הבאה
+    except JobCancelled:
+        jobqueue.finish(job_id, "cancelled")
+        raise
+    except UnsupportedFile:
+        jobqueue.finish(job_id, "failed", error=ERROR_UNSUPPORTED)
+        raise
+    except StorageFull:
+        jobqueue.finish(job_id, "failed", error=ERROR_STORAGE)
+        raise
+    except Exception as e:
+        jobqueue.finish(job_id, "failed", error=ERROR_ABORTED if isinstance(e, JobAborted) else str(e))
+        raise
+    jobqueue.finish(job_id, "done", result=file_id)
+
+async def resume_local_jobs(client: Client):
+    # עבודות שהתהליך הקודם לא סיים: המשתמש מקבל הודעה, וההתקדמות ממשיכה בהודעה הקיימת
+    for job in jobqueue.interrupted(LOCAL_WORKER):
+        spec = JobSpec(**job["spec"])
+        logger.info(f"ממשיך עבודה {job['id']} של {spec.user_id} משלב {job['stage']}")
+        try:
+            notice = await client.send_message(spec.user_id, RESUME_TEXT, reply_to_message_id=spec.original_msg_id)
+        except Exception as e:
+            logger.error(f"לא ניתן להודיע על חידוש עבודה {job['id']}: {e}")
+            jobqueue.finish(job["id"], "failed", error=str(e))
+            continue
+        progress_msg = await job_message(client, job)
+        if progress_msg is None:
+            # הודעת ההתקדמות המקורית נמחקה - ממשיכים בהודעת החידוש, ושומרים אותה כדי שהביטול ימצא את העבודה
+            progress_msg = notice
+            jobqueue.set_status_message(job["id"], notice.chat.id, notice.id)
+        JOB_MESSAGES.pop(job["id"], None)
+        asyncio.ensure_future(resume_local_job(client, job["id"], spec, progress_msg))
+
+async def resume_local_job(client: Client, job_id: int, spec: JobSpec, progress_msg: Message):
+    try:
+        # לא עוברת בקרת כניסה - העבודה כבר התקבלה לפני הנפילה
+        await run_local_job(client, job_id, spec, LocalReporter(progress_msg, spec.user_id, job_id),
+                            Ticket(spec.user_id, spec.premium))
+        renderer.finish(progress_msg)
+        await progress_msg.delete()
+    except UnsupportedFile:
+        await progress_msg.edit_text("❌ קובץ לא נתמך")
+    except StorageFull as e:
+        logger.warning(f"אין מקום לעבודה {job_id}: {e}")
+        await progress_msg.edit_text(STORAGE_FULL_TEXT)
+    except JobCancelled:
+        renderer.finish(progress_msg)
+        await edit_cancelled(progress_msg)
+    except JobAborted:
+        pass
+    except Exception as e:
+        logger.error(f"שגיאה בעבודה {job_id}: {e}")
+        try:
+            await progress_msg.edit_text("❌ אירעה שגיאה בעיבוד הקובץ")
+        except Exception:
+            pass
+    finally:
+        renderer.finish(progress_msg)
+
+def enqueue_job(spec: JobSpec, progress_msg: Message) -> bool:
+    # אותה בקרת כניסה כמו בתהליך יחיד: לפרימיום יש מרווח כפול, ועבודה שאין לה מקום בדיסק
+    # (או שגדולה מהמכסה של worker) נדחית עם StorageFull במקום להיתפס ולחזור לתור שוב ושוב
+    limit = MAX_QUEUED_JOBS * 2 if spec.premium else MAX_QUEUED_JOBS
+    if jobqueue.pending() >= limit:
+        scheduler.shed += 1
+        return False
+    storage.check(job_size(spec.file_size, spec.upload_type, spec.with_audio))
+    job_id = jobqueue.enqueue(
+        spec.to_dict(),
+        PREMIUM_LANE if spec.premium else FREE_LANE,
+        progress_msg.chat.id,
+        progress_msg.id
+    )
+    JOB_MESSAGES[job_id] = progress_msg
+    return True
+
+async def job_message(client: Client, job) -> Optional[Message]:
+    message = JOB_MESSAGES.get(job["id"])
+    if message is None:
+        # אחרי הפעלה מחדש של הבוט ההודעה לא בזיכרון - מביאים אותה מטלגרם
+        try:
+            message = await client.get_messages(chat_id=job["status_chat_id"], message_ids=job["status_msg_id"])
+        except Exception as e:
+            logger.error(f"לא ניתן לטעון את הודעת ההתקדמות של עבודה {job['id']}: {e}")
+            return None
+        JOB_MESSAGES[job["id"]] = message
+    return message
+
+async def sync_jobs(client: Client):
+    for job in jobqueue.unacked():
+        message = await job_message(client, job)
+        state = job["state"]
+        if state in ("queued", "running"):
+            if message is None or job["cancel_requested"]:
+                continue
+            if state == "queued":
+                renderer.status(message, f"⏳ **ממתין בתור**\n\nמקום בתור: {jobqueue.position(job['id'])}")
+            elif job["progress_action"] == "status":
+                renderer.status(message, job["status_text"])
+            elif job["progress_action"]:
+                renderer.report(message, job["progress_current"], job["progress_total"], job["progress_action"])
+            continue
+
+        jobqueue.ack(job["id"])
+        JOB_MESSAGES.pop(job["id"], None)
+        if message is None:
+            continue
+        renderer.finish(message)
+        try:
+            if state == "done":
+                await message.delete()
+            elif state == "failed" and job["error"] != ERROR_ABORTED:
+                text = {
+                    ERROR_UNSUPPORTED: "❌ קובץ לא נתמך",
+                    ERROR_STORAGE: STORAGE_FULL_TEXT,
+                }.get(job["error"], "❌ אירעה שגיאה בעיבוד הקובץ")
+                await message.edit_text(text)
+        except Exception as e:
+            logger.error(f"שגיאה בעדכון הודעת עבודה {job['id']}: {e}")
+
+async def monitor_jobs(client: Client):
+    # תהליכי ה-worker רק כותבים מצב לתור; כל עריכות ההודעות נעשות מכאן, דרך ה-renderer
+    while True:
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+        try:
+            await sync_jobs(client)
+        except Exception as e:
+            logger.error(f"שגיאה במעקב אחר עבודות: {e}")
+
+def queue_depth() -> int:
+    # עבודות שממתינות: בתורי השלבים בתהליך הזה, ובתור המשותף כשיש תהליכי worker
+    depth = scheduler.queued
+    if WORKERS:
+        depth += jobqueue.pending()
+    return depth
+
+registry.queue_depth = queue_depth
+
+def start_background_tasks():
+    asyncio.ensure_future(watchdog.run())
+    # ניקוי קבצים יתומים מהרצות קודמות (כולל מיקומים ישנים), ואחר כך מדי פעם.
+    # הקבצים של עבודות שעוד יכולות להמשיך נשארים
+    asyncio.ensure_future(storage.sweeper(jobqueue.resumable_keys, legacy=True))
+    if WORKERS:
+        asyncio.ensure_future(monitor_jobs(app))
+    else:
+        asyncio.ensure_future(resume_local_jobs(app))
+    premium_expiry.on_expire = notify_premium_expired
+    asyncio.ensure_future(premium_expiry.run())
+    # שידור שנקטע בהפעלה הקודמת ממשיך מנקודת החידוש האחרונה
+    asyncio.ensure_future(broadcaster.resume(app))
+
+async def notify_premium_expired(user_id: int):
+    await app.send_message(chat_id=user_id, text="⌛ תקופת הפרימיום שלך הסתיימה. חזרת לתוכנית החינמית.")
+
+def cancel_job(job_id: int) -> Optional[Tuple[int, int]]:
+    # נשמר בטבלה (worker שמריץ את העבודה יראה תוך שנייה, והיא לא תתחדש אחרי הפעלה מחדש),
+    # ועבודה שרצה בתהליך הזה נעצרת מיד. הודעת ההתקדמות יוצאת מה-renderer כדי שעדכון
+    # שעוד ממתין לא ידרוס את הודעת הביטול; מחזיר אותה (צ'אט, הודעה) לעריכה
+    jobqueue.request_cancel(job_id)
+    job_control.cancel(job_id)
+    status = jobqueue.status_message(job_id)
+    if status is not None:
+        renderer.finish_id(*status)
+    return status
+
+async def edit_cancelled(message: Message):
+    try:
+        await message.edit_text(CANCELLED_TEXT)
+    except MessageNotModified:
+        pass
+    except Exception as e:
+        logger.error(f"שגיאה בעדכון הודעת ביטול: {e}")
 
 @app.on_callback_query(filters.regex("^cancel"))
 async def cancel_process(client: Client, query: CallbackQuery):
     user_id = query.from_user.id
-    db.delete_active_task(user_id)
-    CANCEL_TASKS[user_id] = True  # סימון ביטול
+    sessions.update(user_id, active_task=None)
+    job_id = jobqueue.find_by_status_message(query.message.chat.id, query.message.id)
+    if job_id is not None:
+        cancel_job(job_id)
+    renderer.finish(query.message)
     try:
         await query.answer("הפעולה בוטלה", show_alert=True)
-        await query.message.edit_text("❌ הפעולה בוטלה!")
+        await query.message.edit_text(CANCELLED_TEXT)
     except Exception as e:
         logger.error(f"שגיאה בטיפול בביטול: {e}")
 
@@ -365,6 +595,7 @@ async def add_premium(client: Client, message: Message):
             return await message.reply_text("❌ פורמט זמן לא תקין", reply_to_message_id=message.id)
         new_premium = time.time() + duration
         db.set_premium_until(target_id, new_premium)
+        premium_expiry.schedule(target_id, new_premium)
         await message.reply_text(f"✅ הוספתי פרימיום למשתמש {target_id} לתקופה של {duration_str}", reply_to_message_id=message.id)
         try:
             await client.send_message(chat_id=target_id, text=f"🎉 קיבלת פרימיום לבוט למשך {duration_str}!")
@@ -395,31 +626,137 @@ async def stop_premium(client: Client, message: Message):
 async def list_premiums(client: Client, message: Message):
     if not is_admin(message.from_user.id):
         return await message.reply_text("❌ אין לך הרשאה לביצוע פעולה זו", reply_to_message_id=message.id)
-    users = db.get_all_users()
-    now = time.time()
-    premium_users = [uid for uid, data in users.items() if data.get("premium_until", 0) > now]
+    premium_users = [str(uid) for uid in db.premium_users(time.time())]
     text = "משתמשי פרימיום:\n" + "\n".join(premium_users) if premium_users else "אין משתמשי פרימיום"
     await message.reply_text(text, reply_to_message_id=message.id)
 
+@app.on_message(filters.command("broadcast"))
+async def broadcast(client: Client, message: Message):
+    # /broadcast <טקסט>, או תגובה ל-/broadcast על הודעה כלשהי - היא תועתק לכל המשתמשים כמו שהיא
+    if not is_admin(message.from_user.id):
+        return await message.reply_text("❌ אין לך הרשאה לביצוע פעולה זו", reply_to_message_id=message.id)
+    if broadcaster.running():
+        return await message.reply_text("⏳ שידור קודם עדיין רץ, נסה שוב כשיסתיים", reply_to_message_id=message.id)
+    parts = message.text.split(None, 1)
+    source = message.reply_to_message
+    if source is None and len(parts) < 2:
+        return await message.reply_text(
+            "❌ שימוש: /broadcast <הודעה>, או תגובה ב-/broadcast להודעה שתישלח לכל המשתמשים",
+            reply_to_message_id=message.id
+        )
+    total = db.broadcast_audience()
+    status_msg = await message.reply_text(f"📣 מתחיל שידור ל-{total} משתמשים...", reply_to_message_id=message.id)
+    if source is not None:
+        broadcast_id = db.create_broadcast(status_msg.chat.id, status_msg.id, total,
+                                           from_chat_id=source.chat.id, message_id=source.id)
+    else:
+        broadcast_id = db.create_broadcast(status_msg.chat.id, status_msg.id, total, text=parts[1])
+    broadcaster.start(client, broadcast_id)
+
+def format_trace(trace: Dict) -> str:
+    started = time.strftime("%d/%m %H:%M", time.localtime(trace["started"]))
+    lines = [
+        f"🧭 עבודה {trace['job_id']} ({trace['kind']}), {started}: {trace['outcome']}, {trace['total']:.1f} שניות",
+        f"המתנה בתור: {trace['queue_wait']:.1f} שניות",
+    ]
+    for span in trace["spans"]:
+        line = f"+{span['at']:.1f} {span['name']}"
+        if span.get("output"):
+            line += f" ({span['output']})"
+        line += f": {span['duration']:.1f} שניות"
+        if span.get("wait"):
+            line += f", המתנה {span['wait']:.1f}"
+        if span.get("cpu") is not None:
+            line += f", CPU {span['cpu']:.1f}"
+        lines.append(line)
+    if trace["bytes"]:
+        lines.append("הועברו: " + ", ".join(f"{action} {humanbytes(amount)}" for action, amount in trace["bytes"].items()))
+    if trace["counters"]:
+        lines.append(", ".join(f"{name}: {value:g}" for name, value in trace["counters"].items()))
+    return "\n".join(lines)
+
+@app.on_message(filters.command("trace"))
+async def trace(client: Client, message: Message):
+    # /trace <user_id> - ציר הזמן של העבודות האחרונות של המשתמש; /trace בלי פרמטר - אחוזונים לכל שלב
+    if not is_admin(message.from_user.id):
+        return await message.reply_text("❌ אין לך הרשאה לביצוע פעולה זו", reply_to_message_id=message.id)
+    parts = message.text.split()
+    loop = asyncio.get_event_loop()
+    if len(parts) < 2:
+        # קריאת קבצי המעקב מחוץ ללולאה
+        summary = await loop.run_in_executor(None, trace_store.percentiles)
+        if not summary:
+            return await message.reply_text("אין עדיין נתוני מעקב", reply_to_message_id=message.id)
+        lines = []
+        for name, values in summary.items():
+            show = humanbytes if name.startswith("bytes.") else (lambda value: f"{value:g}")
+            lines.append(
+                f"{name}: p50 {show(values['p50'])}, p90 {show(values['p90'])}, "
+                f"p99 {show(values['p99'])}, max {show(values['max'])} ({values['count']})"
+            )
+        text = "⏱ אחוזונים לפי שלב (זמנים בשניות, מספר עבודות בסוגריים):\n" + "\n".join(lines)
+    else:
+        try:
+            target_id = int(parts[1])
+        except ValueError:
+            return await message.reply_text("❌ שימוש: /trace <user_id>", reply_to_message_id=message.id)
+        traces = await loop.run_in_executor(None, trace_store.for_user, target_id, 3)
+        if not traces:
+            return await message.reply_text(f"אין מעקב לעבודות של {target_id}", reply_to_message_id=message.id)
+        text = "\n\n".join(format_trace(trace) for trace in traces)
+    await message.reply_text(text[:4000], reply_to_message_id=message.id)
+
+@app.on_message(filters.command("profile"))
+async def profile(client: Client, message: Message):
+    # /profile [שניות] - דגימת כל ה-threads של הבוט; מחזיר את הפונקציות המובילות וקובץ collapsed
+    # (flamegraph.pl, speedscope). הדגימה רצה ב-thread נפרד - הלולאה ממשיכה לעבוד ונמדדת כרגיל
+    if not is_admin(message.from_user.id):
+        return await message.reply_text("❌ אין לך הרשאה לביצוע פעולה זו", reply_to_message_id=message.id)
+    parts = message.text.split()
+    try:
+        seconds = float(parts[1]) if len(parts) > 1 else 10.0
+    except ValueError:
+        seconds = 0
+    if not 0 < seconds <= SAMPLING_MAX_SECONDS:
+        return await message.reply_text(
+            f"❌ שימוש: /profile [שניות, עד {SAMPLING_MAX_SECONDS}]", reply_to_message_id=message.id
+        )
+    status_msg = await message.reply_text(f"🔬 דוגם את הבוט למשך {seconds:g} שניות...", reply_to_message_id=message.id)
+    try:
+        result = await asyncio.get_event_loop().run_in_executor(None, sampler.run, seconds)
+    except SamplerBusy:
+        return await status_msg.edit_text("⏳ דגימה אחרת כבר רצה, נסה שוב כשתסתיים")
+    await status_msg.edit_text(result.summary()[:4000])
+    document = io.BytesIO(result.collapsed().encode())
+    document.name = f"profile-{int(time.time())}.folded"
+    await message.reply_document(document, reply_to_message_id=message.id)
+
 @app.on_message(filters.command("stats"))
 async def stats(client: Client, message: Message):
     if not is_admin(message.from_user.id):
         return await message.reply_text("❌ אין לך הרשאה לביצוע פעולה זו", reply_to_message_id=message.id)
-    users = db.get_all_users()
-    total_users = len(users)
-    now = time.time()
-    premium_users = [uid for uid, data in users.items() if data.get("premium_until", 0) > now]
-    total_premium = len(premium_users)
-    total_actions = sum(data.get("actions_count", 0) for data in users.values())
-    downloads_usage = humanbytes(get_storage_usage("downloads"))
-    thumbs_usage = humanbytes(get_storage_usage("thumbnails"))
+    totals = db.aggregates()
+    scratch = storage.usage()
+    scratch_quota = humanbytes(scratch["quota"]) if scratch["quota"] else "ללא מכסה"
+    thumbs_usage = humanbytes(thumbnails.frames.bytes + thumbnails.custom.bytes)
+    cache_stats = result_cache.stats()
+    queues = scheduler.snapshot()
+    queues_text = ", ".join(f"{name} {q['active']}/{q['limit']} (+{q['queued']})" for name, q in queues.items())
+    workers_text = ""
+    if WORKERS:
+        jobs = jobqueue.counts()
+        workers_text = f"תהליכי עיבוד: {WORKERS}, עבודות: {jobs.get('running', 0)} בעיבוד, {jobs.get('queued', 0)} בתור\n"
     text = (
         f"📊 סטטיסטיקות:\n"
-        f"משתמשים: {total_users}\n"
-        f"משתמשי פרימיום: {total_premium}\n"
-        f"פעולות: {total_actions}\n"
-        f"שטח הורדות: {downloads_usage}\n"
+        f"משתמשים: {totals['total_users']}\n"
+        f"משתמשי פרימיום: {totals['premium_users']}\n"
+        f"פעולות: {totals['total_actions']}\n"
+        f"שטח זמני: {humanbytes(scratch['used'])} (שמור {humanbytes(scratch['reserved'])} מתוך {scratch_quota})\n"
         f"שטח תמונות: {thumbs_usage}\n"
+        f"מטמון המרות: {cache_stats['entries']} פריטים, {cache_stats['hit_rate']}% פגיעות "
+        f"({cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']})\n"
+        f"תורים: {queues_text}, נדחו: {scheduler.shed}\n"
+        f"{workers_text}"
         f"מצב השרת: תקין"
     )
     await message.reply_text(text, reply_to_message_id=message.id)
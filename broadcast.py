@@ -0,0 +1,242 @@
+# broadcast.py
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from typing import Dict, List, Optional, Set
+
+from pyrogram import Client
+from pyrogram.errors import FloodWait, InputUserDeactivated, UserIsBlocked, UserIsBot
+
+from config import BROADCAST_CONCURRENCY, BROADCAST_RATE, BROADCAST_PAGE
+from database import db
+from metrics import broadcast_messages, flood_waits
+
+logger = logging.getLogger(__name__)
+
+# נמען שלא יקבל הודעות גם בפעם הבאה: חסם את הבוט, מחק את החשבון או שהוא בוט.
+# PeerIdInvalid יכול להיות זמני (המשתמש עוד לא במטמון של הסשן) - נספר כנכשל ולא מסומן
+UNREACHABLE = (UserIsBlocked, InputUserDeactivated, UserIsBot)
+MIN_RATE = 1.0  # הודעות לשנייה - הרצפה של הקצב אחרי FloodWait חוזרים
+RATE_RECOVERY = 0.5  # הודעות לשנייה שהקצב עולה בכל שנייה של שליחה בלי FloodWait
+CHECKPOINT_INTERVAL = 2  # שניות בין שמירות של נקודת החידוש
+STATUS_INTERVAL = 15  # שניות בין עדכוני הודעת הסטטוס של המנהל
+SEND_RETRIES = 3  # ניסיונות לנמען בשגיאות רשת
+
+class AdaptiveRate:
+    # קצב משותף לכל השולחים (AIMD): FloodWait חוצה את הקצב ועוצר את כולם לזמן שטלגרם ביקש,
+    # וכל שליחה מוצלחת מחזירה אותו בהדרגה עד התקרה. תור שנשמר לפני העצירה נלקח מחדש אחריה
+    def __init__(self, rate: float, min_rate: float = MIN_RATE):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.next_at = time.monotonic()
+        self.paused_until = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            slot = max(now, self.next_at, self.paused_until)
+            self.next_at = slot + 1 / self.rate
+            await asyncio.sleep(slot - now)
+            if time.monotonic() >= self.paused_until:
+                return
+
+    def success(self):
+        self.rate = min(self.max_rate, self.rate + RATE_RECOVERY / self.rate)
+
+    def flood_wait(self, seconds: float):
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class BroadcastRun:
+    # מצב של שידור אחד בזמן ריצה. הנמענים נטענים מהמסד בעמודים לפי user_id ויוצאים לפי הסדר,
+    # כך שכל מי שקטן מהנמען הנמוך שעוד בשליחה כבר טופל - זה הסמן שנשמר בנקודת החידוש.
+    # נמענים מעל הסמן שכבר טופלו (שולחים מקבילים עקפו נמען איטי) נשמרים איתו, והחידוש מדלג עליהם
+    # - כך אף אחד לא מקבל את ההודעה פעמיים ולא נספר פעמיים
+    def __init__(self, broadcast: Dict, rate: float, page: int):
+        self.broadcast = broadcast
+        self.page = page
+        self.rate = AdaptiveRate(rate)
+        self.counts = {name: broadcast[name] for name in ("sent", "failed", "blocked", "flood_waits")}
+        self.fetched = broadcast["cursor"]  # ה-user_id האחרון שנטען מהמסד
+        self.pending = deque()
+        self.in_flight: Set[int] = set()
+        self.completed: Set[int] = set(json.loads(broadcast["done_ahead"] or "[]"))  # טופלו, מעל הסמן
+        self.exhausted = False
+        self.blocked: List[int] = []  # נמענים שעוד לא סומנו במסד
+        self.started = time.monotonic()
+        self.saved_at = self.started
+        self.status_at = self.started
+
+    def next_user(self) -> Optional[int]:
+        while True:
+            if not self.pending:
+                if self.exhausted:
+                    return None
+                users = db.broadcast_recipients(self.fetched, self.page)
+                if not users:
+                    self.exhausted = True
+                    return None
+                self.pending.extend(users)
+                self.fetched = users[-1]
+            user_id = self.pending.popleft()
+            if user_id in self.completed:
+                continue  # טופל לפני שהשידור נקטע
+            self.in_flight.add(user_id)
+            return user_id
+
+    def done(self, user_id: int, result: str):
+        self.in_flight.discard(user_id)
+        self.completed.add(user_id)
+        if result == "blocked":
+            self.blocked.append(user_id)
+        self.counts[result] += 1
+        broadcast_messages.inc(1, result)
+
+    def cursor(self) -> int:
+        if self.in_flight:
+            return min(self.in_flight) - 1
+        if self.pending:
+            return self.pending[0] - 1
+        return self.fetched
+
+    def elapsed(self) -> float:
+        return self.broadcast["elapsed"] + time.monotonic() - self.started
+
+    def checkpoint(self, **fields):
+        # הסמן, מי שטופל מעליו, המונים והנמענים החסומים נשמרים באותה טרנזקציה
+        cursor = self.cursor()
+        self.completed = {user_id for user_id in self.completed if user_id > cursor}
+        with db.batch():
+            for user_id in self.blocked:
+                db.mark_blocked(user_id, time.time())
+            db.save_broadcast(self.broadcast["id"], cursor=cursor, done_ahead=json.dumps(sorted(self.completed)),
+                              elapsed=self.elapsed(), **self.counts, **fields)
+        self.blocked = []
+        self.saved_at = time.monotonic()
+
+class Broadcaster:
+    # שולח הודעה לכל המשתמשים שלא סומנו כחסומים: כמה שולחים במקביל תחת קצב משותף, ונקודת
+    # חידוש כל כמה שניות - שידור שנקטע (הפעלה מחדש) ממשיך מהמקום שבו נעצר
+    def __init__(self, concurrency: int = BROADCAST_CONCURRENCY, rate: float = BROADCAST_RATE,
+                 page: int = BROADCAST_PAGE):
+        self.concurrency = max(1, concurrency)
+        self.rate = rate
+        self.page = page
+        self.current: Optional[int] = None
+
+    def running(self) -> bool:
+        return self.current is not None
+
+    def start(self, client: Client, broadcast_id: int) -> asyncio.Future:
+        self.current = broadcast_id
+        return asyncio.ensure_future(self.run(client, broadcast_id))
+
+    async def resume(self, client: Client):
+        for broadcast_id in db.running_broadcasts():
+            logger.info(f"ממשיך שידור {broadcast_id}")
+            self.current = broadcast_id
+            await self.run(client, broadcast_id)
+
+    async def run(self, client: Client, broadcast_id: int):
+        run = BroadcastRun(db.get_broadcast(broadcast_id), self.rate, self.page)
+        try:
+            await self._run(client, run)
+        except asyncio.CancelledError:
+            # עצירה מסודרת של הבוט - שומרים את המצב כדי שהחידוש לא ישלח שוב למי שכבר קיבל
+            run.checkpoint()
+            raise
+        except Exception as e:
+            logger.error(f"שגיאה בשידור {broadcast_id}: {e}")
+        finally:
+            self.current = None
+
+    async def _run(self, client: Client, run: BroadcastRun):
+        await asyncio.gather(*(self._lane(client, run) for _ in range(self.concurrency)))
+        run.checkpoint(state="done", finished_at=time.time())
+        elapsed = run.elapsed()
+        logger.info(f"שידור {run.broadcast['id']} הסתיים: {run.counts}, {elapsed:.0f} שניות")
+        # הודעה חדשה ולא עריכה - כדי שהמנהל יקבל התראה כשהשידור מסתיים
+        try:
+            await client.send_message(
+                run.broadcast["status_chat_id"], self._report_text(run.counts, elapsed),
+                reply_to_message_id=run.broadcast["status_msg_id"]
+            )
+        except Exception as e:
+            logger.warning(f"לא ניתן לשלוח את דוח השידור: {e}")
+
+    async def _lane(self, client: Client, run: BroadcastRun):
+        while True:
+            user_id = run.next_user()
+            if user_id is None:
+                return
+            run.done(user_id, await self._send(client, run, user_id))
+            now = time.monotonic()
+            if now - run.saved_at >= CHECKPOINT_INTERVAL:
+                run.checkpoint()
+            if now - run.status_at >= STATUS_INTERVAL:
+                run.status_at = now
+                await self._status(client, run.broadcast, self._progress_text(run))
+
+    async def _send(self, client: Client, run: BroadcastRun, user_id: int) -> str:
+        broadcast = run.broadcast
+        failures = 0
+        while True:
+            await run.rate.acquire()
+            try:
+                if broadcast["message_id"]:
+                    await client.copy_message(user_id, broadcast["from_chat_id"], broadcast["message_id"])
+                else:
+                    await client.send_message(user_id, broadcast["text"])
+            except FloodWait as e:
+                flood_waits.inc(1, "broadcast")
+                run.counts["flood_waits"] += 1
+                run.rate.flood_wait(e.value)
+            except UNREACHABLE:
+                return "blocked"
+            except (OSError, asyncio.TimeoutError) as e:
+                failures += 1
+                if failures >= SEND_RETRIES:
+                    logger.warning(f"לא ניתן לשלוח שידור למשתמש {user_id}: {e}")
+                    return "failed"
+                await asyncio.sleep(failures)
+            except Exception as e:
+                logger.warning(f"לא ניתן לשלוח שידור למשתמש {user_id}: {e}")
+                return "failed"
+            else:
+                run.rate.success()
+                return "sent"
+
+    @staticmethod
+    def _progress_text(run: BroadcastRun) -> str:
+        counts = run.counts
+        done = counts["sent"] + counts["failed"] + counts["blocked"]
+        return (
+            f"📣 שידור בתהליך: {done}/{run.broadcast['total']}\n"
+            f"נשלחו: {counts['sent']}, חסומים: {counts['blocked']}, נכשלו: {counts['failed']}\n"
+            f"קצב נוכחי: {run.rate.rate:.1f} הודעות לשנייה, FloodWait: {counts['flood_waits']}"
+        )
+
+    @staticmethod
+    def _report_text(counts: Dict[str, int], elapsed: float) -> str:
+        done = counts["sent"] + counts["failed"] + counts["blocked"]
+        throughput = done / elapsed if elapsed > 0 else 0.0
+        minutes, seconds = divmod(int(elapsed), 60)
+        return (
+            f"📣 השידור הסתיים\n"
+            f"נשלחו: {counts['sent']} מתוך {done}\n"
+            f"חסמו את הבוט או לא פעילים: {counts['blocked']} (ידולגו בשידורים הבאים)\n"
+            f"נכשלו: {counts['failed']}\n"
+            f"זמן: {minutes}:{seconds:02d}, קצב ממוצע: {throughput:.1f} הודעות לשנייה\n"
+            f"FloodWait: {counts['flood_waits']}"
+        )
+
+    async def _status(self, client: Client, broadcast: Dict, text: str):
+        try:
+            await client.edit_message_text(broadcast["status_chat_id"], broadcast["status_msg_id"], text)
+        except Exception as e:
+            logger.warning(f"לא ניתן לעדכן את הודעת השידור: {e}")
+
+broadcaster = Broadcaster()
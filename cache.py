@@ -0,0 +1,95 @@
+# cache.py
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from config import RESULT_CACHE_SIZE, RESULT_CACHE_TTL
+
+class ResultCache:
+    # מטמון תוצרי המרה: (file_unique_id, פרמטרי המרה) → file_id של הקובץ שכבר נשלח.
+    # בקשות מקבילות לאותו מפתח ממתינות לעבודה אחת שרצה (single-flight).
+    def __init__(self, max_entries: int = RESULT_CACHE_SIZE, max_age: float = RESULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._entries = OrderedDict()  # key -> (file_id, stored_at)
+        self._inflight: Dict[Tuple, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(file_unique_id: str, upload_type: str, profile: str = "default",
+                 thumb: Optional[str] = None, name: Optional[str] = None) -> Tuple:
+        return (file_unique_id, upload_type, profile, thumb or "", name or "")
+
+    def get(self, key: Tuple) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        file_id, stored_at = entry
+        if time.time() - stored_at > self.max_age:
+            del self._entries[key]
+            self.evictions += 1
+            return None
+        self._entries.move_to_end(key)
+        return file_id
+
+    def put(self, key: Tuple, file_id: str):
+        self._entries[key] = (file_id, time.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, key: Tuple):
+        self._entries.pop(key, None)
+
+    async def run(self, key: Tuple, producer: Callable[[], Awaitable[Optional[str]]]) -> Tuple[Optional[str], bool]:
+        # מחזיר (file_id, מהמטמון?). אם עבודה זהה כבר רצה - ממתינים לה במקום להריץ שוב
+        while True:
+            file_id = self.get(key)
+            if file_id:
+                self.hits += 1
+                return file_id, True
+            pending = self._inflight.get(key)
+            if pending is None:
+                break
+            self.shared += 1
+            try:
+                await asyncio.shield(pending)
+            except Exception:
+                # העבודה המובילה נכשלה - ננסה בעצמנו
+                pass
+
+        self.misses += 1
+        future = asyncio.get_event_loop().create_future()
+        self._inflight[key] = future
+        try:
+            file_id = await producer()
+        except BaseException as e:
+            future.set_exception(e if isinstance(e, Exception) else RuntimeError("producer cancelled"))
+            # מונע אזהרת "exception was never retrieved" כשאין ממתינים
+            future.exception()
+            raise
+        else:
+            if file_id:
+                self.put(key, file_id)
+            future.set_result(file_id)
+            return file_id, False
+        finally:
+            del self._inflight[key]
+
+    def stats(self) -> Dict[str, int]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared": self.shared,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits * 100 / lookups) if lookups else 0,
+        }
+
+result_cache = ResultCache()
@@ -7,3 +7,92 @@ BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
 PORT = int(os.environ.get("PORT", 8000))
 ADMIN_ID = int(os.environ.get("ADMIN_ID", 0))  # עדכן למזהה המנהל
 WAIT_TIME = 300
+
+# מסד נתונים
+DB_PATH = os.environ.get("DB_PATH", "data.db")
+LEGACY_JSON_PATH = os.environ.get("LEGACY_JSON_PATH", "data.json")
+
+# מצב שיחה זמני (זיכרון בלבד)
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 1800))  # שניות
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", 100000))
+
+# המרות ffmpeg
+TRANSCODE_WORKERS = int(os.environ.get("TRANSCODE_WORKERS", 2))  # המרות במקביל
+FFMPEG_THREADS = int(os.environ.get("FFMPEG_THREADS", 0))  # 0 = חלוקה אוטומטית של הליבות
+
+# מצב הזרמה: הורדה, המרה והעלאה במקביל בלי קבצי ביניים בדיסק
+STREAM_PIPELINE = os.environ.get("STREAM_PIPELINE", "0") == "1"
+STREAM_BUFFER_PARTS = int(os.environ.get("STREAM_BUFFER_PARTS", 8))  # חלקים של 512KB בתור ההעלאה
+
+# העברה מקבילית: כמה חיבורים לטלגרם לכל קובץ בהורדה ובהעלאה. כבוי כברירת מחדל (כמו STREAM_PIPELINE) -
+# ההעלאה המקבילית עוקפת את send_video/send_document ועוברת דרך ה-API הגולמי
+TRANSFER_PARALLELISM = int(os.environ.get("TRANSFER_PARALLELISM", 1))  # 1 = חיבור אחד כמו pyrogram
+TRANSFER_SEGMENT_SIZE = int(os.environ.get("TRANSFER_SEGMENT_SIZE", 32 * 1024 * 1024))  # בייטים לכל מקטע הורדה
+TRANSFER_MIN_SIZE = int(os.environ.get("TRANSFER_MIN_SIZE", 10 * 1024 * 1024))  # מתחת לזה - העלאה רגילה של pyrogram
+
+# מטמון תוצרי המרה (file_id של קבצים שכבר נשלחו)
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 10000))
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", 7 * 86400))  # שניות
+
+# מטמון תמונות ממוזערות בדיסק (מספר קבצים)
+THUMB_CACHE_SIZE = int(os.environ.get("THUMB_CACHE_SIZE", 2000))
+CUSTOM_THUMB_CACHE_SIZE = int(os.environ.get("CUSTOM_THUMB_CACHE_SIZE", 5000))
+
+# תקציב עריכות של הודעות התקדמות
+PROGRESS_GLOBAL_RATE = float(os.environ.get("PROGRESS_GLOBAL_RATE", 20))  # עריכות לשנייה בכל הבוט
+PROGRESS_CHAT_RATE = float(os.environ.get("PROGRESS_CHAT_RATE", 0.5))  # עריכות לשנייה לכל צ'אט
+
+# תזמון עבודות: מקביליות לכל שלב וגודל תור מקסימלי
+DOWNLOAD_SLOTS = int(os.environ.get("DOWNLOAD_SLOTS", 4))
+UPLOAD_SLOTS = int(os.environ.get("UPLOAD_SLOTS", 4))
+MAX_QUEUED_JOBS = int(os.environ.get("MAX_QUEUED_JOBS", 50))
+PREMIUM_WEIGHT = int(os.environ.get("PREMIUM_WEIGHT", 2))  # משקל בתור ההוגן בין משתמשי פרימיום
+QUEUE_NOTIFY_INTERVAL = int(os.environ.get("QUEUE_NOTIFY_INTERVAL", 10))  # שניות בין עדכוני מיקום בתור
+
+# תהליכי עיבוד נפרדים: הבוט מקבל עדכונים ומעביר עבודות דרך תור מתמיד בדיסק
+WORKERS = int(os.environ.get("WORKERS", 0))  # 0 = העבודות רצות בתהליך של הבוט
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", 2))  # עבודות במקביל בכל תהליך
+JOBS_DB_PATH = os.environ.get("JOBS_DB_PATH", "jobs.db")
+JOB_LEASE = int(os.environ.get("JOB_LEASE", 60))  # שניות עד שעבודה של תהליך שנפל חוזרת לתור
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+
+# ניטור: פעימת לולאת האירועים וספי מוכנות (/ready מחזיר 503 מעבר להם)
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", 0.5))  # שניות בין פעימות
+READY_MAX_LOOP_LAG = float(os.environ.get("READY_MAX_LOOP_LAG", 5))  # שניות
+READY_MAX_QUEUE_DEPTH = int(os.environ.get("READY_MAX_QUEUE_DEPTH", 100))
+
+# אחסון זמני לקבצי עבודות (אפשר להפנות ל-tmpfs, למשל /dev/shm/bot)
+SCRATCH_DIR = os.environ.get("SCRATCH_DIR", "downloads")
+SCRATCH_QUOTA = int(os.environ.get("SCRATCH_QUOTA", 0))  # בייטים לכל תהליך עיבוד, 0 = ללא מכסה
+SCRATCH_MIN_FREE = int(os.environ.get("SCRATCH_MIN_FREE", 512 * 1024 * 1024))  # בייטים שנשארים פנויים בדיסק
+SCRATCH_SWEEP_INTERVAL = int(os.environ.get("SCRATCH_SWEEP_INTERVAL", 600))  # שניות בין ניקויי קבצים יתומים
+
+# בחירת הגדרות המרה לפי הקלט והעומס
+UPLOAD_SIZE_LIMIT = int(os.environ.get("UPLOAD_SIZE_LIMIT", 2000 * 1024 * 1024))  # בייטים, מגבלת ההעלאה של טלגרם
+PROFILE_LONG_INPUT = int(os.environ.get("PROFILE_LONG_INPUT", 1800))  # שניות - קלט ארוך מזה עובר לרמה מהירה יותר
+
+# מצב אצווה: אלבום או כמה קבצים שנשלחו ברצף הופכים לעבודה אחת עם בחירה אחת והודעת התקדמות אחת
+BATCH_WINDOW = float(os.environ.get("BATCH_WINDOW", 3))  # שניות מהקובץ הקודם שבהן קובץ נוסף מצטרף לאצווה
+BATCH_MAX_FILES = int(os.environ.get("BATCH_MAX_FILES", 20))
+BATCH_LOOKAHEAD = int(os.environ.get("BATCH_LOOKAHEAD", 2))  # קבצים בעיבוד בו-זמנית - הבא יורד בזמן שהקודם מומר ומועלה
+
+# המרה בקטעים של קלט ארוך: פיצול בפריימי מפתח, המרת הקטעים במקביל וחיבור בלי המרה נוספת
+SEGMENT_MIN_DURATION = int(os.environ.get("SEGMENT_MIN_DURATION", 900))  # שניות, 0 = כבוי
+SEGMENT_WORKERS = int(os.environ.get("SEGMENT_WORKERS", 0))  # תהליכי ffmpeg במקביל, 0 = מספר הליבות
+SEGMENT_MIN_LENGTH = int(os.environ.get("SEGMENT_MIN_LENGTH", 30))  # שניות - קטע קצר מזה לא משתלם
+
+# שידור הודעה לכל המשתמשים (/broadcast)
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", 8))  # שליחות בו-זמנית
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 25))  # הודעות לשנייה - תקרת הקצב, יורד אוטומטית אחרי FloodWait
+BROADCAST_PAGE = int(os.environ.get("BROADCAST_PAGE", 200))  # נמענים שנטענים מהמסד בכל פעם
+
+# מעקב אחר עבודות: ציר זמן של שלבים, ffmpeg והעברות לכל עבודה, בקובץ מתגלגל לכל תהליך (/trace)
+TRACE_DIR = os.environ.get("TRACE_DIR", "traces")
+TRACE_MAX_BYTES = int(os.environ.get("TRACE_MAX_BYTES", 5 * 1024 * 1024))  # בייטים לקובץ לפני גלגול
+TRACE_BACKUPS = int(os.environ.get("TRACE_BACKUPS", 3))  # קבצים ישנים שנשמרים לכל תהליך
+
+# דוגם פרופיל לפי דרישה (/profile בבוט, או /profile בשרת הבריאות עם הכותרת X-Profile-Token)
+SAMPLING_INTERVAL = float(os.environ.get("SAMPLING_INTERVAL", 0.01))  # שניות בין דגימות
+SAMPLING_MAX_DEPTH = int(os.environ.get("SAMPLING_MAX_DEPTH", 64))  # מסגרות לכל מחסנית
+SAMPLING_MAX_SECONDS = int(os.environ.get("SAMPLING_MAX_SECONDS", 120))  # חלון דגימה מקסימלי
+SAMPLING_TOKEN = os.environ.get("SAMPLING_TOKEN", "")  # ריק = הנתיב בשרת הבריאות כבוי
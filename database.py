@@ -1,102 +1,326 @@
 # database.py
 import json
 import os
+import sqlite3
+import threading
 import time
-from typing import Dict, Union
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple, Union
 
-class Database:
-    def __init__(self, file_path: str = "data.json"):
-        self.file_path = file_path
-        self.data = self._load_data()
+from config import DB_PATH, LEGACY_JSON_PATH
+from metrics import db_write_latency
 
-    def _load_data(self) -> Dict:
-        if not os.path.exists(self.file_path):
-            return {"users": {}}
-        with open(self.file_path, "r") as f:
-            return json.load(f)
+# עמודות טבלת המשתמשים (רשימה סגורה - משמשת גם לבניית השאילתות)
+USER_COLUMNS = (
+    "thumbnail",
+    "last_action_time",
+    "premium_until",
+    "actions_count",
+    "blocked_at",
+)
 
-    def _save(self):
-        with open(self.file_path, "w") as f:
-            json.dump(self.data, f, indent=2)
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    thumbnail TEXT,
+    last_action_time REAL,
+    premium_until REAL,
+    actions_count INTEGER NOT NULL DEFAULT 0,
+    blocked_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_users_premium_until ON users (premium_until);
+CREATE INDEX IF NOT EXISTS idx_users_last_action_time ON users (last_action_time);
+CREATE TABLE IF NOT EXISTS aggregates (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    state TEXT NOT NULL DEFAULT 'running',
+    from_chat_id INTEGER,
+    message_id INTEGER,
+    text TEXT,
+    status_chat_id INTEGER NOT NULL,
+    status_msg_id INTEGER NOT NULL,
+    cursor INTEGER NOT NULL DEFAULT 0,
+    done_ahead TEXT,
+    total INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    blocked INTEGER NOT NULL DEFAULT 0,
+    flood_waits INTEGER NOT NULL DEFAULT 0,
+    elapsed REAL NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+"""
 
-    def save_thumbnail(self, user_id: int, file_id: str):
-        self.data["users"].setdefault(str(user_id), {})["thumbnail"] = file_id
-        self._save()
+# שדות של שידור שמתעדכנים בנקודות החידוש (רשימה סגורה - משמשת לבניית השאילתה)
+BROADCAST_PROGRESS = ("state", "cursor", "done_ahead", "sent", "failed", "blocked", "flood_waits", "elapsed", "finished_at")
 
-    def get_thumbnail(self, user_id: int) -> Union[str, None]:
-        return self.data["users"].get(str(user_id), {}).get("thumbnail")
+# סיכומים שמתעדכנים בכל כתיבה לטבלת המשתמשים (באותה טרנזקציה, ע"י triggers),
+# כך ש-/stats ו-/premiums לא סורקים את כל המשתמשים
+AGGREGATES = {
+    "total_users": "COUNT(*)",
+    "total_actions": "COALESCE(SUM(actions_count), 0)",
+    "premium_users": "COUNT(premium_until)",  # פרימיום פעיל - פגי תוקף מנוקים ע"י PremiumExpiry
+}
 
-    def delete_thumbnail(self, user_id: int):
-        if str(user_id) in self.data["users"]:
-            self.data["users"][str(user_id)].pop("thumbnail", None)
-            self._save()
+TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS users_aggregates_insert AFTER INSERT ON users BEGIN
+        UPDATE aggregates SET value = value + 1 WHERE name = 'total_users';
+        UPDATE aggregates SET value = value + NEW.actions_count WHERE name = 'total_actions';
+        UPDATE aggregates SET value = value + (NEW.premium_until IS NOT NULL) WHERE name = 'premium_users';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_aggregates_delete AFTER DELETE ON users BEGIN
+        UPDATE aggregates SET value = value - 1 WHERE name = 'total_users';
+        UPDATE aggregates SET value = value - OLD.actions_count WHERE name = 'total_actions';
+        UPDATE aggregates SET value = value - (OLD.premium_until IS NOT NULL) WHERE name = 'premium_users';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_aggregates_update AFTER UPDATE OF actions_count, premium_until ON users BEGIN
+        UPDATE aggregates SET value = value + NEW.actions_count - OLD.actions_count WHERE name = 'total_actions';
+        UPDATE aggregates SET value = value + (NEW.premium_until IS NOT NULL) - (OLD.premium_until IS NOT NULL)
+            WHERE name = 'premium_users';
+    END""",
+)
 
-    def add_active_task(self, user_id: int, message_id: int):
-        self.data["users"].setdefault(str(user_id), {})["active_task"] = message_id
-        self._save()
+class Database:
+    def __init__(self, file_path: str = DB_PATH):
+        self.file_path = file_path
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+        # isolation_level=None - כל פקודה בודדת היא טרנזקציה משלה, batch() פותח טרנזקציה מפורשת
+        self.conn = sqlite3.connect(file_path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        # INSERT OR REPLACE מוחק את השורה הקודמת - בלי זה ה-trigger של המחיקה לא רץ
+        self.conn.execute("PRAGMA recursive_triggers=ON")
+        self.conn.executescript(SCHEMA)
+        # עמודות שנוספו אחרי יצירת הטבלה בגרסאות קודמות
+        for table, name, definition in (
+            ("users", "blocked_at", "REAL"),
+            ("broadcasts", "done_ahead", "TEXT"),
+        ):
+            columns = {row["name"] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+            if name not in columns:
+                self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+        self._init_aggregates()
 
-    def get_active_task(self, user_id: int) -> Union[int, None]:
-        return self.data["users"].get(str(user_id), {}).get("active_task")
+    def _init_aggregates(self):
+        # בפעם הראשונה (או אחרי שנוסף סיכום) - סריקה אחת של הטבלה, ומאז רק triggers
+        with self.batch():
+            existing = {row["name"] for row in self.conn.execute("SELECT name FROM aggregates")}
+            for name, expression in AGGREGATES.items():
+                if name not in existing:
+                    self.conn.execute(
+                        f"INSERT INTO aggregates (name, value) SELECT ?, {expression} FROM users", (name,)
+                    )
+            for trigger in TRIGGERS:
+                self.conn.execute(trigger)
 
-    def delete_active_task(self, user_id: int):
-        if str(user_id) in self.data["users"]:
-            self.data["users"][str(user_id)].pop("active_task", None)
-            self._save()
+    @contextmanager
+    def batch(self):
+        # מאחד כמה כתיבות לטרנזקציה אחת (commit אחד בסוף הבלוק)
+        with self._lock:
+            if self._batch_depth == 0:
+                self.conn.execute("BEGIN IMMEDIATE")
+            self._batch_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self.conn.execute("ROLLBACK")
+                raise
+            else:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self._write("COMMIT")
 
-    def set_waiting_for_name(self, user_id: int, status: bool):
-        self.data["users"].setdefault(str(user_id), {})["waiting_for_name"] = status
-        self._save()
+    def _write(self, sql: str, params=()):
+        # כל כתיבה נמדדת כולל ההמתנה לנעילה - זה מה שהלולאה מרגישה
+        started = time.perf_counter()
+        with self._lock:
+            self.conn.execute(sql, params)
+        db_write_latency.observe(time.perf_counter() - started)
 
-    def is_waiting_for_name(self, user_id: int) -> bool:
-        return self.data["users"].get(str(user_id), {}).get("waiting_for_name", False)
+    def _set(self, user_id: int, column: str, value):
+        self._write(
+            f"INSERT INTO users (user_id, {column}) VALUES (?, ?) "
+            f"ON CONFLICT(user_id) DO UPDATE SET {column} = excluded.{column}",
+            (user_id, value)
+        )
 
-    def set_original_message(self, user_id: int, message_id: int):
-        self.data["users"].setdefault(str(user_id), {})["original_msg_id"] = message_id
-        self._save()
+    def _get(self, user_id: int, column: str, default=None):
+        with self._lock:
+            row = self.conn.execute(f"SELECT {column} FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None or row[0] is None:
+            return default
+        return row[0]
 
-    def get_original_message(self, user_id: int) -> Union[int, None]:
-        return self.data["users"].get(str(user_id), {}).get("original_msg_id")
+    def _clear(self, user_id: int, column: str):
+        self._write(f"UPDATE users SET {column} = NULL WHERE user_id = ?", (user_id,))
 
-    def save_new_name(self, user_id: int, new_name: str):
-        self.data["users"].setdefault(str(user_id), {})["new_name"] = new_name
-        self._save()
+    def save_thumbnail(self, user_id: int, file_id: str):
+        self._set(user_id, "thumbnail", file_id)
 
-    def get_new_name(self, user_id: int) -> Union[str, None]:
-        return self.data["users"].get(str(user_id), {}).get("new_name")
+    def get_thumbnail(self, user_id: int) -> Union[str, None]:
+        return self._get(user_id, "thumbnail")
 
-    def delete_new_name(self, user_id: int):
-        if str(user_id) in self.data["users"]:
-            self.data["users"][str(user_id)].pop("new_name", None)
-            self._save()
+    def delete_thumbnail(self, user_id: int):
+        self._clear(user_id, "thumbnail")
 
     def set_last_action_time(self, user_id: int, timestamp: float):
-        self.data["users"].setdefault(str(user_id), {})["last_action_time"] = timestamp
-        self._save()
+        self._set(user_id, "last_action_time", timestamp)
 
     def get_last_action_time(self, user_id: int) -> Union[float, None]:
-        return self.data["users"].get(str(user_id), {}).get("last_action_time")
+        return self._get(user_id, "last_action_time")
 
     def set_premium_until(self, user_id: int, timestamp: float):
-        self.data["users"].setdefault(str(user_id), {})["premium_until"] = timestamp
-        self._save()
+        self._set(user_id, "premium_until", timestamp)
 
     def get_premium_until(self, user_id: int) -> Union[float, None]:
-        return self.data["users"].get(str(user_id), {}).get("premium_until")
+        return self._get(user_id, "premium_until")
 
     def remove_premium(self, user_id: int):
-        if str(user_id) in self.data["users"]:
-            self.data["users"][str(user_id)].pop("premium_until", None)
-            self._save()
+        self._clear(user_id, "premium_until")
 
     def add_action_count(self, user_id: int):
-        user = self.data["users"].setdefault(str(user_id), {})
-        user["actions_count"] = user.get("actions_count", 0) + 1
-        self._save()
+        self._write(
+            "INSERT INTO users (user_id, actions_count) VALUES (?, 1) "
+            "ON CONFLICT(user_id) DO UPDATE SET actions_count = actions_count + 1",
+            (user_id,)
+        )
 
     def get_action_count(self, user_id: int) -> int:
-        return self.data["users"].get(str(user_id), {}).get("actions_count", 0)
+        return self._get(user_id, "actions_count", 0)
+
+    def register(self, user_id: int):
+        # /start: המשתמש נכנס לקהל השידורים, ומי שחסם את הבוט וחזר מפסיק להיות מדולג
+        self._write(
+            "INSERT INTO users (user_id) VALUES (?) ON CONFLICT(user_id) DO UPDATE SET blocked_at = NULL",
+            (user_id,)
+        )
+
+    def mark_blocked(self, user_id: int, timestamp: float):
+        self._set(user_id, "blocked_at", timestamp)
+
+    def get_user(self, user_id: int) -> Dict:
+        # כל השדות בשאילתה אחת (למשל לבדיקת הרשאה לפעולה)
+        with self._lock:
+            row = self.conn.execute(
+                f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        if row is None:
+            return {}
+        return {col: row[col] for col in USER_COLUMNS if row[col] is not None}
+
+    def aggregates(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self.conn.execute("SELECT name, value FROM aggregates").fetchall()
+        return {row["name"]: row["value"] for row in rows}
+
+    def premium_users(self, now: float) -> List[int]:
+        # לפי האינדקס על premium_until - תלוי במספר משתמשי הפרימיום ולא במספר המשתמשים
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT user_id FROM users WHERE premium_until > ? ORDER BY premium_until", (now,)
+            ).fetchall()
+        return [row["user_id"] for row in rows]
+
+    def premium_expiries(self) -> List[Tuple[float, int]]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT premium_until, user_id FROM users WHERE premium_until IS NOT NULL"
+            ).fetchall()
+        return [(row["premium_until"], row["user_id"]) for row in rows]
+
+    def expire_premium(self, user_id: int, premium_until: float) -> bool:
+        # מנקה רק אם התוקף לא השתנה בינתיים (הארכה ע"י /add אחרי שהתזמון נקבע)
+        started = time.perf_counter()
+        with self._lock:
+            cur = self.conn.execute(
+                "UPDATE users SET premium_until = NULL WHERE user_id = ? AND premium_until = ?",
+                (user_id, premium_until)
+            )
+        db_write_latency.observe(time.perf_counter() - started)
+        return cur.rowcount > 0
+
+    def broadcast_audience(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM users WHERE blocked_at IS NULL").fetchone()[0]
+
+    def broadcast_recipients(self, after: int, limit: int) -> List[int]:
+        # עמוד לפי המפתח הראשי, מהנקודה שבה השידור נעצר - בלי לטעון את כל המשתמשים לזיכרון
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT user_id FROM users WHERE user_id > ? AND blocked_at IS NULL ORDER BY user_id LIMIT ?",
+                (after, limit)
+            ).fetchall()
+        return [row["user_id"] for row in rows]
+
+    def create_broadcast(self, status_chat_id: int, status_msg_id: int, total: int, text: Optional[str] = None,
+                         from_chat_id: Optional[int] = None, message_id: Optional[int] = None) -> int:
+        started = time.perf_counter()
+        with self._lock:
+            cur = self.conn.execute(
+                "INSERT INTO broadcasts (from_chat_id, message_id, text, status_chat_id, status_msg_id, total, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (from_chat_id, message_id, text, status_chat_id, status_msg_id, total, time.time())
+            )
+        db_write_latency.observe(time.perf_counter() - started)
+        return cur.lastrowid
+
+    def save_broadcast(self, broadcast_id: int, **fields):
+        columns = [name for name in fields if name in BROADCAST_PROGRESS]
+        self._write(
+            f"UPDATE broadcasts SET {', '.join(f'{name} = ?' for name in columns)} WHERE id = ?",
+            (*(fields[name] for name in columns), broadcast_id)
+        )
+
+    def get_broadcast(self, broadcast_id: int) -> Dict:
+        with self._lock:
+            row = self.conn.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+        return dict(row) if row else {}
+
+    def running_broadcasts(self) -> List[int]:
+        with self._lock:
+            rows = self.conn.execute("SELECT id FROM broadcasts WHERE state = 'running' ORDER BY id").fetchall()
+        return [row["id"] for row in rows]
+
+    def get_all_users(self) -> Dict[str, Dict]:
+        # אותו מבנה שהחזיר data.json: {"<user_id>": {שדה: ערך}}
+        with self._lock:
+            rows = self.conn.execute(f"SELECT user_id, {', '.join(USER_COLUMNS)} FROM users").fetchall()
+        users = {}
+        for row in rows:
+            user = {col: row[col] for col in USER_COLUMNS if row[col] is not None}
+            users[str(row["user_id"])] = user
+        return users
 
-    def get_all_users(self):
-        return self.data.get("users", {})
+    def migrate_from_json(self, json_path: str = LEGACY_JSON_PATH) -> int:
+        # ייבוא חד-פעמי של data.json הישן. הקובץ משונה ל-.migrated כדי שלא ייובא שוב
+        if not os.path.exists(json_path):
+            return 0
+        with open(json_path, "r") as f:
+            users = json.load(f).get("users", {})
+        rows = []
+        for uid, data in users.items():
+            # שדות זמניים של שיחה (active_task, new_name וכו') לא עוברים - הם נשמרים ב-sessions
+            values = [data.get(col) for col in USER_COLUMNS]
+            actions = USER_COLUMNS.index("actions_count")
+            values[actions] = values[actions] or 0
+            rows.append((int(uid), *values))
+        placeholders = ", ".join("?" * (len(USER_COLUMNS) + 1))
+        with self.batch():
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO users (user_id, {', '.join(USER_COLUMNS)}) VALUES ({placeholders})",
+                rows
+            )
+        os.replace(json_path, json_path + ".migrated")
+        return len(rows)
 
 db = Database()
+db.migrate_from_json()
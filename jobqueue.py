@@ -0,0 +1,342 @@
+# jobqueue.py
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from config import JOBS_DB_PATH, JOB_LEASE, JOB_MAX_ATTEMPTS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    priority INTEGER NOT NULL,
+    spec TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    status_chat_id INTEGER,
+    status_msg_id INTEGER,
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    progress_action TEXT,
+    progress_current REAL,
+    progress_total REAL,
+    status_text TEXT,
+    result TEXT,
+    error TEXT,
+    annotations TEXT,
+    stage TEXT NOT NULL DEFAULT 'queued',
+    checkpoint TEXT,
+    acked INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, priority, id);
+CREATE INDEX IF NOT EXISTS idx_jobs_acked ON jobs (acked);
+"""
+
+# מצבים סופיים - העבודה לא תרוץ שוב
+FINAL_STATES = ("done", "failed", "cancelled")
+# השלבים של עבודה לאורך חייה; עבודה שנקטעה ממשיכה מהשלב והנקודה השמורים
+STAGES = ("queued", "downloading", "transcoding", "uploading", "done")
+# העבודות שהבוט מריץ בתהליך שלו (בלי workers) - בלי lease, מתחדשות בהפעלה הבאה
+LOCAL_WORKER = "local"
+
+# קודי שגיאה שה-worker כותב והבוט מתרגם להודעה למשתמש
+ERROR_UNSUPPORTED = "unsupported"
+ERROR_ABORTED = "aborted"  # השגיאה כבר דווחה למשתמש
+ERROR_STORAGE = "storage"  # אין מקום בדיסק הזמני
+
+class JobQueue:
+    # תור עבודות מתמיד ב-SQLite, משותף לתהליך הבוט ולתהליכי ה-worker.
+    # worker תופס עבודה עם lease שמתחדש; lease שפג (worker נפל) מחזיר את העבודה לתור
+    def __init__(self, file_path: str = JOBS_DB_PATH):
+        self.file_path = file_path
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(file_path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.executescript(SCHEMA)
+        # עמודות שנוספו אחרי יצירת הטבלה בגרסאות קודמות
+        columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        for name, definition in (
+            ("annotations", "TEXT"),
+            ("stage", "TEXT NOT NULL DEFAULT 'queued'"),
+            ("checkpoint", "TEXT"),
+        ):
+            if name not in columns:
+                self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {definition}")
+
+    def enqueue(self, spec: Dict, priority: int, status_chat_id: int, status_msg_id: int,
+                worker: Optional[str] = None) -> int:
+        # worker: עבודה שכבר רצה בתהליך הקורא (LOCAL_WORKER) - נשמרת רק לצורך חידוש אחרי נפילה
+        now = time.time()
+        with self._lock:
+            cur = self.conn.execute(
+                "INSERT INTO jobs (user_id, priority, spec, state, worker, acked, status_chat_id, status_msg_id, "
+                "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (spec["user_id"], priority, json.dumps(spec), "running" if worker else "queued", worker,
+                 int(worker is not None), status_chat_id, status_msg_id, now, now)
+            )
+            return cur.lastrowid
+
+    def pending(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+
+    def position(self, job_id: int) -> int:
+        with self._lock:
+            row = self.conn.execute("SELECT priority FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return 0
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND (priority < ? OR (priority = ? AND id <= ?))",
+                (row["priority"], row["priority"], job_id)
+            ).fetchone()[0]
+
+    def claim(self, worker_id: str, lease: float = JOB_LEASE) -> Optional[Dict]:
+        now = time.time()
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._recover_expired(now)
+                # פרימיום קודם; בתוך אותו נתיב - משתמש עם פחות עבודות רצות קודם, ואז לפי סדר הגעה
+                row = self.conn.execute(
+                    "SELECT j.* FROM jobs j WHERE j.state = 'queued' ORDER BY j.priority, "
+                    "(SELECT COUNT(*) FROM jobs r WHERE r.user_id = j.user_id AND r.state = 'running'), j.id LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    self.conn.execute("COMMIT")
+                    return None
+                self.conn.execute(
+                    "UPDATE jobs SET state = 'running', worker = ?, lease_until = ?, attempts = attempts + 1, "
+                    "updated_at = ? WHERE id = ?",
+                    (worker_id, now + lease, now, row["id"])
+                )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        job = dict(row)
+        job["spec"] = json.loads(job["spec"])
+        return job
+
+    def _recover_expired(self, now: float):
+        self.conn.execute(
+            "UPDATE jobs SET state = 'failed', error = 'worker lost', updated_at = ? "
+            "WHERE state = 'running' AND lease_until < ? AND attempts >= ?",
+            (now, now, JOB_MAX_ATTEMPTS)
+        )
+        self.conn.execute(
+            "UPDATE jobs SET state = 'queued', worker = NULL, updated_at = ? "
+            "WHERE state = 'running' AND lease_until < ?",
+            (now, now)
+        )
+
+    def renew(self, job_ids: List[int], worker_id: str, lease: float = JOB_LEASE):
+        if not job_ids:
+            return
+        now = time.time()
+        with self._lock:
+            self.conn.execute(
+                f"UPDATE jobs SET lease_until = ? WHERE worker = ? AND state = 'running' "
+                f"AND id IN ({', '.join('?' * len(job_ids))})",
+                (now + lease, worker_id, *job_ids)
+            )
+
+    def release(self, job_id: int):
+        # worker שנעצר בצורה מסודרת מחזיר את העבודה לתור בלי לחכות לפקיעת ה-lease
+        with self._lock:
+            self.conn.execute(
+                "UPDATE jobs SET state = 'queued', worker = NULL, attempts = attempts - 1, updated_at = ? "
+                "WHERE id = ? AND state = 'running'",
+                (time.time(), job_id)
+            )
+
+    def report(self, job_id: int, current: float, total: float, action: str):
+        with self._lock:
+            self.conn.execute(
+                "UPDATE jobs SET progress_action = ?, progress_current = ?, progress_total = ?, updated_at = ? "
+                "WHERE id = ?",
+                (action, current, total, time.time(), job_id)
+            )
+
+    def set_status(self, job_id: int, text: str):
+        with self._lock:
+            self.conn.execute(
+                "UPDATE jobs SET progress_action = 'status', status_text = ?, updated_at = ? WHERE id = ?",
+                (text, time.time(), job_id)
+            )
+
+    def set_status_message(self, job_id: int, chat_id: int, message_id: int):
+        # ההודעה שמציגה את ההתקדמות הוחלפה - כפתור הביטול בהודעה החדשה מוצא את העבודה לפיה
+        with self._lock:
+            self.conn.execute(
+                "UPDATE jobs SET status_chat_id = ?, status_msg_id = ?, updated_at = ? WHERE id = ?",
+                (chat_id, message_id, time.time(), job_id)
+            )
+
+    def annotate(self, job_id: int, annotations: Dict):
+        with self._lock:
+            self.conn.execute(
+                "UPDATE jobs SET annotations = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(annotations), time.time(), job_id)
+            )
+
+    def set_stage(self, job_id: int, stage: str):
+        assert stage in STAGES, stage
+        with self._lock:
+            self.conn.execute("UPDATE jobs SET stage = ?, updated_at = ? WHERE id = ?", (stage, time.time(), job_id))
+
+    def save_checkpoint(self, job_id: int, checkpoint: Dict):
+        with self._lock:
+            self.conn.execute(
+                "UPDATE jobs SET checkpoint = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(checkpoint), time.time(), job_id)
+            )
+
+    def checkpoint(self, job_id: int) -> "JobCheckpoint":
+        with self._lock:
+            row = self.conn.execute("SELECT stage, checkpoint FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        data = json.loads(row["checkpoint"]) if row and row["checkpoint"] else {}
+        return JobCheckpoint(self, job_id, row["stage"] if row else "queued", data)
+
+    def finish(self, job_id: int, state: str, result: Optional[str] = None, error: Optional[str] = None):
+        assert state in FINAL_STATES, state
+        with self._lock:
+            self.conn.execute(
+                "UPDATE jobs SET state = ?, stage = CASE WHEN ? = 'done' THEN 'done' ELSE stage END, "
+                "result = ?, error = ?, lease_until = NULL, updated_at = ? WHERE id = ?",
+                (state, state, result, error, time.time(), job_id)
+            )
+
+    def request_cancel(self, job_id: int):
+        with self._lock:
+            self.conn.execute(
+                "UPDATE jobs SET cancel_requested = 1, updated_at = ? WHERE id = ?", (time.time(), job_id)
+            )
+            # עבודה שעוד לא נתפסה פשוט לא תרוץ
+            self.conn.execute(
+                "UPDATE jobs SET state = 'cancelled' WHERE id = ? AND state = 'queued'", (job_id,)
+            )
+
+    def status_message(self, job_id: int) -> Optional[Tuple[int, int]]:
+        with self._lock:
+            row = self.conn.execute("SELECT status_chat_id, status_msg_id FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return (row["status_chat_id"], row["status_msg_id"]) if row else None
+
+    def find_by_status_message(self, chat_id: int, message_id: int) -> Optional[int]:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT id FROM jobs WHERE status_chat_id = ? AND status_msg_id = ? ORDER BY id DESC LIMIT 1",
+                (chat_id, message_id)
+            ).fetchone()
+        return row["id"] if row else None
+
+    def active_for_user(self, user_id: int) -> List[int]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT id FROM jobs WHERE user_id = ? AND state IN ('queued', 'running')", (user_id,)
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+    def interrupted(self, worker: str = LOCAL_WORKER) -> List[Dict]:
+        # עבודות שהתהליך הקודם התחיל ולא סיים (נפל או כובה באמצע)
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT * FROM jobs WHERE state = 'running' AND worker = ? AND cancel_requested = 0 ORDER BY id",
+                (worker,)
+            ).fetchall()
+        jobs = []
+        for row in rows:
+            job = dict(row)
+            job["spec"] = json.loads(job["spec"])
+            jobs.append(job)
+        return jobs
+
+    def resumable_keys(self) -> Set[str]:
+        # תיקיות הקבצים הזמניים של עבודות שעוד יכולות להמשיך - ניקוי היתומים לא נוגע בהן
+        with self._lock:
+            rows = self.conn.execute("SELECT id FROM jobs WHERE state IN ('queued', 'running')").fetchall()
+        return {job_key(row["id"]) for row in rows}
+
+    def cancel_requested(self, job_ids: List[int]) -> List[int]:
+        if not job_ids:
+            return []
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT id FROM jobs WHERE cancel_requested = 1 AND id IN ({', '.join('?' * len(job_ids))})",
+                job_ids
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+    def unacked(self) -> List[sqlite3.Row]:
+        # עבודות שהבוט עוד לא סיים להציג (פעילות, או שהסתיימו ולא טופלו)
+        with self._lock:
+            return self.conn.execute("SELECT * FROM jobs WHERE acked = 0 ORDER BY id").fetchall()
+
+    def ack(self, job_id: int):
+        with self._lock:
+            self.conn.execute("UPDATE jobs SET acked = 1 WHERE id = ?", (job_id,))
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT state, COUNT(*) AS n FROM jobs WHERE state IN ('queued', 'running') GROUP BY state"
+            ).fetchall()
+        return {row["state"]: row["n"] for row in rows}
+
+class JobCheckpoint:
+    # מצב החידוש של עבודה אחת: השלב הנוכחי ונתונים שנשמרים תוך כדי (כמה בייטים הורדו,
+    # האם ההמרה הושלמה). נכתב לטבלה מיד, כדי ששום דבר לא יאבד בנפילה. בעבודת אצווה לכל
+    # קובץ נקודת חידוש משלו (child) שנשמרת בתוך הנתונים של העבודה
+    def __init__(self, queue: JobQueue, job_id: int, stage: str, data: Dict,
+                 name: Optional[str] = None, parent: Optional["JobCheckpoint"] = None):
+        self.queue = queue
+        self.job_id = job_id
+        self.stage = stage
+        self.data = data
+        self.name = name
+        self.parent = parent
+
+    @property
+    def key(self) -> str:
+        if self.parent is None:
+            return job_key(self.job_id)
+        return f"{self.parent.key}/{self.name}"
+
+    @property
+    def resumed(self) -> bool:
+        return self.stage != "queued"
+
+    def enter(self, stage: str):
+        if stage == self.stage:
+            return
+        self.stage = stage
+        if self.parent is None:
+            self.queue.set_stage(self.job_id, stage)
+        else:
+            self.save(stage=stage)
+
+    def get(self, name: str, default=None):
+        return self.data.get(name, default)
+
+    def save(self, **values):
+        self.data.update(values)
+        if self.parent is None:
+            self.queue.save_checkpoint(self.job_id, self.data)
+        else:
+            self.parent.save()
+
+    def child(self, name: str) -> "JobCheckpoint":
+        data = self.data.setdefault("files", {}).setdefault(name, {})
+        return JobCheckpoint(self.queue, self.job_id, data.get("stage", "queued"), data, name, self)
+
+def job_key(job_id: int) -> str:
+    return f"job_{job_id}"
+
+jobqueue = JobQueue()
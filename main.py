@@ -1,21 +1,132 @@
 # main.py
-from threading import Thread
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from bot import app
-from config import PORT
+import os
+import sys
+import json
+import hmac
+import time
+import logging
+import subprocess
+from threading import Thread, Event
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+from urllib.parse import urlsplit, parse_qs
+from pyrogram import idle
+from bot import app, start_background_tasks
+from config import PORT, WORKERS, SAMPLING_MAX_SECONDS, SAMPLING_TOKEN
+from metrics import registry
+from tracing import trace_store
+from sampling import sampler, SamplerBusy
+
+logger = logging.getLogger(__name__)
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+RESTART_DELAY = 5  # שניות מינימום בין הפעלות חוזרות של אותו worker
 
 class HealthHandler(BaseHTTPRequestHandler):
+    # /metrics - מדדים בפורמט Prometheus, /ready - 503 כשהלולאה תקועה או התור ארוך מדי,
+    # /traces - אחוזוני זמן לכל שלב מקבצי המעקב (JSON), /profile - דגימת פרופיל (רק עם SAMPLING_TOKEN),
+    # כל נתיב אחר - בדיקת חיים (התהליך עונה)
     def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
+        if self.path.startswith('/profile'):
+            self._profile()
+        elif self.path == '/metrics':
+            self._reply(200, registry.expose(), 'text/plain; version=0.0.4')
+        elif self.path == '/traces':
+            self._reply(200, json.dumps(trace_store.percentiles()), 'application/json')
+        elif self.path == '/ready':
+            ready, problems = registry.readiness()
+            self._reply(200 if ready else 503, 'OK' if ready else '\n'.join(problems))
+        else:
+            self._reply(200, 'OK')
+
+    def _profile(self):
+        # /profile?seconds=10[&format=top] עם הכותרת X-Profile-Token (לא בכתובת - היא נכתבת ללוג).
+        # ברירת המחדל היא פורמט collapsed (flamegraph.pl, speedscope)
+        query = parse_qs(urlsplit(self.path).query)
+        token = self.headers.get('X-Profile-Token', '')
+        if not SAMPLING_TOKEN or not hmac.compare_digest(token, SAMPLING_TOKEN):
+            return self._reply(403, 'forbidden')
+        try:
+            seconds = float(query.get('seconds', ['10'])[0])
+            limit = int(query.get('limit', ['30'])[0])
+        except ValueError:
+            seconds = 0
+        if not 0 < seconds <= SAMPLING_MAX_SECONDS:
+            return self._reply(400, f'seconds must be in (0, {SAMPLING_MAX_SECONDS}]')
+        try:
+            result = sampler.run(seconds)
+        except SamplerBusy:
+            return self._reply(409, 'another profile is running')
+        if query.get('format', [''])[0] == 'top':
+            self._reply(200, result.summary(limit), 'text/plain; charset=utf-8')
+        else:
+            self._reply(200, result.collapsed())
+
+    def _reply(self, status: int, body: str, content_type: str = 'text/plain'):
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
         self.end_headers()
-        self.wfile.write(b'OK')
+        self.wfile.write(body.encode())
 
 def run_health_server():
-    server = HTTPServer(('0.0.0.0', PORT), HealthHandler)
+    # בקשה לכל thread - דגימת פרופיל ארוכה לא חוסמת את /ready ו-/metrics
+    server = ThreadingHTTPServer(('0.0.0.0', PORT), HealthHandler)
     server.serve_forever()
 
+class WorkerSupervisor:
+    # מפעיל את תהליכי ה-worker ומפעיל מחדש כל תהליך שיצא (נפל, או נהרג כדי לאתחל אותו)
+    def __init__(self, count: int):
+        self.count = count
+        self.procs: Dict[int, subprocess.Popen] = {}
+        self.started_at: Dict[int, float] = {}
+        self._stop = Event()
+
+    def _spawn(self, index: int):
+        self.procs[index] = subprocess.Popen([sys.executable, WORKER_SCRIPT, str(index)])
+        self.started_at[index] = time.monotonic()
+        logger.info(f"worker {index} הופעל (pid {self.procs[index].pid})")
+
+    def run(self):
+        for index in range(self.count):
+            self._spawn(index)
+        while not self._stop.wait(1):
+            for index, proc in list(self.procs.items()):
+                if proc.poll() is None:
+                    continue
+                if time.monotonic() - self.started_at[index] < RESTART_DELAY:
+                    continue
+                logger.warning(f"worker {index} יצא עם קוד {proc.returncode}, מפעיל מחדש")
+                self._spawn(index)
+
+    def restart(self, index: int):
+        # SIGTERM: ה-worker מחזיר את העבודות שלו לתור ויוצא, והלולאה מפעילה אותו מחדש
+        self.procs[index].terminate()
+
+    def stop(self):
+        self._stop.set()
+        for proc in self.procs.values():
+            proc.terminate()
+        for proc in self.procs.values():
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+async def main():
+    await app.start()
+    start_background_tasks()
+    await idle()
+    await app.stop()
+
 if __name__ == "__main__":
     health_thread = Thread(target=run_health_server, daemon=True)
     health_thread.start()
-    app.run()
+    supervisor = None
+    if WORKERS:
+        supervisor = WorkerSupervisor(WORKERS)
+        Thread(target=supervisor.run, daemon=True).start()
+    try:
+        app.run(main())
+    finally:
+        if supervisor:
+            supervisor.stop()
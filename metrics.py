@@ -0,0 +1,228 @@
+# metrics.py
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+from config import LOOP_LAG_INTERVAL, READY_MAX_LOOP_LAG, READY_MAX_QUEUE_DEPTH
+
+# גבולות הדליים בשניות - מאלפיות שנייה (כתיבות למסד) ועד שעה (המרות ארוכות)
+DEFAULT_BUCKETS = (0.005, 0.025, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+RATE_WINDOW = 10  # שניות של היסטוריה לחישוב קצב העברה
+
+Labels = Tuple[str, ...]
+
+def _format_labels(names: Tuple[str, ...], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _le(bound) -> str:
+    return f'le="{bound}"'
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, *labels: str):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def expose(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in items]
+
+class Gauge(_Metric):
+    # ערך שנקרא בזמן הגירוד (קריאה לפונקציה) - בלי לעדכן אותו מכל נקודה בקוד
+    kind = "gauge"
+
+    def __init__(self, name, help_text, collect: Callable[[], Dict[Labels, float]], labels=()):
+        super().__init__(name, help_text, labels)
+        self.collect = collect
+
+    def expose(self) -> List[str]:
+        items = sorted(self.collect().items())
+        return self.header() + [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in items]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        self._counts: Dict[Labels, List[int]] = {}
+        self._sums: Dict[Labels, float] = {}
+
+    def observe(self, value: float, *labels: str):
+        with self._lock:
+            counts = self._counts.get(labels)
+            if counts is None:
+                counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+                self._sums[labels] = 0.0
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self._sums[labels] += value
+
+    def expose(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, list(counts), self._sums[key]) for key, counts in self._counts.items())
+        lines = self.header()
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, _le(bound))} {cumulative}")
+            cumulative += counts[-1]
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, _le('+Inf'))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+class TransferRate:
+    # בייטים לשנייה בחלון האחרון, לפי מונה מצטבר
+    def __init__(self, window: float = RATE_WINDOW):
+        self.window = window
+        self.samples = deque()
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def add(self, amount: int):
+        now = time.monotonic()
+        with self._lock:
+            self.total += amount
+            self.samples.append((now, self.total))
+            while len(self.samples) > 2 and now - self.samples[0][0] > self.window:
+                self.samples.popleft()
+
+    def rate(self) -> float:
+        now = time.monotonic()
+        with self._lock:
+            if not self.samples or now - self.samples[-1][0] > self.window:
+                return 0.0
+            t0, v0 = self.samples[0]
+            return (self.total - v0) / max(now - t0, 1e-6)
+
+class LoopWatchdog:
+    # פעימה בלולאת האירועים: כל איחור בהתעוררות הוא זמן שבו הלולאה הייתה חסומה.
+    # הבדיקה מתהליכון שרת הבריאות מזהה גם חסימה שעדיין נמשכת (הפעימה לא הגיעה)
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.last_beat: Optional[float] = None
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    async def run(self):
+        while True:
+            started = time.monotonic()
+            self.last_beat = started
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - started - self.interval)
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            loop_lag.observe(lag)
+
+    def lag(self) -> float:
+        if self.last_beat is None:
+            return 0.0
+        stalled = time.monotonic() - self.last_beat - self.interval
+        return max(self.last_lag, stalled, 0.0)
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+        self.queue_depth: Callable[[], int] = lambda: 0
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.expose())
+            except Exception as e:
+                lines.append(f"# {metric.name} unavailable: {e}")
+        return "\n".join(lines) + "\n"
+
+    def readiness(self) -> Tuple[bool, List[str]]:
+        problems = []
+        lag = watchdog.lag()
+        if lag > READY_MAX_LOOP_LAG:
+            problems.append(f"event loop lag {lag:.2f}s > {READY_MAX_LOOP_LAG}s")
+        depth = self.queue_depth()
+        if depth > READY_MAX_QUEUE_DEPTH:
+            problems.append(f"queue depth {depth} > {READY_MAX_QUEUE_DEPTH}")
+        return not problems, problems
+
+registry = Registry()
+watchdog = LoopWatchdog()
+transfer_rates: Dict[str, TransferRate] = {}
+
+stage_latency = registry.register(Histogram(
+    "bot_stage_duration_seconds", "Time spent inside a job stage", ("stage",)
+))
+stage_wait = registry.register(Histogram(
+    "bot_stage_wait_seconds", "Time a job waited for a stage slot", ("stage",)
+))
+transfer_bytes = registry.register(Counter(
+    "bot_transfer_bytes_total", "Bytes moved by downloads and uploads", ("action",)
+))
+registry.register(Gauge(
+    "bot_transfer_bytes_per_second", "Recent transfer throughput",
+    lambda: {(action,): rate.rate() for action, rate in transfer_rates.items()}, ("action",)
+))
+registry.register(Gauge(
+    "bot_queue_depth", "Jobs waiting for a slot", lambda: {(): registry.queue_depth()}
+))
+db_write_latency = registry.register(Histogram(
+    "bot_db_write_seconds", "SQLite write latency including lock wait"
+))
+flood_waits = registry.register(Counter(
+    "bot_floodwait_total", "FloodWait errors received from Telegram", ("source",)
+))
+broadcast_messages = registry.register(Counter(
+    "bot_broadcast_messages_total", "Broadcast deliveries by result", ("result",)
+))
+loop_lag = registry.register(Histogram(
+    "bot_event_loop_lag_seconds", "Event loop wake-up delay measured by the heartbeat",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+))
+registry.register(Gauge(
+    "bot_event_loop_lag_current_seconds", "Current event loop lag (includes an ongoing stall)",
+    lambda: {(): watchdog.lag()}
+))
+
+def record_transfer(action: str, amount: int):
+    if amount <= 0:
+        return
+    transfer_bytes.inc(amount, action)
+    rate = transfer_rates.get(action)
+    if rate is None:
+        rate = transfer_rates.setdefault(action, TransferRate())
+    rate.add(amount)
@@ -0,0 +1,772 @@
+# pipeline.py
+import os
+import time
+import asyncio
+import logging
+from contextlib import contextmanager, asynccontextmanager, nullcontext
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional, Set
+
+from pyrogram import Client
+from pyrogram.errors import RPCError
+from pyrogram.types import Message
+
+from config import STREAM_PIPELINE, TRANSFER_PARALLELISM, TRANSFER_MIN_SIZE, BATCH_LOOKAHEAD
+from database import db
+from cache import result_cache
+from streaming import StreamingUnsupported, stream_video, stream_document, send_uploaded_media
+from probe import probe, ProbeError
+from transcode import transcoder, TranscodeError, ConversionPlan, plan_conversion, audio_output_args
+from thumbnails import thumbnails
+from progress import renderer
+from scheduler import scheduler, Ticket
+from metrics import record_transfer
+from storage import storage, Reservation, StorageFull, job_size, plan_size
+from profiles import profile_engine
+from jobqueue import jobqueue, JobCheckpoint
+from transfer import ParallelDownload, TransferIncomplete, upload_parallel
+from segments import should_segment, encode_segmented
+from tracing import start_trace, trace_bytes, trace_count, traced, trace_store
+
+logger = logging.getLogger(__name__)
+
+RESUME_TEXT = "♻️ הבוט הופעל מחדש - ממשיך את העבודה שלך מהנקודה שבה נעצרה..."
+
+class JobAborted(Exception):
+    # העבודה הופסקה (ביטול או שגיאה שכבר דווחה למשתמש)
+    pass
+
+class UnsupportedFile(JobAborted):
+    pass
+
+class JobCancelled(JobAborted):
+    # המשתמש ביטל את העבודה - היא לא תמשיך, והקבצים שלה נמחקים
+    pass
+
+class JobControl:
+    # ה-task של כל עבודה שרצה בתהליך הזה, לפי מזהה העבודה. ביטול עוצר את ה-task מיד:
+    # ffmpeg נהרג, ההעברות נקטעות, והמשבצות בתורים והמקום בדיסק משתחררים ביציאה מה-context managers
+    def __init__(self):
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self.cancelled: Set[int] = set()
+
+    async def run(self, job_id: int, coro):
+        # העבודה רצה ב-task משלה, כך שביטול שלה לא מגיע ל-task שקרא לה (למשל worker של pyrogram)
+        task = asyncio.ensure_future(coro)
+        self.tasks[job_id] = task
+        try:
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            # הקורא עצמו בוטל (כיבוי) - העבודה נעצרת איתו ותמשיך בהפעלה הבאה
+            task.cancel()
+            await asyncio.wait({task})
+            raise
+        finally:
+            self.tasks.pop(job_id, None)
+            self.cancelled.discard(job_id)
+        if task.cancelled():
+            raise JobCancelled()
+        return task.result()
+
+    def cancel(self, job_id: int) -> bool:
+        task = self.tasks.get(job_id)
+        if task is None or task.done():
+            return False
+        self.cancelled.add(job_id)
+        task.cancel()
+        return True
+
+    def is_cancelled(self, job_id: Optional[int]) -> bool:
+        return job_id in self.cancelled
+
+job_control = JobControl()
+
+@contextmanager
+def cancellation(reporter: "Reporter"):
+    # ביטול של המשתמש (ולא כיבוי) הופך ל-JobCancelled כבר כאן, כדי שה-reservation
+    # שמסביב ימחק את הקבצים במקום לשמור אותם להמשך
+    try:
+        yield
+    except asyncio.CancelledError:
+        if reporter.cancelled():
+            raise JobCancelled() from None
+        raise
+
+@dataclass
+class JobSpec:
+    # כל מה שצריך כדי להריץ עבודה - ניתן לשמירה כ-JSON בתור העבודות
+    user_id: int
+    original_msg_id: int
+    upload_type: str
+    new_name: Optional[str] = None
+    premium: bool = False
+    batch: Optional[List[int]] = None  # עבודת אצווה: כל ההודעות שלה, לפי הסדר (הראשונה היא original_msg_id)
+    with_audio: bool = False  # וידאו: גם רצועת אודיו בלבד, מאותה הרצה של ffmpeg
+    file_size: Optional[int] = None  # הקובץ הגדול באצווה - לבדיקת המקום בדיסק לפני שהעבודה נלקחת
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+class Reporter:
+    # לאן עבודה מדווחת התקדמות, ואיך היא יודעת שבוטלה
+    def __init__(self, job_id: Optional[int] = None):
+        self.job_id = job_id
+        self._transferred = {}
+        self.annotations = {}
+
+    def transferred(self, current: float, action: str) -> float:
+        # הדיווחים מצטברים - מחזיר כמה נוסף מאז הדיווח הקודם של אותו שלב
+        previous = self._transferred.get(action, 0)
+        self._transferred[action] = current
+        return current - previous if current >= previous else current
+
+    def annotate(self, key: str, value):
+        # נתון שנשמר עם העבודה (למשל הגדרות ההמרה שנבחרו) לצורך מדידה בדיעבד
+        self.annotations[key] = value
+
+    def report(self, current: float, total: float, action: str):
+        raise NotImplementedError
+
+    def status(self, text: str):
+        raise NotImplementedError
+
+    def cancelled(self) -> bool:
+        return job_control.is_cancelled(self.job_id)
+
+class LocalReporter(Reporter):
+    # עבודה שרצה בתהליך של הבוט - עורכת את הודעת ההתקדמות דרך ה-renderer
+    def __init__(self, message: Message, user_id: int, job_id: Optional[int] = None):
+        super().__init__(job_id)
+        self.message = message
+        self.user_id = user_id
+
+    def report(self, current, total, action):
+        renderer.report(self.message, current, total, action)
+
+    def status(self, text):
+        renderer.status(self.message, text)
+
+    def annotate(self, key, value):
+        # כמו ב-worker: ההחלטות נשמרות בשורת העבודה גם כשהיא רצה בתהליך של הבוט
+        super().annotate(key, value)
+        if self.job_id is not None:
+            jobqueue.annotate(self.job_id, self.annotations)
+
+class BatchProgress:
+    # ההתקדמות של כל קובץ באצווה (0 עד 1 לפי השלבים שעבר) מדווחת כהתקדמות אחת של העבודה,
+    # בקבצים: כמה קבצים (חלקיים) הושלמו מתוך כולם
+    def __init__(self, reporter: Reporter, count: int, upload_type: str):
+        self.reporter = reporter
+        self.stages = ("download", "encode", "upload") if upload_type in ("video", "audio") else ("download", "upload")
+        self.done = [0.0] * count
+
+    def update(self, index: int, action: str, fraction: float):
+        if action not in self.stages:
+            return
+        value = (self.stages.index(action) + min(1.0, fraction)) / len(self.stages)
+        if value > self.done[index]:
+            self.done[index] = value
+            self.reporter.report(sum(self.done), len(self.done), "batch")
+
+    def complete(self, index: int):
+        self.update(index, self.stages[-1], 1.0)
+
+class BatchFileReporter(Reporter):
+    # קובץ אחד בעבודת אצווה: מדווח לסיכום של האצווה ולא להודעה משלו
+    def __init__(self, progress: BatchProgress, index: int):
+        super().__init__(progress.reporter.job_id)
+        self.progress = progress
+        self.index = index
+
+    def report(self, current, total, action):
+        self.progress.update(self.index, action, current / total if total else 0.0)
+
+    def status(self, text):
+        self.progress.reporter.status(text)
+
+class BatchPipeline:
+    # הסדר בין הקבצים של עבודת אצווה: ההורדות, וכך גם ההעלאות, נכנסות אחת בכל פעם לפי סדר
+    # הקבצים - הקובץ הבא יורד בזמן שהקודם מומר ומועלה, והתוצרים נשלחים בסדר המקורי.
+    # קובץ שלא עבר שלב (מטמון, כשל) משחרר את התור שלו ב-finish
+    STAGES = ("download", "upload")
+
+    def __init__(self, lookahead: int = BATCH_LOOKAHEAD):
+        self.slots = asyncio.Semaphore(max(1, lookahead))
+        self._next = {stage: 0 for stage in self.STAGES}
+        self._finished = {stage: set() for stage in self.STAGES}
+        self._advanced = asyncio.Event()
+
+    @asynccontextmanager
+    async def turn(self, stage: str, index: int):
+        while self._next[stage] < index:
+            await self._advanced.wait()
+        try:
+            yield
+        finally:
+            self.finish(index, stage)
+
+    def finish(self, index: int, *stages: str):
+        for stage in stages or self.STAGES:
+            self._finished[stage].add(index)
+            while self._next[stage] in self._finished[stage]:
+                self._next[stage] += 1
+        # כל הממתינים מתעוררים ובודקים שוב; הבאים בתור ימתינו לאירוע חדש
+        advanced, self._advanced = self._advanced, asyncio.Event()
+        advanced.set()
+
+class BatchSlot:
+    # המקום של קובץ אחד בסדר של עבודת האצווה
+    __slots__ = ("pipeline", "index")
+
+    def __init__(self, pipeline: BatchPipeline, index: int):
+        self.pipeline = pipeline
+        self.index = index
+
+@asynccontextmanager
+async def batch_turn(slot: Optional[BatchSlot], stage: str):
+    if slot is None:
+        yield
+    else:
+        async with slot.pipeline.turn(stage, slot.index):
+            yield
+
+async def progress_callback(current: int, total: int, start_time: float, reporter: Reporter, action: str):
+    # גיבוי לביטול דרך ה-task: אם העבודה סומנה כמבוטלת, עוצרים את ההעברה כאן
+    if reporter.cancelled():
+        raise JobCancelled()
+    if action != "encode":
+        amount = reporter.transferred(current, action)
+        record_transfer(action, amount)
+        trace_bytes(action, amount)
+    # העריכה עצמה מתבצעת ע"י ה-renderer בקצב מבוקר - כאן רק מדווחים
+    reporter.report(current, total, action)
+
+def make_encode_progress(reporter: Reporter):
+    async def encode_progress(processed: float, duration):
+        await progress_callback(processed, duration or 0, 0, reporter, "encode")
+
+    return encode_progress
+
+def make_queue_notice(reporter: Reporter):
+    async def on_wait(position: int, eta: float):
+        reporter.status(f"⏳ **ממתין בתור**\n\nמקום בתור: {position}\nהתחלה משוערת בעוד {int(eta)} שניות")
+
+    return on_wait
+
+def sent_file_id(sent: Message):
+    media = sent and (sent.video or sent.audio or sent.document)
+    return media.file_id if media else None
+
+def audio_file_name(name: str) -> str:
+    return f"{os.path.splitext(os.path.basename(name))[0]}.m4a"
+
+def audio_cache_key(file, new_name: Optional[str] = None):
+    # אותו מפתח לבקשת אודיו בלבד ולאודיו שנוצר כתוצר נוסף של המרת וידאו
+    return result_cache.make_key(file.file_unique_id, "audio", name=new_name)
+
+def enter_stage(checkpoint: Optional[JobCheckpoint], stage: str):
+    if checkpoint:
+        checkpoint.enter(stage)
+
+def grow_reservation(reservation: Reservation, size: int) -> bool:
+    # תוספת מקום לתוכנית המרה כבדה יותר; בלי מקום העבודה ממשיכה בתוכנית הרגילה
+    try:
+        reservation.grow(size)
+        return True
+    except StorageFull as e:
+        logger.info(f"אין מקום להרחבת העבודה ב-{reservation.directory}: {e}")
+        return False
+
+def parallel_download(size: Optional[int]) -> bool:
+    # כמו בהעלאה: חיבורים נוספים רק כשהם מותרים ורק לקבצים גדולים. בחיבור אחד download_media
+    # זול יותר ממקטעי stream_media, שכל אחד מהם פותח session משלו
+    return TRANSFER_PARALLELISM > 1 and (size or 0) >= TRANSFER_MIN_SIZE
+
+def parallel_upload(path: str) -> bool:
+    # קבצים קטנים עולים מהר גם בחיבור אחד - לא שווה לפתוח בשבילם חיבורים נוספים
+    return TRANSFER_PARALLELISM > 1 and os.path.getsize(path) >= TRANSFER_MIN_SIZE
+
+async def send_parallel(client: Client, path: str, file_name: str, on_upload, **media) -> Optional[Message]:
+    # העלאה מקבילית ושליחה דרך ה-API הגולמי. שגיאת RPC מאחד החיבורים (או בשליחה, שאז ההודעה
+    # לא נשלחה) לא מכשילה את העבודה - מחזירים None והקורא שולח בהעלאה הרגילה של pyrogram.
+    # שליחה שהצליחה בלי הודעה בתשובה היא שגיאה (send_uploaded_media זורק) - לא שולחים פעמיים
+    try:
+        input_file = await upload_parallel(client, path, file_name, on_upload)
+        return await send_uploaded_media(client, input_file=input_file, file_name=file_name, **media)
+    except RPCError as e:
+        logger.warning(f"העלאה מקבילית של {path} נכשלה ({e}), עובר להעלאה רגילה")
+        return None
+
+async def stream_upload(client: Client, original_msg: Message, file, upload_type: str,
+                        new_name, reporter: Reporter, start_time: float):
+    file_name = new_name or getattr(file, "file_name", None) or f"{file.file_unique_id}.mp4"
+
+    async def on_chunk(current: int):
+        await progress_callback(current, file.file_size or current, start_time, reporter, "stream")
+
+    thumb_path = None
+    custom_thumb = db.get_thumbnail(original_msg.chat.id) if upload_type == "video" else None
+    if custom_thumb:
+        thumb_path = await thumbnails.get_custom(client, original_msg.chat.id, custom_thumb)
+
+    try:
+        if upload_type == "video":
+            input_file, info, plan = await stream_video(client, original_msg, file_name, on_chunk)
+            logger.info(f"תוכנית המרה (הזרמה) עבור {file.file_id}: {plan}")
+            if plan.profile:
+                reporter.annotate("encode_profile", plan.profile.to_dict())
+                profile_engine.record(plan.profile)
+        else:
+            input_file = await stream_document(client, original_msg, file_name, on_chunk)
+            info = None
+    except StreamingUnsupported as e:
+        logger.info(f"הקובץ {file.file_id} לא מתאים להזרמה ({e}), עובר להורדה לדיסק")
+        return None
+
+    return await send_uploaded_media(
+        client,
+        chat_id=original_msg.chat.id,
+        input_file=input_file,
+        kind=upload_type,
+        file_name=file_name,
+        caption=f"📁 שם קובץ: `{new_name}`" if new_name and upload_type == "video" else None,
+        duration=int(info.duration or getattr(file, "duration", 0) or 0) if info else 0,
+        width=info.width if info else 0,
+        height=info.height if info else 0,
+        thumb=thumb_path,
+        reply_to_message_id=original_msg.id
+    )
+
+async def convert_and_send(client: Client, user_id: int, original_msg: Message, file, upload_type: str,
+                           new_name, reporter: Reporter, start_time: float, ticket: Ticket,
+                           reservation: Reservation, checkpoint: Optional[JobCheckpoint] = None,
+                           slot: Optional[BatchSlot] = None, with_audio: bool = False) -> Message:
+    original_msg_id = original_msg.id
+    on_wait = make_queue_notice(reporter)
+    resuming = bool(checkpoint and checkpoint.get("segments"))
+
+    # מצב הזרמה: הורדה, המרה והעלאה במקביל. אם הקלט דורש גישה אקראית - חוזרים למסלול הדיסק.
+    # עבודה שכבר הורידה חלק לדיסק ממשיכה במסלול הדיסק. קובץ באצווה תמיד עובר דרך הדיסק -
+    # שם ההורדה של הקובץ הבא חופפת להמרה ולהעלאה של הקודם. אודיו (לבד או עם הווידאו) נוצר מהקובץ בדיסק
+    if STREAM_PIPELINE and not resuming and slot is None and upload_type != "audio" and not with_audio:
+        # שלושת השלבים רצים יחד, לכן תופסים את שלושתם (תמיד באותו סדר)
+        async with scheduler.stage("download", ticket, on_wait), \
+                scheduler.stage("transcode", ticket, on_wait), \
+                scheduler.stage("upload", ticket, on_wait):
+            sent = await stream_upload(client, original_msg, file, upload_type, new_name, reporter, start_time)
+        if sent is not None:
+            return sent
+
+    async def on_chunk(current: int):
+        await progress_callback(current, file.file_size or current, start_time, reporter, "download")
+
+    def upload_progress(path: str):
+        size = os.path.getsize(path)
+
+        async def on_upload(current: int):
+            await progress_callback(current, size, start_time, reporter, "upload")
+
+        return on_upload
+
+    async def send_audio_output(path: str, duration) -> Message:
+        file_name = audio_file_name(new_name or getattr(file, "file_name", None) or file.file_unique_id)
+        if parallel_upload(path):
+            sent = await send_parallel(
+                client, path, file_name, upload_progress(path),
+                chat_id=user_id,
+                kind="audio",
+                duration=int(duration or 0),
+                reply_to_message_id=original_msg_id
+            )
+            if sent is not None:
+                return sent
+        return await client.send_audio(
+            chat_id=user_id,
+            audio=path,
+            file_name=file_name,
+            duration=int(duration or 0),
+            progress=progress_callback,
+            progress_args=(start_time, reporter, "upload"),
+            reply_to_message_id=original_msg_id
+        )
+
+    # הורדת הקובץ. השם נשמר בנקודת החידוש - file_id של אותו קובץ משתנה בין חיבורים
+    download_name = file.file_id
+    if checkpoint:
+        download_name = checkpoint.get("download_name") or download_name
+        checkpoint.save(download_name=download_name)
+    enter_stage(checkpoint, "downloading")
+    async with batch_turn(slot, "download"), scheduler.stage("download", ticket, on_wait):
+        download_path = None
+        if parallel_download(file.file_size):
+            try:
+                download_path = await ParallelDownload(
+                    client, original_msg, reservation.path(download_name), file.file_size, on_chunk, checkpoint
+                ).run()
+            except RPCError as e:
+                logger.warning(f"הורדה מקבילית של {file.file_id} נכשלה ({e}), עובר להורדה רגילה")
+        if download_path is None:
+            download_path = await client.download_media(
+                file.file_id,
+                file_name=reservation.path(download_name),
+                progress=progress_callback,
+                progress_args=(start_time, reporter, "download")
+            )
+    # הקבצים נמחקים ביציאה מה-reservation (ב-execute_job), גם בשגיאה
+    reservation.track(download_path)
+
+    # בדיקה במידה והמשתמש ביטל במהלך ההורדה
+    if reporter.cancelled():
+        raise JobCancelled()
+    if download_path is None:
+        # download_media מחזיר None כשההורדה נכשלה (ולא זורק)
+        raise TransferIncomplete(f"download of {file.file_id} failed")
+
+    if upload_type == "audio":
+        try:
+            with traced("probe"):
+                info = await probe(download_path)
+        except ProbeError as e:
+            logger.error(f"שגיאה בניתוח הקובץ: {e}")
+            info = None
+        if info is not None and not info.audio_codec:
+            await client.send_message(chat_id=user_id, text="❌ אין בקובץ רצועת אודיו", reply_to_message_id=original_msg_id)
+            raise JobAborted()
+        duration = info.duration if info else getattr(file, "duration", None)
+        audio_path = reservation.path("audio.m4a")
+        enter_stage(checkpoint, "transcoding")
+        async with scheduler.stage("transcode", ticket, on_wait):
+            try:
+                await transcoder.run(
+                    ["-i", download_path],
+                    audio_output_args(info, audio_path),
+                    duration=duration,
+                    progress=make_encode_progress(reporter)
+                )
+            except TranscodeError as e:
+                logger.error(f"שגיאה בחילוץ אודיו: {e}")
+                await client.send_message(chat_id=user_id, text="❌ אירעה שגיאה בחילוץ האודיו", reply_to_message_id=original_msg_id)
+                raise JobAborted()
+            reservation.track(audio_path)
+        enter_stage(checkpoint, "uploading")
+        async with batch_turn(slot, "upload"), scheduler.stage("upload", ticket, on_wait):
+            return await send_audio_output(audio_path, duration)
+
+    if upload_type == "video":
+        custom_thumb = db.get_thumbnail(user_id)
+        thumb_path = await thumbnails.get_custom(client, user_id, custom_thumb) if custom_thumb else None
+        # בדיקת הקודקים כדי לבחור בין העתקה, המרת אודיו בלבד או המרה מלאה
+        try:
+            with traced("probe"):
+                info = await probe(download_path)
+        except ProbeError as e:
+            logger.error(f"שגיאה בניתוח הקובץ: {e}")
+            info = None
+        plan = plan_conversion(info)
+        if plan.mode != "encode" and profile_engine.must_encode(file.file_size):
+            plan = ConversionPlan("encode", info)
+
+        duration = info.duration if info else getattr(file, "duration", None)
+        # רצועת אודיו בלבד כתוצר נוסף - נוצרת באותה הרצה של ffmpeg כמו ה-MP4
+        audio_path = reservation.path("audio.m4a") if with_audio and (info is None or info.audio_codec) else None
+
+        output_path = reservation.path("converted.mp4")
+        # תוצר המרה שהושלם לפני הנפילה - מעלים אותו כמו שהוא
+        reuse_output = bool(
+            checkpoint and checkpoint.get("transcoded") and os.path.exists(output_path)
+            and (audio_path is None or os.path.exists(audio_path))
+        )
+        if reuse_output:
+            logger.info(f"משתמש בתוצר ההמרה הקיים של {file.file_id}")
+        # בהמרה מלאה הפריימים מפוענחים בכל מקרה - התמונה הממוזערת יוצאת מאותו מעבר
+        frame_from_encode = not thumb_path and plan.mode == "encode" and not reuse_output
+        frame = None
+        enter_stage(checkpoint, "transcoding")
+        async with scheduler.stage("transcode", ticket, on_wait):
+            if plan.mode == "encode" and not reuse_output:
+                # ההגדרות נבחרות כשהמשבצת מתפנה - לפי העומס ברגע שההמרה באמת מתחילה
+                plan.profile = profile_engine.choose(info, file.file_size)
+                if plan.profile.two_pass and not grow_reservation(reservation, plan_size(file.file_size, two_pass=True)):
+                    # אין מקום לקובצי הסטטיסטיקה - מעבר אחד באותו קצב יעד
+                    plan.profile.two_pass = False
+                    plan.profile.reasons.append("no scratch space for two-pass")
+                if plan.profile.two_pass:
+                    plan.profile.passlog = reservation.path("passlog")
+                    reservation.path("passlog-0.log")
+                    reservation.path("passlog-0.log.mbtree")
+                reporter.annotate("encode_profile", plan.profile.to_dict())
+            logger.info(f"תוכנית המרה עבור {file.file_id}: {plan}")
+            try:
+                if plan.mode == "passthrough":
+                    output_path = download_path
+                    if audio_path and not reuse_output:
+                        # אין המרה - ההרצה היחידה היא חילוץ האודיו
+                        await transcoder.run(["-i", download_path], audio_output_args(info, audio_path))
+                elif not reuse_output:
+                    encode_started = time.monotonic()
+                    segmented = False
+                    if should_segment(plan, info) and grow_reservation(
+                            reservation, plan_size(file.file_size, segmented=True)):
+                        # קלט ארוך במכונה פנויה: הקטעים מומרים במקביל על כל הליבות
+                        try:
+                            await encode_segmented(
+                                download_path, output_path, plan, info, reservation,
+                                make_encode_progress(reporter), audio_path
+                            )
+                            segmented = True
+                            reporter.annotate("segmented", True)
+                        except TranscodeError as e:
+                            logger.warning(f"המרה בקטעים של {file.file_id} נכשלה, ממיר בתהליך אחד: {e}")
+                    if not segmented and plan.profile and plan.profile.two_pass:
+                        await transcoder.run(
+                            ["-i", download_path],
+                            plan.first_pass_args(),
+                            duration=duration,
+                            progress=make_encode_progress(reporter),
+                            label="first_pass"
+                        )
+                    if not segmented:
+                        frame = thumbnails.frame_output(file.file_unique_id, duration) if frame_from_encode else None
+                        await transcoder.run(
+                            ["-i", download_path],
+                            plan.output_args(output_path, frame, audio_path),
+                            duration=duration,
+                            progress=make_encode_progress(reporter),
+                            label=plan.mode
+                        )
+                    if plan.profile:
+                        profile_engine.record(plan.profile, duration, time.monotonic() - encode_started)
+                    if checkpoint:
+                        checkpoint.save(transcoded=True)
+            except TranscodeError as e:
+                logger.error(f"שגיאה בהמרת וידאו: {e}")
+                await client.send_message(chat_id=user_id, text="❌ אירעה שגיאה בהמרת הווידאו", reply_to_message_id=original_msg_id)
+                raise JobAborted()
+            reservation.track(output_path)
+            if audio_path:
+                reservation.track(audio_path)
+
+            if frame_from_encode:
+                thumb_path = thumbnails.adopt_frame(file.file_unique_id, frame)
+            if not thumb_path:
+                thumb_path = await thumbnails.extract(download_path, file.file_unique_id, duration)
+
+        enter_stage(checkpoint, "uploading")
+        async with batch_turn(slot, "upload"), scheduler.stage("upload", ticket, on_wait):
+            sent = None
+            if parallel_upload(output_path):
+                sent = await send_parallel(
+                    client, output_path, os.path.basename(output_path), upload_progress(output_path),
+                    chat_id=user_id,
+                    kind="video",
+                    caption=f"📁 שם קובץ: `{new_name}`" if new_name else None,
+                    duration=int(info.duration) if info else 0,
+                    width=info.width if info else 0,
+                    height=info.height if info else 0,
+                    thumb=thumb_path,
+                    reply_to_message_id=original_msg_id
+                )
+            if sent is None:
+                sent = await client.send_video(
+                    chat_id=user_id,
+                    video=output_path,
+                    thumb=thumb_path,
+                    duration=int(info.duration) if info else 0,
+                    width=info.width if info else 0,
+                    height=info.height if info else 0,
+                    supports_streaming=True,
+                    caption=f"📁 שם קובץ: `{new_name}`" if new_name else None,
+                    progress=progress_callback,
+                    progress_args=(start_time, reporter, "upload"),
+                    reply_to_message_id=original_msg_id
+                )
+            if audio_path:
+                audio_sent = await send_audio_output(audio_path, duration)
+                # גם בקשת אודיו בלבד לאותו קובץ תקבל אותו מהמטמון
+                if sent_file_id(audio_sent):
+                    result_cache.put(audio_cache_key(file, new_name), sent_file_id(audio_sent))
+            return sent
+    else:
+        enter_stage(checkpoint, "uploading")
+        async with batch_turn(slot, "upload"), scheduler.stage("upload", ticket, on_wait):
+            if parallel_upload(download_path):
+                sent = await send_parallel(
+                    client, download_path, new_name or os.path.basename(download_path), upload_progress(download_path),
+                    chat_id=user_id,
+                    kind="document",
+                    reply_to_message_id=original_msg_id
+                )
+                if sent is not None:
+                    return sent
+            return await client.send_document(
+                chat_id=user_id,
+                document=download_path,
+                file_name=new_name if new_name else None,
+                progress=progress_callback,
+                progress_args=(start_time, reporter, "upload"),
+                reply_to_message_id=original_msg_id
+            )
+
+async def send_cached(client: Client, user_id: int, file_id: str, upload_type: str, new_name, original_msg_id: int):
+    # שליחה חוזרת של תוצר קיים לפי file_id - בלי הורדה, המרה והעלאה
+    if upload_type == "audio":
+        return await client.send_audio(chat_id=user_id, audio=file_id, reply_to_message_id=original_msg_id)
+    if upload_type == "video":
+        return await client.send_video(
+            chat_id=user_id,
+            video=file_id,
+            caption=f"📁 שם קובץ: `{new_name}`" if new_name else None,
+            reply_to_message_id=original_msg_id
+        )
+    return await client.send_document(
+        chat_id=user_id,
+        document=file_id,
+        reply_to_message_id=original_msg_id
+    )
+
+async def process_file(client: Client, spec: JobSpec, original_msg: Message, reporter: Reporter, ticket: Ticket,
+                       checkpoint: Optional[JobCheckpoint] = None, slot: Optional[BatchSlot] = None) -> Optional[str]:
+    # קובץ אחד (מטמון → הורדה → המרה → העלאה); מחזיר את file_id של התוצר
+    user_id = spec.user_id
+    file = original_msg.video or original_msg.document
+    if not file:
+        raise UnsupportedFile()
+
+    start_time = time.time()
+
+    # אותו קלט עם אותם פרמטרים כבר הומר? שולחים את התוצר הקיים.
+    # במסמך טלגרם לא מאפשר לשנות שם בשליחה חוזרת, לכן השם הוא חלק מהמפתח
+    if spec.upload_type == "audio":
+        cache_key = audio_cache_key(file, spec.new_name)
+    else:
+        cache_key = result_cache.make_key(
+            file.file_unique_id,
+            "video+audio" if spec.with_audio else spec.upload_type,
+            thumb=db.get_thumbnail(user_id) if spec.upload_type == "video" else None,
+            name=spec.new_name if spec.upload_type == "file" else None
+        )
+    audio_key = audio_cache_key(file, spec.new_name) if spec.with_audio else None
+    if audio_key and not result_cache.get(audio_key):
+        result_cache.discard(cache_key)  # שני התוצרים נשלחים מהמטמון רק יחד
+
+    async def produce():
+        # המקום בדיסק נשמר מראש לפי גודל הקובץ; אם אין - StorageFull לפני שמתחילים להוריד
+        key = checkpoint.key if checkpoint else None
+        with storage.reserve(job_size(file.file_size, spec.upload_type, spec.with_audio), key) as reservation, \
+                cancellation(reporter):
+            sent = await convert_and_send(
+                client, user_id, original_msg, file, spec.upload_type, spec.new_name,
+                reporter, start_time, ticket, reservation, checkpoint, slot, spec.with_audio
+            )
+        return sent_file_id(sent)
+
+    file_id, cached = await result_cache.run(cache_key, produce)
+    if cached:
+        trace_count("cache_hits")
+        logger.info(f"נמצא במטמון: {file.file_unique_id} ({spec.upload_type})")
+        async with batch_turn(slot, "upload"):
+            await send_cached(client, user_id, file_id, spec.upload_type, spec.new_name, original_msg.id)
+            audio_id = result_cache.get(audio_key) if audio_key else None
+            if audio_id:
+                await send_cached(client, user_id, audio_id, "audio", None, original_msg.id)
+
+    if reporter.annotations:
+        logger.info(f"עבודה של {user_id} על {file.file_unique_id}: {reporter.annotations}")
+    return file_id
+
+async def report_file_failure(client: Client, message: Message, error: Exception):
+    # כשל של קובץ אחד באצווה מדווח בתשובה אליו; שגיאות המרה כבר דווחו (JobAborted)
+    if isinstance(error, UnsupportedFile):
+        text = "❌ קובץ לא נתמך"
+    elif isinstance(error, JobAborted):
+        return
+    else:
+        text = "❌ אירעה שגיאה בעיבוד הקובץ"
+    try:
+        await client.send_message(chat_id=message.chat.id, text=text, reply_to_message_id=message.id)
+    except Exception as e:
+        logger.error(f"לא ניתן לדווח על כשל בקובץ {message.id}: {e}")
+
+async def execute_batch(client: Client, spec: JobSpec, reporter: Reporter, ticket: Ticket,
+                        checkpoint: Optional[JobCheckpoint] = None) -> Optional[str]:
+    # עבודת אצווה: כל קובץ עובר את המסלול הרגיל עם נקודת חידוש משלו, ועד BATCH_LOOKAHEAD
+    # קבצים בעיבוד בו-זמנית לפי הסדר (BatchPipeline). קובץ שנכשל לא עוצר את השאר; ביטול
+    # עוצר את כולם. קבצים שהסתיימו נשמרים בנקודת החידוש ולא נשלחים שוב אחרי נפילה
+    messages = await client.get_messages(chat_id=spec.user_id, message_ids=spec.batch)
+    pipeline = BatchPipeline()
+    progress = BatchProgress(reporter, len(messages), spec.upload_type)
+    completed = set(checkpoint.get("completed", [])) if checkpoint else set()
+    results: Dict[int, Optional[str]] = {}
+    enter_stage(checkpoint, "downloading")
+
+    async def run(index: int, message: Message):
+        try:
+            if index in completed:
+                return
+            results[index] = await process_file(
+                client, spec, message, BatchFileReporter(progress, index), ticket,
+                checkpoint.child(str(index)) if checkpoint else None, BatchSlot(pipeline, index)
+            )
+            if checkpoint:
+                completed.add(index)
+                checkpoint.save(completed=sorted(completed))
+        except JobCancelled:
+            raise
+        except Exception as e:
+            logger.error(f"שגיאה בקובץ {index + 1}/{len(messages)} בעבודה של {spec.user_id}: {e}")
+            await report_file_failure(client, message, e)
+        finally:
+            progress.complete(index)  # גם קובץ שנכשל כבר לא ממתין
+            pipeline.finish(index)
+            pipeline.slots.release()
+
+    tasks = []
+    # התיקייה של העבודה (job_<id>) מכילה את התיקיות של הקבצים; ההזמנה שלה (בלי מקום) מוחקת
+    # אותה בסיום, ומשאירה אותה כשהעבודה נקטעה ותמשיך
+    with storage.reserve(0, checkpoint.key) if checkpoint else nullcontext():
+        try:
+            for index, message in enumerate(messages):
+                # הקובץ הבא מתחיל רק כשיש לו מקום - ההורדות לא רצות רחוק לפני ההמרות
+                await pipeline.slots.acquire()
+                tasks.append(asyncio.ensure_future(run(index, message)))
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+    if not results and not completed:
+        raise JobAborted()  # כל הקבצים נכשלו, וכל אחד כבר דווח
+    return results[max(results)] if results else None
+
+async def execute_job(client: Client, spec: JobSpec, reporter: Reporter, ticket: Ticket,
+                      checkpoint: Optional[JobCheckpoint] = None, queued_at: Optional[float] = None) -> Optional[str]:
+    # מריץ עבודה מלאה (קובץ אחד או אצווה) ומחזיר את file_id של התוצר.
+    # עם checkpoint העבודה שומרת את השלב וההתקדמות שלה וממשיכה מהם אם נקטעה.
+    # ציר הזמן של העבודה נכתב לקובץ המעקב בסיום, גם בכישלון או בביטול (queued_at - מתי נכנסה לתור)
+    user_id = spec.user_id
+    kind = f"batch:{spec.upload_type}" if spec.batch else spec.upload_type
+    trace = start_trace(reporter.job_id, user_id, kind, queued_at or ticket.created_at)
+    if checkpoint and checkpoint.resumed:
+        trace.count("resumed")
+    try:
+        if spec.batch:
+            trace.count("files", len(spec.batch))
+            file_id = await execute_batch(client, spec, reporter, ticket, checkpoint)
+        else:
+            original_msg = await client.get_messages(chat_id=user_id, message_ids=spec.original_msg_id)
+            file_id = await process_file(client, spec, original_msg, reporter, ticket, checkpoint)
+    except (JobCancelled, asyncio.CancelledError):
+        trace.outcome = "cancelled" if reporter.cancelled() else "interrupted"
+        raise
+    except Exception as e:
+        trace.outcome = type(e).__name__
+        raise
+    finally:
+        trace_store.submit(trace)
+
+    # עדכון זמן הפעולה וספירת פעולות (למשתמש לא פרימיום) - אצווה נספרת כפעולה אחת
+    with db.batch():
+        db.set_last_action_time(user_id, time.time())
+        db.add_action_count(user_id)
+    return file_id
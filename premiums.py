@@ -0,0 +1,65 @@
+# premiums.py
+import asyncio
+import heapq
+import logging
+import time
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+MAX_SLEEP = 3600  # שניות - בדיקה מחדש גם בלי שינוי (למשל אם שעון המערכת זז)
+
+class PremiumExpiry:
+    # ערימת מינימום של (premium_until, user_id): ה-task ישן עד התוקף הקרוב ביותר, מנקה אותו
+    # במסד (ומשם מתעדכן גם סיכום משתמשי הפרימיום) ומודיע למשתמש. רשומות שהשתנו בינתיים
+    # (הארכה או ביטול) לא נמחקות מהערימה - הן מזוהות כשמגיע תורן ומדולגות
+    def __init__(self):
+        self._heap: List[Tuple[float, int]] = []
+        self._wakeup = asyncio.Event()
+        self.on_expire: Optional[Callable[[int], Awaitable[None]]] = None
+        self.expired = 0
+
+    def load(self):
+        self._heap = db.premium_expiries()
+        heapq.heapify(self._heap)
+
+    def schedule(self, user_id: int, premium_until: float):
+        heapq.heappush(self._heap, (premium_until, user_id))
+        if self._heap[0] == (premium_until, user_id):
+            self._wakeup.set()  # התוקף החדש קודם לזה שה-task ממתין לו
+
+    def next_expiry(self) -> Optional[float]:
+        return self._heap[0][0] if self._heap else None
+
+    async def run(self):
+        self.load()
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                premium_until, user_id = heapq.heappop(self._heap)
+                await self._expire(user_id, premium_until)
+            delay = MAX_SLEEP if not self._heap else min(MAX_SLEEP, self._heap[0][0] - now)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _expire(self, user_id: int, premium_until: float):
+        try:
+            if not db.expire_premium(user_id, premium_until):
+                return
+        except Exception as e:
+            logger.error(f"שגיאה בסיום פרימיום של {user_id}: {e}")
+            return
+        self.expired += 1
+        logger.info(f"הפרימיום של {user_id} הסתיים")
+        if self.on_expire:
+            try:
+                await self.on_expire(user_id)
+            except Exception as e:
+                logger.error(f"לא ניתן להודיע למשתמש {user_id} על סיום הפרימיום: {e}")
+
+premium_expiry = PremiumExpiry()
@@ -0,0 +1,140 @@
+# probe.py
+import asyncio
+import io
+import json
+import struct
+from dataclasses import dataclass
+from typing import BinaryIO, Optional
+
+class ProbeError(Exception):
+    pass
+
+@dataclass
+class MediaInfo:
+    format_name: str
+    duration: float
+    width: int
+    height: int
+    video_codec: Optional[str]
+    audio_codec: Optional[str]
+    pix_fmt: Optional[str]
+    # None כשהקובץ אינו ממשפחת MP4/MOV (אין בו moov בכלל)
+    moov_at_start: Optional[bool]
+
+    @property
+    def is_mp4(self) -> bool:
+        return "mp4" in self.format_name or "mov" in self.format_name
+
+    @property
+    def is_matroska(self) -> bool:
+        return "matroska" in self.format_name or "webm" in self.format_name
+
+def find_moov(path: str) -> Optional[bool]:
+    # סורק את ה-atoms העליונים של הקובץ: True אם moov מופיע לפני mdat
+    try:
+        with open(path, "rb") as f:
+            return _scan_atoms(f)
+    except OSError:
+        return None
+
+def find_moov_in_head(head: bytes) -> Optional[bool]:
+    return _scan_atoms(io.BytesIO(head))
+
+def _scan_atoms(f: BinaryIO) -> Optional[bool]:
+    try:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            size, kind = struct.unpack(">I4s", header)
+            if kind == b"moov":
+                return True
+            if kind == b"mdat":
+                return False
+            if size == 1:
+                size = struct.unpack(">Q", f.read(8))[0]
+                header_size = 16
+            elif size == 0:
+                return None
+            else:
+                header_size = 8
+            if size < header_size:
+                # atom קטן מהכותרת שלו - קובץ פגום; קפיצה אחורה הייתה סורקת בלולאה אינסופית
+                return None
+            f.seek(size - header_size, 1)
+    except struct.error:
+        return None
+
+async def probe(path: str) -> MediaInfo:
+    info = await _ffprobe(path)
+    if info.is_mp4:
+        info.moov_at_start = find_moov(path)
+    return info
+
+async def probe_head(head: bytes) -> MediaInfo:
+    # ניתוח על סמך תחילת הקובץ בלבד (מצב הזרמה) - משך הזמן עשוי להיות 0
+    return await _ffprobe("pipe:0", head)
+
+async def _ffprobe(target: str, data: Optional[bytes] = None) -> MediaInfo:
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error",
+            "-print_format", "json",
+            "-show_format", "-show_streams",
+            target,
+            stdin=asyncio.subprocess.PIPE if data is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+    except OSError as e:
+        # ffprobe לא מותקן (או לא ניתן להרצה) - הקוראים ממשיכים בלי ניתוח, כמו בכל כשל אחר
+        raise ProbeError(f"cannot run ffprobe: {e}")
+    try:
+        stdout, stderr = await proc.communicate(data)
+    except BaseException:
+        # העבודה בוטלה באמצע הניתוח
+        if proc.returncode is None:
+            proc.kill()
+        raise
+    if proc.returncode != 0:
+        raise ProbeError(stderr.decode(errors="replace").strip())
+    try:
+        result = json.loads(stdout)
+    except ValueError as e:
+        raise ProbeError(f"Invalid ffprobe output: {e}")
+
+    streams = result.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"
+                  and not s.get("disposition", {}).get("attached_pic")), None)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    fmt = result.get("format", {})
+
+    width = int(video.get("width", 0)) if video else 0
+    height = int(video.get("height", 0)) if video else 0
+    if video and _rotation(video) in (90, 270):
+        width, height = height, width
+
+    duration = fmt.get("duration") or (video or {}).get("duration") or 0
+    format_name = fmt.get("format_name", "")
+    return MediaInfo(
+        format_name=format_name,
+        duration=float(duration),
+        width=width,
+        height=height,
+        video_codec=video.get("codec_name") if video else None,
+        audio_codec=audio.get("codec_name") if audio else None,
+        pix_fmt=video.get("pix_fmt") if video else None,
+        moov_at_start=None
+    )
+
+def _rotation(stream: dict) -> int:
+    rotate = stream.get("tags", {}).get("rotate")
+    if rotate is None:
+        for side in stream.get("side_data_list", []):
+            if "rotation" in side:
+                rotate = side["rotation"]
+                break
+    try:
+        return abs(int(float(rotate or 0))) % 360
+    except ValueError:
+        return 0
@@ -0,0 +1,133 @@
+# profiles.py
+import os
+from dataclasses import dataclass, asdict, field
+from typing import Dict, List, Optional
+
+from config import UPLOAD_SIZE_LIMIT, PROFILE_LONG_INPUT
+from probe import MediaInfo
+from scheduler import scheduler
+from metrics import registry, Counter, Histogram
+
+# רמות עומס: ככל שהמכונה עמוסה יותר - preset מהיר יותר, CRF גבוה יותר ותקרת רזולוציה
+LEVELS = (
+    {"level": "normal", "preset": "veryfast", "crf": 23, "max_height": None},
+    {"level": "busy", "preset": "superfast", "crf": 25, "max_height": 1080},
+    {"level": "overloaded", "preset": "ultrafast", "crf": 27, "max_height": 720},
+)
+AUDIO_BITRATE = 128_000
+SIZE_MARGIN = 0.95  # מרווח לתקורת המיכל מעל קצב היעד
+# מתחת לקצבים האלה (וידאו, ביט לשנייה) רזולוציה גבוהה רק מוסיפה ארטיפקטים
+BITRATE_HEIGHT_CAPS = ((800_000, 480), (2_000_000, 720))
+
+encode_decisions = registry.register(Counter(
+    "bot_encode_profile_total", "Encode profile decisions", ("level", "preset", "rate_control")
+))
+encode_speed = registry.register(Histogram(
+    "bot_encode_speed_ratio", "Seconds of media encoded per wall-clock second", ("level",),
+    buckets=(0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+))
+
+@dataclass
+class EncodeProfile:
+    level: str
+    preset: str
+    crf: Optional[int] = 23
+    max_height: Optional[int] = None
+    video_bitrate: Optional[int] = None  # ביט לשנייה; כשמוגדר - קצב יעד במקום CRF
+    two_pass: bool = False
+    audio_bitrate: int = AUDIO_BITRATE
+    passlog: Optional[str] = None  # קידומת קבצי הלוג של שני המעברים
+    signals: Dict[str, float] = field(default_factory=dict)
+    reasons: List[str] = field(default_factory=list)
+
+    @property
+    def rate_control(self) -> str:
+        if self.video_bitrate is None:
+            return "crf"
+        return "2pass" if self.two_pass else "abr"
+
+    def video_filter(self) -> Optional[str]:
+        # רק הקטנה - קלט נמוך מהתקרה נשאר ברזולוציה שלו
+        return f"scale=-2:'min({self.max_height},ih)'" if self.max_height else None
+
+    def video_args(self, in_graph: bool = False) -> List[str]:
+        args = ["-c:v", "libx264", "-preset", self.preset]
+        if self.video_bitrate is None:
+            args += ["-crf", str(self.crf)]
+        else:
+            rate = str(self.video_bitrate)
+            args += ["-b:v", rate, "-maxrate", rate, "-bufsize", str(self.video_bitrate * 2)]
+        if self.max_height and not in_graph:
+            # בגרף מסננים (in_graph) ההקטנה היא חלק מהגרף
+            args += ["-vf", self.video_filter()]
+        return args
+
+    def audio_args(self) -> List[str]:
+        return ["-c:a", "aac", "-b:a", f"{self.audio_bitrate // 1000}k"]
+
+    def pass_args(self, number: int) -> List[str]:
+        if not self.two_pass:
+            return []
+        return ["-pass", str(number), "-passlogfile", self.passlog]
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data.pop("passlog")
+        data["rate_control"] = self.rate_control
+        return data
+
+class ProfileEngine:
+    # בוחר הגדרות המרה לכל עבודה לפי הקלט (משך, רזולוציה, גודל) והעומס הנוכחי
+    # (תור ההמרות ועומס המעבד). ההחלטה נשמרת עם העבודה ונספרת במדדים
+    def signals(self) -> Dict[str, float]:
+        stage = scheduler.stages["transcode"]
+        try:
+            load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        except OSError:
+            load = 0.0
+        return {
+            "queue_pressure": round(len(stage.waiters) / stage.limit, 2),
+            "cpu_load": round(load, 2),
+        }
+
+    def choose(self, info: Optional[MediaInfo], file_size: Optional[int], streaming: bool = False) -> EncodeProfile:
+        signals = self.signals()
+        reasons = []
+        index = 0
+        if signals["queue_pressure"] >= 2 or signals["cpu_load"] >= 1.5:
+            index = 2
+            reasons.append("overloaded")
+        elif signals["queue_pressure"] >= 1 or signals["cpu_load"] >= 1.0:
+            index = 1
+            reasons.append("busy")
+        duration = info.duration if info else 0
+        if duration and duration >= PROFILE_LONG_INPUT and index < len(LEVELS) - 1:
+            # קלט ארוך תופס משבצת המרה לאורך זמן - מוותרים על מעט איכות לטובת התור
+            index += 1
+            reasons.append("long input")
+        profile = EncodeProfile(**LEVELS[index], signals=signals, reasons=reasons)
+
+        # קלט שקרוב למגבלת ההעלאה: קצב יעד לפי המשך, כך שהתוצר בטוח ייכנס
+        if duration and file_size and file_size > UPLOAD_SIZE_LIMIT * 0.9:
+            total = int(UPLOAD_SIZE_LIMIT * 8 * SIZE_MARGIN / duration)
+            profile.video_bitrate = max(200_000, total - profile.audio_bitrate)
+            profile.crf = None
+            profile.two_pass = not streaming  # בהזרמה אין אפשרות לקרוא את הקלט פעמיים
+            for bitrate, height in BITRATE_HEIGHT_CAPS:
+                if profile.video_bitrate < bitrate:
+                    profile.max_height = min(profile.max_height or height, height)
+                    break
+            reasons.append("upload size limit")
+        return profile
+
+    def record(self, profile: EncodeProfile, media_seconds: Optional[float] = None, wall_seconds: Optional[float] = None):
+        encode_decisions.inc(1, profile.level, profile.preset, profile.rate_control)
+        if media_seconds and wall_seconds:
+            encode_speed.observe(media_seconds / wall_seconds, profile.level)
+
+    @staticmethod
+    def must_encode(file_size: Optional[int]) -> bool:
+        # העתקת זרמים לא מקטינה את הקובץ - מעל המגבלה חייבים המרה
+        return bool(file_size and file_size > UPLOAD_SIZE_LIMIT)
+
+profile_engine = ProfileEngine()
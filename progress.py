@@ -0,0 +1,247 @@
+# progress.py
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+from pyrogram.enums import ParseMode
+from pyrogram.errors import FloodWait, MessageNotModified
+from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
+
+from config import PROGRESS_GLOBAL_RATE, PROGRESS_CHAT_RATE
+from utils import humanbytes, progress_bar
+from metrics import flood_waits
+
+logger = logging.getLogger(__name__)
+
+MIN_UPDATE_INTERVAL = 5  # שניות בין עריכות של אותה הודעה
+MIN_PERCENT_CHANGE = 10  # קפיצה באחוזים שמצדיקה עדכון מוקדם יותר
+MIN_EDIT_GAP = 1.5  # גם בקפיצה גדולה - לא יותר מעריכה אחת בפרק זמן זה
+TICK = 0.5
+SPEED_WINDOW = 10  # שניות של היסטוריה לחישוב מהירות
+
+ACTION_LABELS = {
+    "download": "⬇️ מוריד",
+    "upload": "⬆️ מעלה",
+    "stream": "🔄 מוריד, ממיר ומעלה",
+    "encode": "🔄 ממיר",
+    "batch": "📦 מעבד",
+}
+
+CANCEL_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("❌ בטל", callback_data="cancel")]])
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def ready(self, now: float) -> bool:
+        # יש אסימון - בלי לקחת אותו
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens >= 1
+
+    def take(self, now: float) -> bool:
+        if self.ready(now):
+            self.tokens -= 1
+            return True
+        return False
+
+class Throughput:
+    # ממוצע נע על החלון האחרון, במקום ממוצע מאז תחילת העבודה
+    def __init__(self, window: float = SPEED_WINDOW):
+        self.window = window
+        self.samples = deque()
+
+    def add(self, now: float, value: float):
+        self.samples.append((now, value))
+        while len(self.samples) > 2 and now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+
+    def rate(self) -> float:
+        if len(self.samples) < 2:
+            return 0.0
+        (t0, v0), (t1, v1) = self.samples[0], self.samples[-1]
+        return (v1 - v0) / (t1 - t0) if t1 > t0 else 0.0
+
+class _State:
+    __slots__ = ("message", "action", "current", "total", "throughput",
+                 "dirty", "rendered_at", "rendered_percent", "editing", "text", "edit_task")
+
+    def __init__(self, message: Message, action: str):
+        self.message = message
+        self.action = action
+        self.current = 0
+        self.total = 0
+        self.throughput = Throughput()
+        self.dirty = False
+        self.rendered_at = 0.0
+        self.rendered_percent = -100.0
+        self.editing = False
+        self.text = None
+        self.edit_task: Optional[asyncio.Future] = None
+
+    @property
+    def percent(self) -> float:
+        return self.current * 100 / self.total if self.total else 0.0
+
+class ProgressRenderer:
+    # כל העבודות מדווחות לכאן מספרים גולמיים; לולאה אחת מחליטה מתי ומה לערוך,
+    # במסגרת תקציב עריכות גלובלי ולכל צ'אט, ומכבדת FloodWait בלי לעצור את ההעברות
+    def __init__(self, global_rate: float = PROGRESS_GLOBAL_RATE, chat_rate: float = PROGRESS_CHAT_RATE):
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.chat_rate = chat_rate
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._flood_until: Dict[int, float] = {}
+        self._states: Dict[Tuple[int, int], _State] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.edits = 0
+        self.flood_waits = 0
+
+    def report(self, message: Message, current: float, total: float, action: str):
+        # נקרא מתוך קולבקים של העברה - לא ממתין לשום דבר
+        key = (message.chat.id, message.id)
+        state = self._states.get(key)
+        if state is None or state.action != action:
+            # שלב חדש (למשל העלאה אחרי הורדה) מתחיל מדידת מהירות מחדש
+            state = self._states[key] = _State(message, action)
+        now = time.monotonic()
+        state.current = current
+        state.total = total
+        state.throughput.add(now, current)
+        state.dirty = True
+        self._ensure_running()
+
+    def status(self, message: Message, text: str):
+        # הודעת מצב חופשית (למשל מיקום בתור) - עוברת באותו תקציב עריכות
+        key = (message.chat.id, message.id)
+        state = self._states.get(key)
+        if state is None or state.action != "status":
+            state = self._states[key] = _State(message, "status")
+        if state.text != text:
+            state.text = text
+            state.dirty = True
+            self._ensure_running()
+
+    def finish(self, message: Message):
+        self.finish_id(message.chat.id, message.id)
+
+    def finish_id(self, chat_id: int, message_id: int):
+        # אחרי finish ההודעה שייכת לקורא (טקסט סיום, שגיאה, ביטול) - עריכת התקדמות שעוד ממתינה
+        # לא תדרוס אותה
+        state = self._states.pop((chat_id, message_id), None)
+        if state is not None and state.edit_task is not None and not state.edit_task.done():
+            state.edit_task.cancel()
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._loop())
+
+    async def _loop(self):
+        while self._states:
+            await asyncio.sleep(TICK)
+            now = time.monotonic()
+            # ההודעות שחיכו הכי הרבה זמן מקבלות עדיפות על התקציב
+            for key, state in sorted(self._states.items(), key=lambda item: item[1].rendered_at):
+                if not self._due(state, now):
+                    continue
+                chat_id = key[0]
+                if self._flood_until.get(chat_id, 0) > now:
+                    continue
+                # התקציב הגלובלי נבדק לפני שלוקחים מהצ'אט - כדי שסירוב גלובלי לא יבזבז את האסימון שלו
+                if not self.global_bucket.ready(now):
+                    break
+                bucket = self._chat_buckets.get(chat_id)
+                if bucket is None:
+                    bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+                if not bucket.take(now):
+                    continue
+                self.global_bucket.take(now)
+                state.dirty = False
+                state.editing = True
+                state.rendered_at = now
+                state.rendered_percent = state.percent
+                state.edit_task = asyncio.ensure_future(self._edit(key, state, self.render(state)))
+            self._gc(now)
+
+    @staticmethod
+    def _due(state: _State, now: float) -> bool:
+        if not state.dirty or state.editing:
+            return False
+        if state.action == "status":
+            return now - state.rendered_at >= MIN_EDIT_GAP
+        elapsed = now - state.rendered_at
+        if elapsed >= MIN_UPDATE_INTERVAL:
+            return True
+        return elapsed >= MIN_EDIT_GAP and state.percent - state.rendered_percent >= MIN_PERCENT_CHANGE
+
+    async def _edit(self, key: Tuple[int, int], state: _State, text: str):
+        chat_id = state.message.chat.id
+        try:
+            if self._states.get(key) is not state:
+                return  # ההודעה הסתיימה (finish) או התחיל בה שלב חדש מאז שהעריכה נקבעה
+            await state.message.edit_text(text, reply_markup=CANCEL_MARKUP, parse_mode=ParseMode.MARKDOWN)
+            self.edits += 1
+        except FloodWait as e:
+            self.flood_waits += 1
+            flood_waits.inc(1, "progress")
+            self._flood_until[chat_id] = time.monotonic() + e.value
+            state.dirty = True
+            logger.warning(f"FloodWait של {e.value} שניות בעדכון התקדמות בצ'אט {chat_id}")
+        except MessageNotModified:
+            pass
+        except Exception as e:
+            logger.error(f"שגיאה בעדכון התקדמות: {e}")
+        finally:
+            state.editing = False
+
+    def _gc(self, now: float):
+        active = {key[0] for key in self._states}
+        for chat_id in [c for c, until in self._flood_until.items() if until <= now]:
+            del self._flood_until[chat_id]
+        for chat_id in [c for c in self._chat_buckets if c not in active]:
+            del self._chat_buckets[chat_id]
+
+    @staticmethod
+    def render(state: _State) -> str:
+        if state.action == "status":
+            return state.text
+        label = ACTION_LABELS.get(state.action, ACTION_LABELS["upload"])
+        speed = state.throughput.rate()
+        if state.action == "encode":
+            # בהמרה הערכים הם שניות וידאו שעובדו מתוך המשך הכולל
+            if state.total:
+                eta = (state.total - state.current) / speed if speed > 0 else 0
+                body = (
+                    f"{progress_bar(state.current, state.total)}\n"
+                    f"**קצב:** x{speed:.2f}\n"
+                    f"**זמן משוער:** {eta:.1f}s"
+                )
+            else:
+                body = f"**עובד:** {int(state.current)} שניות"
+            return f"**{label} את הקובץ**\n\n{body}"
+
+        if state.action == "batch":
+            # בעבודת אצווה הערכים הם קבצים (כולל חלקי קבצים) מתוך מספר הקבצים
+            eta = (state.total - state.current) / speed if speed > 0 else 0
+            return (
+                f"**{label} {int(state.total)} קבצים**\n\n"
+                f"{progress_bar(state.current, state.total)}\n"
+                f"**הושלמו:** {state.current:.1f}/{int(state.total)}\n"
+                f"**זמן משוער:** {eta:.1f}s"
+            )
+
+        eta = (state.total - state.current) / speed if speed > 0 else 0
+        speed_str = f"{humanbytes(speed)}/s" if speed > 0 else "0 B/s"
+        return (
+            f"**{label} את הקובץ**\n\n"
+            f"**גודל קובץ:** `{humanbytes(state.total)}`\n"
+            f"{progress_bar(state.current, state.total)}\n"
+            f"**מהירות:** {speed_str}\n"
+            f"**זמן משוער:** {eta:.1f}s"
+        )
+
+renderer = ProgressRenderer()
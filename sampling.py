@@ -0,0 +1,121 @@
+# sampling.py
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from types import CodeType
+from typing import Dict, List, Optional, Tuple
+
+from config import SAMPLING_INTERVAL, SAMPLING_MAX_DEPTH
+
+class SamplerBusy(Exception):
+    pass
+
+class Profile:
+    # תוצאת דגימה: מחסניות מקובצות (פורמט collapsed של flamegraph.pl / speedscope) ומספר הדגימות
+    def __init__(self, stacks: Counter, samples: int, seconds: float, overhead: float):
+        self.stacks = stacks
+        self.samples = samples
+        self.seconds = seconds
+        self.overhead = overhead
+
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def top(self, limit: int = 15) -> List[Tuple[str, int, int]]:
+        # (פונקציה, דגימות בה עצמה, דגימות כולל מה שהיא קראה), לפי הזמן בפונקציה עצמה -
+        # לפי הזמן הכולל מובילות תמיד מסגרות ההפעלה של ה-threads והלולאה
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")[1:]  # בלי שם ה-thread
+            if not frames:
+                continue
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        return [(frame, count, total[frame]) for frame, count in own.most_common(limit)]
+
+    def summary(self, limit: int = 15) -> str:
+        # אחוזים מתוך כל הדגימות של כל ה-threads
+        taken = sum(self.stacks.values()) or 1
+        lines = [
+            f"🔬 {self.samples} דגימות ב-{self.seconds:.1f} שניות, עלות הדגימה: {self.overhead:.1%} ממעבד אחד",
+            "עצמי / כולל - פונקציה:",
+        ]
+        for frame, own, total in self.top(limit):
+            lines.append(f"{own / taken:.1%} / {total / taken:.1%} - {frame}")
+        return "\n".join(lines)
+
+class Sampler:
+    # דוגם את כל ה-threads של התהליך (לולאת האירועים, ה-threads של pyrogram, שרת הבריאות...)
+    # בקצב קבוע דרך sys._current_frames, מתוך thread נפרד ובלי להתערב בקוד שרץ. בלולאת האירועים
+    # המחסנית מקבלת גם את ה-coroutine של ה-task שרץ באותו רגע, כך שזמן מתחלק לפי עבודות ו-handlers
+    def __init__(self, interval: float = SAMPLING_INTERVAL, max_depth: int = SAMPLING_MAX_DEPTH):
+        self.interval = interval
+        self.max_depth = max_depth
+        self._lock = threading.Lock()
+        self._labels: Dict[CodeType, str] = {}
+
+    def _label(self, code: CodeType) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self._labels[code] = label
+        return label
+
+    @staticmethod
+    def _running_tasks() -> Dict[int, str]:
+        # thread -> ה-coroutine של ה-task שרץ בו כרגע. _current_tasks משותף לכל הלולאות;
+        # קריאה מ-thread אחר עלולה להיתקל בשינוי באמצע - מדלגים על הדגימה הזו
+        try:
+            current = dict(getattr(asyncio.tasks, "_current_tasks", {}))
+        except RuntimeError:
+            return {}
+        tasks = {}
+        for loop, task in current.items():
+            thread_id = getattr(loop, "_thread_id", None)
+            coro = task.get_coro() if thread_id is not None else None
+            if coro is not None:
+                tasks[thread_id] = f"task:{getattr(coro, '__qualname__', type(coro).__name__)}"
+        return tasks
+
+    def _collapse(self, thread: str, task: Optional[str], frame) -> str:
+        frames = []
+        while frame is not None and len(frames) < self.max_depth:
+            frames.append(self._label(frame.f_code))
+            frame = frame.f_back
+        if task:
+            frames.append(task)
+        frames.append(thread)
+        frames.reverse()
+        return ";".join(frames)
+
+    def run(self, seconds: float) -> Profile:
+        # חוסם את ה-thread הקורא למשך החלון - להפעיל מ-executor או מ-thread של שרת הבריאות
+        if not self._lock.acquire(blocking=False):
+            raise SamplerBusy()
+        try:
+            me = threading.get_ident()
+            stacks = Counter()
+            samples = 0
+            started = time.monotonic()
+            cpu_started = time.thread_time()
+            deadline = started + seconds
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                tasks = self._running_tasks()
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stacks[self._collapse(names.get(ident, str(ident)), tasks.get(ident), frame)] += 1
+                samples += 1
+                time.sleep(self.interval)
+            elapsed = time.monotonic() - started
+            return Profile(stacks, samples, elapsed, (time.thread_time() - cpu_started) / elapsed)
+        finally:
+            self._lock.release()
+
+sampler = Sampler()
@@ -0,0 +1,168 @@
+# scheduler.py
+import asyncio
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from config import (
+    DOWNLOAD_SLOTS, TRANSCODE_WORKERS, UPLOAD_SLOTS,
+    MAX_QUEUED_JOBS, PREMIUM_WEIGHT, QUEUE_NOTIFY_INTERVAL
+)
+from metrics import stage_latency, stage_wait
+from storage import storage
+from tracing import trace_span
+
+STAGES = ("download", "transcode", "upload")
+PREMIUM_LANE = 0
+FREE_LANE = 1
+
+# on_wait(position, eta_seconds)
+WaitCallback = Callable[[int, float], Awaitable[None]]
+
+class QueueFull(Exception):
+    pass
+
+class Ticket:
+    __slots__ = ("user_id", "premium", "weight", "seq", "created_at")
+
+    _seq = itertools.count()
+
+    def __init__(self, user_id: int, premium: bool):
+        self.user_id = user_id
+        self.premium = premium
+        self.weight = PREMIUM_WEIGHT if premium else 1
+        self.seq = next(self._seq)
+        self.created_at = time.time()
+
+    @property
+    def lane(self) -> int:
+        return PREMIUM_LANE if self.premium else FREE_LANE
+
+class _Waiter:
+    __slots__ = ("ticket", "tag", "future")
+
+    def __init__(self, ticket: Ticket, tag: float, future: asyncio.Future):
+        self.ticket = ticket
+        self.tag = tag
+        self.future = future
+
+    def sort_key(self) -> Tuple:
+        return (self.ticket.lane, self.tag, self.ticket.seq)
+
+class StageLimiter:
+    # מגביל מקביליות של שלב אחד. כשמשבצת מתפנה היא עוברת לממתין הבא לפי:
+    # 1) נתיב פרימיום לפני חינמי  2) תור הוגן משוקלל בין משתמשים (WFQ)
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = max(1, limit)
+        self.active = 0
+        self.waiters: List[_Waiter] = []
+        self._vtime = 0.0
+        self._user_tags: Dict[int, float] = {}
+        self.avg_service = 30.0  # שניות, ממוצע נע של זמן שלב
+        self.served = 0
+
+    def _tag(self, ticket: Ticket) -> float:
+        # virtual finish time: משתמש עם הרבה עבודות בתור נדחף אחורה ביחס לאחרים
+        start = max(self._vtime, self._user_tags.get(ticket.user_id, 0.0))
+        tag = start + 1.0 / ticket.weight
+        self._user_tags[ticket.user_id] = tag
+        return tag
+
+    async def acquire(self, ticket: Ticket, on_wait: Optional[WaitCallback] = None):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
+        waiter = _Waiter(ticket, self._tag(ticket), asyncio.get_event_loop().create_future())
+        self.waiters.append(waiter)
+        try:
+            while True:
+                if on_wait is not None:
+                    await on_wait(*self.position(ticket))
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter.future), QUEUE_NOTIFY_INTERVAL)
+                    return
+                except asyncio.TimeoutError:
+                    continue
+        except BaseException:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            elif waiter.future.done() and not waiter.future.cancelled():
+                # המשבצת כבר הוקצתה לנו - מעבירים אותה הלאה
+                self.release()
+            raise
+
+    def release(self, service_time: Optional[float] = None):
+        if service_time is not None:
+            self.served += 1
+            self.avg_service = 0.8 * self.avg_service + 0.2 * service_time
+        self.active -= 1
+        while self.waiters and self.active < self.limit:
+            waiter = min(self.waiters, key=_Waiter.sort_key)
+            self.waiters.remove(waiter)
+            if waiter.future.done():
+                continue
+            self._vtime = max(self._vtime, waiter.tag)
+            self.active += 1
+            waiter.future.set_result(None)
+        if not self.waiters and not self.active:
+            self._user_tags.clear()
+
+    def position(self, ticket: Ticket) -> Tuple[int, float]:
+        ordered = sorted(self.waiters, key=_Waiter.sort_key)
+        for index, waiter in enumerate(ordered):
+            if waiter.ticket is ticket:
+                rounds = math.ceil((index + 1) / self.limit)
+                return index + 1, rounds * self.avg_service
+        return 0, 0.0
+
+class JobScheduler:
+    def __init__(self):
+        self.stages = {
+            "download": StageLimiter("download", DOWNLOAD_SLOTS),
+            "transcode": StageLimiter("transcode", TRANSCODE_WORKERS),
+            "upload": StageLimiter("upload", UPLOAD_SLOTS),
+        }
+        self.max_queued = MAX_QUEUED_JOBS
+        self.shed = 0
+
+    @property
+    def queued(self) -> int:
+        return sum(len(stage.waiters) for stage in self.stages.values())
+
+    def admit(self, user_id: int, premium: bool, size: int = 0) -> Ticket:
+        # כשהתורים מלאים דוחים עבודות חדשות במקום להעמיס עוד; לפרימיום יש מרווח כפול.
+        # עבודה שלא תוכל לשמור מקום בדיסק (size - לפי job_size) נדחית כאן עם StorageFull,
+        # ולא אחרי שכבר חיכתה בתור
+        limit = self.max_queued * 2 if premium else self.max_queued
+        if self.queued >= limit:
+            self.shed += 1
+            raise QueueFull()
+        storage.check(size)
+        return Ticket(user_id, premium)
+
+    @asynccontextmanager
+    async def stage(self, name: str, ticket: Ticket, on_wait: Optional[WaitCallback] = None):
+        limiter = self.stages[name]
+        queued_at = time.monotonic()
+        await limiter.acquire(ticket, on_wait)
+        started = time.monotonic()
+        waited = started - queued_at
+        stage_wait.observe(waited, name)
+        try:
+            yield
+        finally:
+            service_time = time.monotonic() - started
+            stage_latency.observe(service_time, name)
+            limiter.release(service_time)
+            trace_span(name, service_time, wait=waited)
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        return {
+            name: {"active": stage.active, "queued": len(stage.waiters), "limit": stage.limit}
+            for name, stage in self.stages.items()
+        }
+
+scheduler = JobScheduler()
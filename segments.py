@@ -0,0 +1,107 @@
+# segments.py
+import asyncio
+import glob
+import logging
+import os
+from typing import Dict, List, Optional
+
+from config import SEGMENT_MIN_DURATION, SEGMENT_WORKERS, SEGMENT_MIN_LENGTH
+from probe import MediaInfo
+from storage import Reservation
+from transcode import TranscodePool, ConversionPlan, EncodeProgress, audio_output_args
+
+logger = logging.getLogger(__name__)
+
+# בריכה נפרדת: כל קטע הוא תהליך ffmpeg עם thread אחד, כך שהקטעים יחד מנצלים את כל הליבות
+segment_pool = TranscodePool(workers=SEGMENT_WORKERS or os.cpu_count() or 1, threads=1)
+
+def should_segment(plan: ConversionPlan, info: Optional[MediaInfo]) -> bool:
+    # רק המרה מלאה של קלט ארוך, כשהמכונה לא עמוסה (אחרת הקטעים רק מתחרים בעבודות אחרות).
+    # קידוד דו-מעברי מכוון לגודל של כל הקובץ ונשאר בתהליך אחד
+    if not SEGMENT_MIN_DURATION or segment_pool.workers < 2 or plan.mode != "encode":
+        return False
+    if info is None or not info.duration or info.duration < SEGMENT_MIN_DURATION:
+        return False
+    profile = plan.profile
+    if profile is None or profile.two_pass:
+        return False
+    return profile.signals.get("queue_pressure", 0) < 1 and profile.signals.get("cpu_load", 0) < 1.0
+
+def segment_length(duration: float, workers: int) -> float:
+    # פי שניים קטעים מתהליכים: הפיצול בפריימי מפתח יוצר קטעים לא שווים, וכך אף תהליך לא מחכה לאחרון
+    return max(SEGMENT_MIN_LENGTH, duration / (workers * 2))
+
+async def encode_segmented(source: str, output_path: str, plan: ConversionPlan, info: MediaInfo,
+                           reservation: Reservation, progress: Optional[EncodeProgress] = None,
+                           audio_path: Optional[str] = None):
+    # 1. פיצול הווידאו בלי המרה (-c copy) לקטעים שמתחילים בפריימי מפתח, כל אחד מזמן 0
+    # 2. המרת הקטעים במקביל (וידאו בלבד), ובמקביל להם רצועת האודיו כולה - ברצף אחד, בלי תפרים
+    # 3. חיבור הקטעים ב-concat demuxer (משכי הקטעים קובעים את הזמנים) יחד עם האודיו, בלי המרה
+    duration = info.duration
+    # עבודה שהתחדשה אחרי נפילה ממשיכה באותה תיקייה - קטעים מהניסיון הקודם (אולי באורך אחר) נמחקים,
+    # ורשימת הקטעים נלקחת ממה ש-ffmpeg כתב בהרצה הזו בלבד
+    for path in glob.glob(os.path.join(reservation.directory, "segment_*.mkv")) + \
+            glob.glob(os.path.join(reservation.directory, "encoded_*.mp4")):
+        os.remove(path)
+    pattern = os.path.join(reservation.directory, "segment_%04d.mkv")
+    segment_list = reservation.path("segments.list")
+    await segment_pool.run(
+        ["-i", source],
+        ["-map", "0:v:0", "-c", "copy", "-f", "segment",
+         "-segment_time", f"{segment_length(duration, segment_pool.workers):.3f}",
+         "-segment_list", segment_list, "-segment_list_type", "flat",
+         "-reset_timestamps", "1", pattern]
+    )
+    with open(segment_list) as f:
+        parts = [reservation.path(name.strip()) for name in f if name.strip()]
+    logger.info(f"המרה בקטעים של {source}: {len(parts)} קטעים, {segment_pool.workers} תהליכים")
+
+    processed: Dict[int, float] = {}
+
+    def segment_progress(index: int):
+        async def on_progress(seconds: float, _):
+            processed[index] = seconds
+            if progress is not None:
+                await progress(min(duration, sum(processed.values())), duration)
+
+        return on_progress
+
+    async def encode_part(index: int, part: str) -> str:
+        encoded = reservation.path(f"encoded_{index:04d}.mp4")
+        await segment_pool.run(
+            ["-i", part],
+            ["-map", "0:v:0", *plan.profile.video_args(), "-an", encoded],
+            progress=segment_progress(index)
+        )
+        os.remove(part)  # המקור של הקטע כבר לא נחוץ - המקום בדיסק חוזר תוך כדי
+        return encoded
+
+    track = None
+    if info.audio_codec:
+        track = audio_path or reservation.path("track.m4a")
+    tasks = [asyncio.ensure_future(encode_part(index, part)) for index, part in enumerate(parts)]
+    if track:
+        tasks.append(asyncio.ensure_future(
+            segment_pool.run(["-i", source], audio_output_args(info, track, plan.profile))
+        ))
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    encoded = results[:len(parts)]
+
+    concat_list = reservation.path("segments.txt")
+    with open(concat_list, "w") as f:
+        for path in encoded:
+            f.write(f"file '{path}'\n")
+    inputs = ["-f", "concat", "-safe", "0", "-i", concat_list]
+    maps = ["-map", "0:v:0"]
+    if track:
+        inputs += ["-i", track]
+        maps += ["-map", "1:a:0"]
+    await segment_pool.run(inputs, [*maps, "-c", "copy", "-movflags", "+faststart", output_path])
+    for path in encoded:
+        os.remove(path)
@@ -0,0 +1,78 @@
+# sessions.py
+import time
+from collections import OrderedDict
+from typing import Union
+
+from config import SESSION_TTL, MAX_SESSIONS
+
+class Session:
+    # מצב שיחה קצר-מועד של משתמש (בין שליחת הקובץ לסיום ההעלאה)
+    __slots__ = ("user_id", "waiting_for_name", "original_msg_id", "active_task", "new_name",
+                 "batch", "batch_group", "batch_at", "file_size", "touched_at")
+
+    FIELDS = ("waiting_for_name", "original_msg_id", "active_task", "new_name", "batch", "batch_group", "batch_at",
+              "file_size")
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.waiting_for_name = False
+        self.original_msg_id = None
+        self.active_task = None
+        self.new_name = None
+        self.batch = None  # הודעות הקבצים שנאספו עד שנבחר פורמט (אלבום או קבצים ברצף)
+        self.batch_group = None  # media_group_id של האלבום
+        self.batch_at = 0.0  # מתי הגיע הקובץ האחרון באצווה (monotonic)
+        self.file_size = None  # הקובץ הגדול באצווה - לבדיקת המקום בדיסק בכניסה לתור
+        self.touched_at = time.monotonic()
+
+class SessionStore:
+    def __init__(self, ttl: float = SESSION_TTL, max_sessions: int = MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        # לפי סדר נגיעה אחרונה - הישנה ביותר בראש, כך שהסרת פגי תוקף היא מהראש בלבד
+        self._sessions = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _expire(self, now: float):
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.touched_at < self.ttl:
+                break
+            self._sessions.popitem(last=False)
+
+    def get(self, user_id: int) -> Union[Session, None]:
+        now = time.monotonic()
+        self._expire(now)
+        return self._sessions.get(user_id)
+
+    def field(self, user_id: int, name: str, default=None):
+        session = self.get(user_id)
+        if session is None:
+            return default
+        value = getattr(session, name)
+        return default if value is None else value
+
+    def update(self, user_id: int, **fields) -> Session:
+        # כל השדות נבדקים לפני שמשהו נכתב - או שכולם מתעדכנים או אף אחד
+        unknown = set(fields) - set(Session.FIELDS)
+        if unknown:
+            raise KeyError(f"Unknown session fields: {', '.join(sorted(unknown))}")
+        now = time.monotonic()
+        self._expire(now)
+        session = self._sessions.get(user_id)
+        if session is None:
+            session = self._sessions[user_id] = Session(user_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        for name, value in fields.items():
+            setattr(session, name, value)
+        session.touched_at = now
+        self._sessions.move_to_end(user_id)
+        return session
+
+    def end(self, user_id: int):
+        self._sessions.pop(user_id, None)
+
+sessions = SessionStore()
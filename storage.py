@@ -0,0 +1,205 @@
+# storage.py
+import asyncio
+import glob
+import itertools
+import logging
+import os
+import shutil
+from typing import Callable, Dict, Optional, Set
+
+from config import SCRATCH_DIR, SCRATCH_QUOTA, SCRATCH_MIN_FREE, SCRATCH_SWEEP_INTERVAL
+from metrics import registry, Gauge
+
+logger = logging.getLogger(__name__)
+
+class StorageFull(Exception):
+    pass
+
+class Reservation:
+    # המקום ששמור לעבודה אחת והקבצים שנוצרו עבורה (בתיקייה משלה). משמש כ-context manager:
+    # ביציאה הקבצים נמחקים והמקום משתחרר, גם אם העבודה נכשלה. עבודה שנקטעה (ביטול המשימה
+    # בכיבוי) משאירה את הקבצים כדי שתוכל להמשיך מהם
+    __slots__ = ("storage", "key", "size", "files", "released", "resumable")
+
+    def __init__(self, storage: "ScratchStorage", key: str, size: int, resumable: bool):
+        self.storage = storage
+        self.key = key
+        self.size = size
+        self.files: Dict[str, int] = {}  # path -> bytes (0 עד שהקובץ נכתב)
+        self.released = False
+        self.resumable = resumable
+        os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def directory(self) -> str:
+        return os.path.join(self.storage.directory, self.key)
+
+    def path(self, name: str) -> str:
+        path = os.path.join(self.directory, os.path.basename(name))
+        self.files.setdefault(path, 0)
+        return path
+
+    def track(self, path: str):
+        # נקרא כשקובץ הושלם: stat אחד לקובץ במקום סריקת התיקייה
+        if path not in self.files or not os.path.exists(path):
+            return
+        size = os.path.getsize(path)
+        self.storage.used += size - self.files[path]
+        self.files[path] = size
+
+    def grow(self, size: int):
+        # תוכנית ההמרה נקבעת רק אחרי ההורדה - תוספת למקום השמור, או StorageFull אם אין
+        size = max(0, int(size or 0))
+        self.storage.check(size)
+        self.storage.reserved += size
+        self.size += size
+
+    def release(self, keep_files: bool = False):
+        self.storage.release(self, keep_files)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        interrupted = exc_type is not None and issubclass(exc_type, asyncio.CancelledError)
+        self.release(keep_files=self.resumable and interrupted)
+
+class ScratchStorage:
+    # כל קבצי העבודות (הורדות ותוצרי המרה) תחת תיקייה אחת, עם מכסה, הזמנת מקום מראש
+    # וספירת בייטים מצטברת. לכל עבודה תת-תיקייה לפי המפתח שלה (job_<id> לעבודה מתמשכת)
+    def __init__(self, root: str = SCRATCH_DIR, quota: int = SCRATCH_QUOTA):
+        self.directory = os.path.abspath(root)
+        self.quota = quota  # 0 = ללא מכסה (רק המקום הפנוי בדיסק)
+        self.used = 0
+        self.reserved = 0
+        self.rejected = 0
+        self._ids = itertools.count(1)
+        self._active: Dict[str, Reservation] = {}
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _shortage(self, size: int) -> Optional[str]:
+        if self.quota and self.reserved + size > self.quota:
+            return f"quota: {self.reserved} + {size} > {self.quota}"
+        # המקום שכבר שמור אבל עוד לא נכתב עדיין פנוי בדיסק - מורידים אותו מהחשבון
+        pending = max(0, self.reserved - self.used)
+        if shutil.disk_usage(self.directory).free - pending - size < SCRATCH_MIN_FREE:
+            return f"disk: no room for {size} bytes"
+        return None
+
+    def fits(self, size: int) -> bool:
+        return self._shortage(max(0, int(size or 0))) is None
+
+    def check(self, size: int):
+        # StorageFull אם אין עכשיו מקום להזמנה בגודל הזה - גם לבקרת הכניסה, לפני שהעבודה מתחילה
+        reason = self._shortage(max(0, int(size or 0)))
+        if reason:
+            self.rejected += 1
+            raise StorageFull(reason)
+
+    def reserve(self, size: int, key: Optional[str] = None) -> Reservation:
+        size = max(0, int(size or 0))
+        self.check(size)
+        # בלי מפתח - עבודה שלא נשמרת לחידוש; התיקייה שלה תימחק בניקוי אם התהליך נפל
+        resumable = key is not None
+        if key is None:
+            key = f"tmp_{os.getpid()}_{next(self._ids)}"
+        reservation = Reservation(self, key, size, resumable)
+        self._active[key] = reservation
+        self.reserved += size
+        return reservation
+
+    def release(self, reservation: Reservation, keep_files: bool = False):
+        if reservation.released:
+            return
+        reservation.released = True
+        if not keep_files:
+            shutil.rmtree(reservation.directory, ignore_errors=True)
+        self.used -= sum(reservation.files.values())
+        self.reserved -= reservation.size
+        self._active.pop(reservation.key, None)
+
+    def usage(self) -> Dict[str, int]:
+        return {"used": self.used, "reserved": self.reserved, "quota": self.quota, "jobs": len(self._active)}
+
+    def sweep(self, keep: Set[str] = frozenset(), legacy: bool = False) -> int:
+        # מוחק כל מה שלא שייך לעבודה פעילה בתהליך הזה או לעבודה שעדיין יכולה להתחדש (keep):
+        # עבודות שנפלו, שהסתיימו בתהליך אחר, וקבצים מגרסאות קודמות
+        removed = 0
+        for entry in os.scandir(self.directory):
+            if entry.name in self._active or entry.name in keep:
+                continue
+            if entry.is_dir() and not entry.name.startswith(("job_", "tmp_")) and not legacy:
+                continue
+            if entry.name.startswith("tmp_") and self._owner_alive(entry.name):
+                continue
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                self._remove(entry.path)
+            removed += 1
+        if legacy:
+            # תוצרי המרה מגרסאות קודמות נשמרו בתיקיית העבודה
+            for path in glob.glob("converted_*.mp4"):
+                removed += self._remove(path)
+        if removed:
+            logger.info(f"נמחקו {removed} קבצים/תיקיות יתומים מ-{self.directory}")
+        return removed
+
+    @staticmethod
+    def _owner_alive(name: str) -> bool:
+        # tmp_<pid>_<n>: עבודה בלי מפתח של תהליך שעדיין רץ (worker אחר)
+        try:
+            os.kill(int(name.split("_")[1]), 0)
+        except (ValueError, IndexError, ProcessLookupError):
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    @staticmethod
+    def _remove(path: str) -> int:
+        try:
+            os.remove(path)
+            return 1
+        except OSError as e:
+            logger.error(f"שגיאה במחיקת קובץ יתום {path}: {e}")
+            return 0
+
+    async def sweeper(self, keep: Callable[[], Set[str]] = frozenset, legacy: bool = False):
+        # ניקוי מלא בהפעלה, ואחר כך מדי פעם
+        self.sweep(keep(), legacy=legacy)
+        while True:
+            await asyncio.sleep(SCRATCH_SWEEP_INTERVAL)
+            try:
+                self.sweep(keep())
+            except Exception as e:
+                logger.error(f"שגיאה בניקוי קבצים יתומים: {e}")
+
+PASSLOG_SIZE = 64 * 1024 * 1024  # קובצי הסטטיסטיקה של קידוד דו-מעברי (log ו-mbtree)
+
+def job_size(file_size: Optional[int], upload_type: str, with_audio: bool = False) -> int:
+    # הקלט ועוד התוצרים. אודיו: audio.m4a, לכל היותר בגודל הקלט; וידאו: תוצר ההמרה (בערך
+    # באותו גודל) ורצועת האודיו אם ביקשו גם אותה; מסמך: הקלט בלבד
+    size = file_size or 0
+    if upload_type == "audio":
+        return size * 2
+    if upload_type == "video":
+        return size * (3 if with_audio else 2)
+    return size
+
+def plan_size(file_size: Optional[int], segmented: bool = False, two_pass: bool = False) -> int:
+    # התוספת ל-job_size לפי תוכנית ההמרה. בקטעים נמצאים בדיסק יחד הקלט, הקטעים (מקור ומומרים)
+    # והתוצר המחובר - בערך פי 3 מהקלט; בדו-מעברי - קובצי הסטטיסטיקה
+    extra = 0
+    if segmented:
+        extra += file_size or 0
+    if two_pass:
+        extra += PASSLOG_SIZE
+    return extra
+
+storage = ScratchStorage()
+
+registry.register(Gauge(
+    "bot_scratch_bytes", "Scratch storage bytes written and reserved by jobs",
+    lambda: {("used",): storage.used, ("reserved",): storage.reserved}, ("kind",)
+))
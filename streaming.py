@@ -0,0 +1,256 @@
+# streaming.py
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, Optional, Union
+
+from pyrogram import Client, raw, types, utils
+from pyrogram.enums import ParseMode
+from pyrogram.errors import FloodWait
+
+from config import STREAM_BUFFER_PARTS
+from probe import ProbeError, probe_head, find_moov_in_head
+from transcode import TranscodeError, transcoder, plan_conversion
+from metrics import flood_waits
+from tracing import trace_count
+from profiles import profile_engine
+
+logger = logging.getLogger(__name__)
+
+PART_SIZE = 512 * 1024  # גודל חלק בהעלאה (מקסימום של טלגרם)
+BIG_FILE_THRESHOLD = 10 * 1024 * 1024  # מעל זה חובה להשתמש ב-SaveBigFilePart
+PART_RETRIES = 3
+MEDIA_MIME_TYPES = {"video": "video/mp4", "audio": "audio/mp4"}
+
+# on_chunk(bytes_read_so_far)
+ChunkProgress = Callable[[int], Awaitable[None]]
+
+class StreamingUnsupported(Exception):
+    # הקלט דורש גישה אקראית (למשל MP4 שה-moov שלו בסוף) - עוברים למסלול הדיסק
+    pass
+
+class ChunkUploader:
+    # מעלה נתונים לטלגרם בחלקים בזמן שהם נוצרים, בלי לדעת מראש את הגודל הסופי.
+    # עד 10MB החלקים נשמרים בזיכרון (ייתכן שהקובץ קטן), מעבר לזה עוברים להעלאה
+    # בהזרמה עם file_total_parts=-1 עד החלק האחרון.
+    def __init__(self, client: Client, file_name: str, buffer_parts: int = STREAM_BUFFER_PARTS):
+        self.client = client
+        self.file_name = file_name
+        self.file_id = client.rnd_id()
+        self.size = 0
+        self.parts = 0
+        self.is_big = False
+        self._pending = bytearray()
+        self._held: List[bytes] = []
+        self._last: Optional[bytes] = None
+        self._queue = asyncio.Queue(maxsize=buffer_parts)
+        self._sender: Optional[asyncio.Future] = None
+
+    async def write(self, data: bytes):
+        self._pending += data
+        self.size += len(data)
+        while len(self._pending) >= PART_SIZE:
+            part = bytes(self._pending[:PART_SIZE])
+            del self._pending[:PART_SIZE]
+            await self._push(part)
+
+    async def finish(self) -> Union[raw.types.InputFile, raw.types.InputFileBig]:
+        tail = bytes(self._pending)
+        self._pending.clear()
+        if not self.is_big:
+            parts = self._held + ([tail] if tail else [])
+            for index, part in enumerate(parts):
+                await self._invoke(raw.functions.upload.SaveFilePart(
+                    file_id=self.file_id, file_part=index, bytes=part
+                ))
+            self.parts = len(parts)
+            return raw.types.InputFile(id=self.file_id, parts=self.parts, name=self.file_name, md5_checksum="")
+
+        if tail:
+            await self._push_big(tail)
+        total = self.parts + 1
+        await self._enqueue((self.parts, self._last, total))
+        self.parts = total
+        await self._enqueue(None)
+        await self._sender
+        return raw.types.InputFileBig(id=self.file_id, parts=total, name=self.file_name)
+
+    def abort(self):
+        if self._sender is not None and not self._sender.done():
+            self._sender.cancel()
+
+    async def _push(self, part: bytes):
+        if self.is_big:
+            return await self._push_big(part)
+        self._held.append(part)
+        if len(self._held) * PART_SIZE > BIG_FILE_THRESHOLD:
+            self.is_big = True
+            self._sender = asyncio.ensure_future(self._send_loop())
+            held, self._held = self._held, []
+            for held_part in held:
+                await self._push_big(held_part)
+
+    async def _push_big(self, part: bytes):
+        # החלק האחרון מוחזק עד שידוע המספר הכולל של החלקים
+        if self._last is not None:
+            await self._enqueue((self.parts, self._last, -1))
+            self.parts += 1
+        self._last = part
+
+    async def _enqueue(self, item):
+        # put חוסם כשהתור מלא (backpressure) - אבל לא נתקעים לנצח אם השולח נפל
+        put = asyncio.ensure_future(self._queue.put(item))
+        await asyncio.wait({put, self._sender}, return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            self._sender.result()
+            raise RuntimeError("Upload sender stopped")
+
+    async def _send_loop(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            index, part, total = item
+            await self._invoke(raw.functions.upload.SaveBigFilePart(
+                file_id=self.file_id, file_part=index, file_total_parts=total, bytes=part
+            ))
+
+    async def _invoke(self, query):
+        failures = 0
+        while True:
+            try:
+                return await self.client.invoke(query)
+            except FloodWait as e:
+                flood_waits.inc(1, "upload")
+                trace_count("flood_waits")
+                trace_count("flood_wait_seconds", e.value)
+                await asyncio.sleep(e.value)
+            except (OSError, asyncio.TimeoutError) as e:
+                failures += 1
+                trace_count("retries")
+                if failures >= PART_RETRIES:
+                    raise
+                logger.warning(f"ניסיון חוזר להעלאת חלק: {e}")
+
+async def send_uploaded_media(
+    client: Client,
+    chat_id: int,
+    input_file,
+    kind: str,
+    file_name: str,
+    caption: Optional[str] = None,
+    duration: int = 0,
+    width: int = 0,
+    height: int = 0,
+    thumb: Optional[str] = None,
+    reply_to_message_id: Optional[int] = None
+) -> types.Message:
+    # שליחת קובץ שכבר הועלה בחלקים (pyrogram.send_video מקבל רק נתיב או file_id)
+    attributes = [raw.types.DocumentAttributeFilename(file_name=file_name)]
+    if kind == "video":
+        attributes.insert(0, raw.types.DocumentAttributeVideo(
+            duration=duration, w=width, h=height, supports_streaming=True
+        ))
+    elif kind == "audio":
+        attributes.insert(0, raw.types.DocumentAttributeAudio(duration=duration))
+    media = raw.types.InputMediaUploadedDocument(
+        file=input_file,
+        mime_type=MEDIA_MIME_TYPES.get(kind, "application/octet-stream"),
+        attributes=attributes,
+        thumb=await client.save_file(thumb) if thumb else None,
+        force_file=kind == "document" or None
+    )
+    r = await client.invoke(raw.functions.messages.SendMedia(
+        peer=await client.resolve_peer(chat_id),
+        media=media,
+        random_id=client.rnd_id(),
+        reply_to_msg_id=reply_to_message_id,
+        **await utils.parse_text_entities(client, caption or "", ParseMode.MARKDOWN, None)
+    ))
+    for update in r.updates:
+        if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+            return await types.Message._parse(
+                client, update.message,
+                {u.id: u for u in r.users},
+                {c.id: c for c in r.chats}
+            )
+    # ההודעה כבר נשלחה - שגיאה ולא None, כדי שהקורא לא ישלח את הקובץ שוב במסלול החלופי
+    raise RuntimeError(f"SendMedia returned no message for {file_name}")
+
+async def stream_document(client: Client, source: types.Message, file_name: str,
+                          on_chunk: ChunkProgress):
+    # הורדה → העלאה ישירה, בלי לגעת בדיסק
+    uploader = ChunkUploader(client, file_name)
+    read = 0
+    try:
+        async for chunk in client.stream_media(source):
+            read += len(chunk)
+            await uploader.write(chunk)
+            await on_chunk(read)
+        return await uploader.finish()
+    except BaseException:
+        uploader.abort()
+        raise
+
+async def stream_video(client: Client, source: types.Message, file_name: str,
+                       on_chunk: ChunkProgress):
+    # הורדה → ffmpeg (stdin/stdout) → העלאה, שלושת השלבים רצים במקביל
+    chunks = client.stream_media(source)
+    try:
+        head = await chunks.__anext__()
+    except StopAsyncIteration:
+        raise StreamingUnsupported("empty input")
+    if find_moov_in_head(head) is False:
+        await chunks.aclose()
+        raise StreamingUnsupported("moov atom is at the end of the file")
+    try:
+        info = await probe_head(head)
+    except ProbeError as e:
+        await chunks.aclose()
+        raise StreamingUnsupported(f"cannot probe stream head: {e}")
+    plan = plan_conversion(info)
+    if plan.mode == "encode":
+        media = source.video or source.document
+        plan.profile = profile_engine.choose(info, getattr(media, "file_size", None), streaming=True)
+
+    uploader = ChunkUploader(client, file_name)
+    async with transcoder.spawn(["-i", "pipe:0"], plan.stream_output_args()) as (proc, stderr_tail):
+        feeder = asyncio.ensure_future(_feed(proc, head, chunks, on_chunk))
+        try:
+            while True:
+                data = await proc.stdout.read(PART_SIZE)
+                if not data:
+                    break
+                await uploader.write(data)
+            await feeder
+            returncode = await proc.wait()
+        except BaseException:
+            feeder.cancel()
+            uploader.abort()
+            raise
+        if returncode != 0:
+            uploader.abort()
+            raise TranscodeError(returncode, "\n".join(stderr_tail))
+    input_file = await uploader.finish()
+    return input_file, info, plan
+
+async def _feed(proc, head: bytes, chunks, on_chunk: ChunkProgress):
+    read = 0
+    try:
+        proc.stdin.write(head)
+        await proc.stdin.drain()
+        read += len(head)
+        await on_chunk(read)
+        async for chunk in chunks:
+            proc.stdin.write(chunk)
+            # drain ממתין כש-ffmpeg לא מספיק לקרוא - ההורדה מואטת בהתאם
+            await proc.stdin.drain()
+            read += len(chunk)
+            await on_chunk(read)
+    except (BrokenPipeError, ConnectionResetError):
+        # ffmpeg סגר את הקלט (סיים או נכשל) - קוד היציאה שלו יקבע
+        pass
+    finally:
+        await chunks.aclose()
+        if not proc.stdin.is_closing():
+            proc.stdin.close()
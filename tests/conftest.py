@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# המודולים יוצרים מסדי נתונים ותיקיות בזמן הייבוא (singletons) - מפנים אותם לתיקייה זמנית
+_tmp = tempfile.mkdtemp(prefix="bot-tests-")
+os.environ.setdefault("DB_PATH", os.path.join(_tmp, "data.db"))
+os.environ.setdefault("LEGACY_JSON_PATH", os.path.join(_tmp, "data.json"))
+os.environ.setdefault("JOBS_DB_PATH", os.path.join(_tmp, "jobs.db"))
+os.environ.setdefault("SCRATCH_DIR", os.path.join(_tmp, "downloads"))
+os.environ.setdefault("TRACE_DIR", os.path.join(_tmp, "traces"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,47 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("pyrogram")
+
+from broadcast import AdaptiveRate, RATE_RECOVERY
+
+def test_flood_wait_halves_rate():
+    rate = AdaptiveRate(20.0, min_rate=1.0)
+    rate.flood_wait(0)
+    assert rate.rate == 10.0
+    for _ in range(10):
+        rate.flood_wait(0)
+    assert rate.rate == 1.0
+
+def test_success_recovers_up_to_max():
+    rate = AdaptiveRate(20.0, min_rate=1.0)
+    rate.rate = 4.0
+    rate.success()
+    assert rate.rate == 4.0 + RATE_RECOVERY / 4.0
+    for _ in range(10000):
+        rate.success()
+    assert rate.rate == 20.0
+
+def test_min_rate_not_above_rate():
+    assert AdaptiveRate(0.5, min_rate=1.0).min_rate == 0.5
+
+def test_acquire_spacing():
+    async def scenario():
+        rate = AdaptiveRate(50.0)
+        started = time.monotonic()
+        for _ in range(6):
+            await rate.acquire()
+        return time.monotonic() - started
+    # הראשון מיד, וכל אחד אחריו 1/50 שנייה
+    assert asyncio.run(scenario()) >= 5 / 50 - 0.01
+
+def test_acquire_waits_out_flood_wait():
+    async def scenario():
+        rate = AdaptiveRate(1000.0)
+        rate.flood_wait(0.2)
+        started = time.monotonic()
+        await rate.acquire()
+        return time.monotonic() - started
+    assert asyncio.run(scenario()) >= 0.19
@@ -0,0 +1,71 @@
+import pytest
+
+from config import JOB_MAX_ATTEMPTS
+from jobqueue import JobQueue
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / "jobs.db"))
+
+def enqueue(queue: JobQueue, user_id: int, priority: int = 1) -> int:
+    return queue.enqueue({"user_id": user_id}, priority, user_id, 1)
+
+def row(queue: JobQueue, job_id: int):
+    return queue.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+def test_claim_order(queue):
+    first = enqueue(queue, 1)
+    second = enqueue(queue, 1)
+    premium = enqueue(queue, 2, priority=0)
+    other = enqueue(queue, 3)
+    assert queue.claim("w")["id"] == premium
+    assert queue.claim("w")["id"] == first
+    # למשתמש 1 כבר יש עבודה רצה - משתמש 3 קודם, למרות שהגיע אחריו
+    assert queue.claim("w")["id"] == other
+    assert queue.claim("w")["id"] == second
+    assert queue.claim("w") is None
+
+def test_claim_sets_lease(queue):
+    job_id = enqueue(queue, 1)
+    job = queue.claim("w1", lease=60)
+    assert job["spec"] == {"user_id": 1}
+    record = row(queue, job_id)
+    assert record["state"] == "running"
+    assert record["worker"] == "w1"
+    assert record["attempts"] == 1
+    assert queue.claim("w2") is None
+
+def test_expired_lease_requeues(queue):
+    job_id = enqueue(queue, 1)
+    queue.claim("w1", lease=-1)
+    job = queue.claim("w2")
+    assert job["id"] == job_id
+    assert row(queue, job_id)["worker"] == "w2"
+    assert row(queue, job_id)["attempts"] == 2
+
+def test_renew_keeps_lease(queue):
+    job_id = enqueue(queue, 1)
+    queue.claim("w1", lease=-1)
+    queue.renew([job_id], "w1", lease=60)
+    assert queue.claim("w2") is None
+    # worker אחר לא מחדש lease של עבודה שלא שלו
+    queue.renew([job_id], "w2", lease=-1)
+    assert row(queue, job_id)["worker"] == "w1"
+
+def test_expired_lease_fails_after_max_attempts(queue):
+    job_id = enqueue(queue, 1)
+    for _ in range(JOB_MAX_ATTEMPTS):
+        assert queue.claim("w", lease=-1)["id"] == job_id
+    assert queue.claim("w") is None
+    record = row(queue, job_id)
+    assert record["state"] == "failed"
+    assert record["error"] == "worker lost"
+
+def test_release_does_not_count_attempt(queue):
+    job_id = enqueue(queue, 1)
+    queue.claim("w1")
+    queue.release(job_id)
+    record = row(queue, job_id)
+    assert record["state"] == "queued"
+    assert record["attempts"] == 0
+    assert queue.claim("w2")["id"] == job_id
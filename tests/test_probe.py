@@ -0,0 +1,38 @@
+import io
+import struct
+
+from probe import _scan_atoms, find_moov_in_head
+
+def atom(kind: bytes, payload: bytes = b"") -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+def test_moov_before_mdat():
+    assert find_moov_in_head(atom(b"ftyp", b"isom") + atom(b"moov") + atom(b"mdat")) is True
+
+def test_mdat_before_moov():
+    assert find_moov_in_head(atom(b"ftyp", b"isom") + atom(b"mdat", b"x" * 32) + atom(b"moov")) is False
+
+def test_skips_free_atoms():
+    assert find_moov_in_head(atom(b"ftyp") + atom(b"free", b"\0" * 100) + atom(b"moov")) is True
+
+def test_large_size_atom():
+    large = struct.pack(">I4sQ", 1, b"free", 16 + 4) + b"\0" * 4
+    assert find_moov_in_head(atom(b"ftyp") + large + atom(b"moov")) is True
+
+def test_truncated_head():
+    # הראש נגמר לפני שנמצא moov או mdat
+    assert find_moov_in_head(atom(b"ftyp", b"isom")[:6]) is None
+    assert find_moov_in_head(struct.pack(">I4s", 1000, b"ftyp")) is None
+
+def test_size_to_end_of_file():
+    assert find_moov_in_head(struct.pack(">I4s", 0, b"free") + atom(b"moov")) is None
+
+def test_undersized_atoms():
+    # atom קטן מהכותרת שלו - בלי סריקה אחורה ובלי לולאה אינסופית
+    for size in (2, 7):
+        assert find_moov_in_head(struct.pack(">I4s", size, b"free") + atom(b"moov")) is None
+    assert find_moov_in_head(struct.pack(">I4sQ", 1, b"free", 8) + atom(b"moov")) is None
+
+def test_scan_from_file_object():
+    f = io.BytesIO(atom(b"ftyp") + atom(b"mdat"))
+    assert _scan_atoms(f) is False
@@ -0,0 +1,30 @@
+import pytest
+
+pytest.importorskip("pyrogram")
+
+from progress import TokenBucket
+
+def test_burst_then_empty():
+    bucket = TokenBucket(rate=1.0, burst=3)
+    now = bucket.updated
+    assert [bucket.take(now) for _ in range(4)] == [True, True, True, False]
+
+def test_refill():
+    bucket = TokenBucket(rate=2.0, burst=1)
+    now = bucket.updated
+    assert bucket.take(now)
+    assert not bucket.take(now + 0.25)
+    assert bucket.take(now + 0.5)
+
+def test_refill_capped_at_burst():
+    bucket = TokenBucket(rate=10.0, burst=2)
+    now = bucket.updated + 100
+    assert [bucket.take(now) for _ in range(3)] == [True, True, False]
+
+def test_ready_does_not_take():
+    bucket = TokenBucket(rate=1.0, burst=1)
+    now = bucket.updated
+    assert bucket.ready(now)
+    assert bucket.ready(now)
+    assert bucket.take(now)
+    assert not bucket.ready(now)
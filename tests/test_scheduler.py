@@ -0,0 +1,65 @@
+import asyncio
+
+from scheduler import StageLimiter, Ticket
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+def test_acquire_without_waiting():
+    async def scenario():
+        limiter = StageLimiter("test", 2)
+        await limiter.acquire(Ticket(1, False))
+        await limiter.acquire(Ticket(2, False))
+        assert limiter.active == 2
+        limiter.release()
+        assert limiter.active == 1
+    asyncio.run(scenario())
+
+def test_release_order():
+    # פרימיום קודם; בתוך הנתיב החינמי - משתמש עם עבודה אחת לפני עבודה שנייה של משתמש אחר
+    async def scenario():
+        limiter = StageLimiter("test", 1)
+        await limiter.acquire(Ticket(1, False))
+        order = []
+
+        async def run(name: str, ticket: Ticket):
+            await limiter.acquire(ticket)
+            order.append(name)
+
+        tasks = []
+        for name, user_id, premium in (("b", 2, False), ("c", 2, False), ("d", 3, False), ("e", 4, True)):
+            tasks.append(asyncio.ensure_future(run(name, Ticket(user_id, premium))))
+            await settle()
+        assert len(limiter.waiters) == 4
+        for _ in tasks:
+            limiter.release(1.0)
+            await settle()
+        await asyncio.gather(*tasks)
+        assert order == ["e", "b", "d", "c"]
+        assert limiter.active == 1
+    asyncio.run(scenario())
+
+def test_position():
+    async def scenario():
+        limiter = StageLimiter("test", 1)
+        limiter.avg_service = 10.0
+        await limiter.acquire(Ticket(1, False))
+        free, premium = Ticket(2, False), Ticket(3, True)
+        tasks = [asyncio.ensure_future(limiter.acquire(free)), asyncio.ensure_future(limiter.acquire(premium))]
+        await settle()
+        assert limiter.position(premium) == (1, 10.0)
+        assert limiter.position(free) == (2, 20.0)
+        assert limiter.position(Ticket(4, False)) == (0, 0.0)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        assert not limiter.waiters
+    asyncio.run(scenario())
+
+def test_service_time_average():
+    limiter = StageLimiter("test", 1)
+    limiter.active = 1
+    limiter.release(80.0)
+    assert limiter.avg_service == 0.8 * 30.0 + 0.2 * 80.0
+    assert limiter.served == 1
@@ -0,0 +1,17 @@
+from storage import PASSLOG_SIZE, job_size, plan_size
+
+def test_job_size():
+    assert job_size(100, "audio") == 200
+    assert job_size(100, "video") == 200
+    assert job_size(100, "video", with_audio=True) == 300
+    assert job_size(100, "document") == 100
+
+def test_job_size_unknown_file_size():
+    assert job_size(None, "video", with_audio=True) == 0
+
+def test_plan_size():
+    assert plan_size(100) == 0
+    assert plan_size(100, segmented=True) == 100
+    assert plan_size(100, two_pass=True) == PASSLOG_SIZE
+    assert plan_size(100, segmented=True, two_pass=True) == 100 + PASSLOG_SIZE
+    assert plan_size(None, segmented=True) == 0
@@ -0,0 +1,11 @@
+from utils import parse_duration
+
+def test_units():
+    assert parse_duration("20d") == 20 * 86400
+    assert parse_duration("5h") == 5 * 3600
+    assert parse_duration("30m") == 30 * 60
+
+def test_invalid():
+    assert parse_duration("10s") == 0
+    assert parse_duration("xd") == 0
+    assert parse_duration("d") == 0
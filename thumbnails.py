@@ -0,0 +1,166 @@
+# thumbnails.py
+import asyncio
+import itertools
+import logging
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from pyrogram import Client
+
+from config import THUMB_CACHE_SIZE, CUSTOM_THUMB_CACHE_SIZE
+from transcode import transcoder, TranscodeError
+
+logger = logging.getLogger(__name__)
+
+THUMB_DIR = "thumbnails"
+CUSTOM_DIR = os.path.join(THUMB_DIR, "custom")
+THUMB_FILTER = "scale=320:-2"
+PART_SUFFIX = ".part.jpg"  # ffmpeg בוחר את פורמט הפלט לפי הסיומת
+PART_TTL = 3600  # שניות - קובץ זמני ישן מזה נשאר מכתיבה שלא הושלמה
+
+class DiskLRU:
+    # מטמון LRU של קבצים בתיקייה שמשותפת לבוט ולכל ה-workers. אין אינדקס בזיכרון: הסדר נקבע
+    # לפי זמן השינוי בדיסק (מתעדכן בכל שימוש) והדחייה סורקת את התיקייה, כך שכל התהליכים רואים
+    # אותו מצב. קבצים נכתבים לשם זמני ועוברים למקומם ב-os.replace - אף תהליך לא קורא קובץ חלקי
+    def __init__(self, directory: str, max_entries: int):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.bytes = 0  # סך גודל הקבצים בתיקייה, לפי הסריקה האחרונה
+        self._ids = itertools.count(1)
+        os.makedirs(directory, exist_ok=True)
+        self._trim()
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.jpg")
+
+    def temp_path(self, key: str) -> str:
+        # שם ייחודי לכל כתיבה, גם כשכמה תהליכים או עבודות כותבים את אותו מפתח
+        return os.path.join(self.directory, f"{key}.{os.getpid()}.{next(self._ids)}{PART_SUFFIX}")
+
+    def get(self, key: str) -> Optional[str]:
+        path = self.path_for(key)
+        try:
+            os.utime(path)  # שימוש = הכי חדש בסדר ה-LRU
+        except FileNotFoundError:
+            return None
+        return path
+
+    def add(self, key: str, path: str) -> str:
+        # path הוא קובץ זמני (temp_path); מחזיר את הנתיב הקבוע
+        target = self.path_for(key)
+        os.replace(path, target)
+        self._trim()
+        return target
+
+    def remove(self, key: str):
+        self._unlink(self.path_for(key))
+        self._trim()
+
+    @staticmethod
+    def _unlink(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # תהליך אחר כבר מחק
+
+    def _trim(self):
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or not entry.name.endswith(".jpg"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith(PART_SUFFIX):
+                # כתיבה שנקטעה (המרה שנכשלה, תהליך שנפל)
+                if now - stat.st_mtime > PART_TTL:
+                    self._unlink(entry.path)
+                continue
+            entries.append((stat.st_mtime, entry.path, stat.st_size))
+        entries.sort()
+        excess = max(0, len(entries) - self.max_entries)
+        for _, path, _ in entries[:excess]:
+            self._unlink(path)
+        self.bytes = sum(size for _, _, size in entries[excess:])
+
+class ThumbnailEngine:
+    def __init__(self):
+        # תמונות שחולצו מקבצים - לפי file_unique_id
+        self.frames = DiskLRU(THUMB_DIR, THUMB_CACHE_SIZE)
+        # תמונות מותאמות אישית שהורדו מטלגרם - לפי user_id (נמחקות כשהמשתמש מחליף/מוחק)
+        self.custom = DiskLRU(CUSTOM_DIR, CUSTOM_THUMB_CACHE_SIZE)
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._lock_users: Dict[str, int] = {}  # מחזיקים וממתינים לכל מנעול - נמחק רק כשאין אף אחד
+
+    @staticmethod
+    def seek_position(duration: Optional[float]) -> float:
+        # 10% מהסרטון, כדי לדלג על פתיחים שחורים; בלי משך ידוע - ההתחלה
+        if not duration:
+            return 0.0
+        return min(duration * 0.1, 60.0)
+
+    def frame_filter(self, duration: Optional[float]) -> str:
+        return f"select='gte(t\\,{self.seek_position(duration):.3f})',{THUMB_FILTER}"
+
+    def frame_output(self, file_unique_id: str, duration: Optional[float]) -> Tuple[str, str]:
+        # (מסנן, נתיב) לפלט נוסף של מעבר ההמרה: התמונה נלקחת מהפריימים שכבר מפוענחים בלי פענוח חוזר.
+        # הנתיב זמני - adopt_frame מעביר אותו למטמון כשההמרה הצליחה
+        return self.frame_filter(duration), self.frames.temp_path(file_unique_id)
+
+    def adopt_frame(self, file_unique_id: str, frame: Optional[Tuple[str, str]]) -> Optional[str]:
+        # נקרא אחרי מעבר המרה שכלל את frame_output
+        if frame is None or not os.path.exists(frame[1]):
+            return None
+        return self.frames.add(file_unique_id, frame[1])
+
+    async def extract(self, video_path: str, file_unique_id: str, duration: Optional[float] = None) -> Optional[str]:
+        cached = self.frames.get(file_unique_id)
+        if cached:
+            return cached
+        lock = self._locks.setdefault(file_unique_id, asyncio.Lock())
+        self._lock_users[file_unique_id] = self._lock_users.get(file_unique_id, 0) + 1
+        try:
+            async with lock:
+                cached = self.frames.get(file_unique_id)
+                if cached:
+                    return cached
+                tmp_path = self.frames.temp_path(file_unique_id)
+                # -ss לפני -i: קפיצה ישירה במיכל, ופענוח של פריימי מפתח בלבד
+                await transcoder.run(
+                    ["-skip_frame", "nokey", "-ss", f"{self.seek_position(duration):.3f}", "-i", video_path],
+                    ["-map", "0:v:0", "-frames:v", "1", "-vf", THUMB_FILTER, "-q:v", "4", tmp_path]
+                )
+                if not os.path.exists(tmp_path):
+                    return None
+                return self.frames.add(file_unique_id, tmp_path)
+        except TranscodeError as e:
+            logger.error(f"שגיאה ביצירת תמונה ממוזערת: {e}")
+            return None
+        finally:
+            self._lock_users[file_unique_id] -= 1
+            if not self._lock_users[file_unique_id]:
+                del self._lock_users[file_unique_id]
+                self._locks.pop(file_unique_id, None)
+
+    async def get_custom(self, client: Client, user_id: int, file_id: str) -> Optional[str]:
+        # תמונה מותאמת אישית מהמטמון המקומי; הורדה מטלגרם רק בפעם הראשונה
+        key = str(user_id)
+        cached = self.custom.get(key)
+        if cached:
+            return cached
+        try:
+            path = await client.download_media(file_id, file_name=self.custom.temp_path(key))
+        except Exception as e:
+            logger.error(f"שגיאה בהורדת תמונה ממוזערת של {user_id}: {e}")
+            return None
+        if not path:
+            return None
+        return self.custom.add(key, path)
+
+    def invalidate_custom(self, user_id: int):
+        self.custom.remove(str(user_id))
+
+thumbnails = ThumbnailEngine()
@@ -0,0 +1,193 @@
+# tracing.py
+import asyncio
+import glob
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+from typing import Dict, List, Optional
+
+from config import TRACE_DIR, TRACE_MAX_BYTES, TRACE_BACKUPS
+
+logger = logging.getLogger(__name__)
+
+MAX_SPANS = 300  # אצווה גדולה או המרה בקטעים - לא מנפחים רשומה אחת
+QUANTILES = (0.5, 0.9, 0.99)
+
+class JobTrace:
+    # ציר הזמן של עבודה אחת: שלבים (כולל ההמתנה לתור של כל שלב), הרצות ffmpeg, בייטים ומונים.
+    # הזמנים נשמרים כהיסט בשניות מתחילת העבודה
+    def __init__(self, job_id: Optional[int], user_id: int, kind: str, queued_at: Optional[float] = None):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.kind = kind
+        self.started = time.time()
+        self.queue_wait = max(0.0, self.started - queued_at) if queued_at else 0.0
+        self.spans: List[Dict] = []
+        self.bytes: Dict[str, int] = {}
+        self.counters: Dict[str, float] = {}
+        self.outcome = "done"
+
+    def add_span(self, name: str, duration: float, **fields):
+        if len(self.spans) >= MAX_SPANS:
+            self.count("dropped_spans")
+            return
+        at = time.time() - self.started - duration
+        span = {"name": name, "at": round(at, 3), "duration": round(duration, 3)}
+        span.update({key: round(value, 3) if isinstance(value, float) else value for key, value in fields.items()})
+        self.spans.append(span)
+
+    def count(self, name: str, amount: float = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_bytes(self, action: str, amount: int):
+        self.bytes[action] = self.bytes.get(action, 0) + amount
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.job_id,
+            "user_id": self.user_id,
+            "kind": self.kind,
+            "started": round(self.started, 3),
+            "total": round(time.time() - self.started, 3),
+            "queue_wait": round(self.queue_wait, 3),
+            "outcome": self.outcome,
+            "spans": self.spans,
+            "bytes": self.bytes,
+            "counters": self.counters,
+        }
+
+# העבודה שרצה ב-task הנוכחי. כל עבודה רצה ב-task משלה (JobControl), וה-tasks שהיא פותחת
+# (מקטעי הורדה, קבצי אצווה) יורשים את ההקשר - כך השלבים, ffmpeg וההעברות נרשמים לעבודה הנכונה
+_current: ContextVar[Optional[JobTrace]] = ContextVar("job_trace", default=None)
+
+def start_trace(job_id: Optional[int], user_id: int, kind: str, queued_at: Optional[float] = None) -> JobTrace:
+    trace = JobTrace(job_id, user_id, kind, queued_at)
+    _current.set(trace)
+    return trace
+
+def trace_span(name: str, duration: float, **fields):
+    trace = _current.get()
+    if trace is not None:
+        trace.add_span(name, duration, **fields)
+
+def trace_count(name: str, amount: float = 1):
+    trace = _current.get()
+    if trace is not None:
+        trace.count(name, amount)
+
+def trace_bytes(action: str, amount: int):
+    trace = _current.get()
+    if trace is not None and amount > 0:
+        trace.add_bytes(action, amount)
+
+@contextmanager
+def traced(name: str, **fields):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        trace_span(name, time.monotonic() - started, **fields)
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def job_measurements(trace: Dict) -> Dict[str, float]:
+    # המדדים של עבודה אחת לחישוב האחוזונים. שלב שרץ כמה פעמים (אצווה) נסכם
+    values = {"total": trace["total"], "queue_wait": trace["queue_wait"]}
+    for span in trace["spans"]:
+        name = span["name"]
+        values[f"{name}.duration"] = values.get(f"{name}.duration", 0.0) + span["duration"]
+        for key in ("wait", "cpu"):
+            if span.get(key) is not None:
+                values[f"{name}.{key}"] = values.get(f"{name}.{key}", 0.0) + span[key]
+    for action, amount in trace["bytes"].items():
+        values[f"bytes.{action}"] = amount
+    for name, amount in trace["counters"].items():
+        values[name] = amount
+    return values
+
+class TraceStore:
+    # קובץ JSON lines מתגלגל לכל תהליך (הבוט וכל worker), כך שאין כתיבה משותפת בין תהליכים.
+    # הקריאה (/trace, /traces) עוברת על כל הקבצים בתיקייה
+    def __init__(self, directory: str = TRACE_DIR, max_bytes: int = TRACE_MAX_BYTES, backups: int = TRACE_BACKUPS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.name = "bot"
+        self._log = None
+
+    def open(self, name: str):
+        self.name = name
+
+    def _writer(self) -> logging.Logger:
+        if self._log is None:
+            os.makedirs(self.directory, exist_ok=True)
+            handler = RotatingFileHandler(
+                os.path.join(self.directory, f"{self.name}.jsonl"), maxBytes=self.max_bytes, backupCount=self.backups
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._log = logging.getLogger(f"{__name__}.{self.name}")
+            self._log.propagate = False
+            self._log.setLevel(logging.INFO)
+            self._log.addHandler(handler)
+        return self._log
+
+    def write(self, trace: JobTrace):
+        self._append(trace.job_id, json.dumps(trace.to_dict(), ensure_ascii=False))
+
+    def submit(self, trace: JobTrace):
+        # הרשומה נארזת כאן (הזמן הכולל נמדד עכשיו), והכתיבה לקובץ והגלגול שלו רצים ב-executor -
+        # לא על לולאת האירועים. לא מחכים לכתיבה, כך שביטול העבודה לא קוטע אותה
+        try:
+            line = json.dumps(trace.to_dict(), ensure_ascii=False)
+        except Exception as e:
+            logger.error(f"לא ניתן לשמור מעקב של עבודה {trace.job_id}: {e}")
+            return
+        asyncio.get_event_loop().run_in_executor(None, self._append, trace.job_id, line)
+
+    def _append(self, job_id: Optional[int], line: str):
+        try:
+            self._writer().info(line)
+        except Exception as e:
+            logger.error(f"לא ניתן לשמור מעקב של עבודה {job_id}: {e}")
+
+    def read(self) -> List[Dict]:
+        traces = []
+        for path in glob.glob(os.path.join(self.directory, "*.jsonl*")):
+            try:
+                with open(path, "r") as f:
+                    for line in f:
+                        try:
+                            traces.append(json.loads(line))
+                        except ValueError:
+                            continue  # שורה חלקית מכתיבה שנקטעה
+            except OSError:
+                continue  # הקובץ התגלגל בזמן הקריאה
+        return traces
+
+    def for_user(self, user_id: int, limit: int = 5) -> List[Dict]:
+        traces = [trace for trace in self.read() if trace.get("user_id") == user_id]
+        traces.sort(key=lambda trace: trace["started"])
+        return traces[-limit:]
+
+    def percentiles(self, since: Optional[float] = None) -> Dict[str, Dict[str, float]]:
+        samples: Dict[str, List[float]] = {}
+        for trace in self.read():
+            if since is not None and trace["started"] < since:
+                continue
+            for name, value in job_measurements(trace).items():
+                samples.setdefault(name, []).append(value)
+        summary = {}
+        for name in sorted(samples):
+            values = samples[name]
+            summary[name] = {"count": len(values), "max": round(max(values), 3)}
+            for q in QUANTILES:
+                summary[name][f"p{int(q * 100)}"] = round(_percentile(values, q), 3)
+        return summary
+
+trace_store = TraceStore()
@@ -0,0 +1,256 @@
+# transcode.py
+import asyncio
+import logging
+import os
+import signal
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from config import TRANSCODE_WORKERS, FFMPEG_THREADS
+from probe import MediaInfo
+from tracing import trace_span
+
+logger = logging.getLogger(__name__)
+
+KILL_TIMEOUT = 3  # שניות בין SIGTERM ל-SIGKILL כשעוצרים ffmpeg
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+# progress(processed_seconds, total_seconds_or_None)
+EncodeProgress = Callable[[float, Optional[float]], Awaitable[None]]
+
+class TranscodeError(Exception):
+    def __init__(self, returncode: int, stderr: str):
+        super().__init__(f"ffmpeg exited with code {returncode}: {stderr}")
+        self.returncode = returncode
+        self.stderr = stderr
+
+class TranscodePool:
+    def __init__(self, workers: int = TRANSCODE_WORKERS, threads: int = FFMPEG_THREADS):
+        self.workers = max(1, workers)
+        # תקציב threads לכל ffmpeg, כך ש-N המרות במקביל לא יחרגו ממספר הליבות
+        self.threads = threads or max(1, (os.cpu_count() or 1) // self.workers)
+        self._slots = None
+        self.running = 0
+
+    @property
+    def slots(self) -> asyncio.Semaphore:
+        # נוצר בעצלות כדי להיקשר ללולאה של Pyrogram ולא ללולאה בזמן import
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        return self._slots
+
+    async def run(self, input_args: List[str], output_args: List[str],
+                  duration: Optional[float] = None, progress: Optional[EncodeProgress] = None,
+                  label: Optional[str] = None):
+        queued_at = time.monotonic()
+        async with self.slots:
+            self.running += 1
+            started = time.monotonic()
+            usage = {"cpu": None}
+            try:
+                await self._run(input_args, output_args, duration, progress, usage)
+            finally:
+                self.running -= 1
+                # ההרצה מזוהה במעקב לפי label, או לפי הפלט האחרון (audio.m4a, תמונה, קטע...)
+                trace_span("ffmpeg", time.monotonic() - started, wait=started - queued_at,
+                           cpu=usage["cpu"], output=label or os.path.basename(output_args[-1]))
+
+    @asynccontextmanager
+    async def spawn(self, input_args: List[str], output_args: List[str]):
+        # תהליך ffmpeg עם stdin/stdout פתוחים (מצב הזרמה), מחזיק משבצת בבריכה עד הסיום
+        async with self.slots:
+            self.running += 1
+            started = time.monotonic()
+            proc = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-hide_banner", "-nostdin", "-y",
+                *input_args,
+                "-threads", str(self.threads),
+                *output_args,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True
+            )
+            stderr_tail = deque(maxlen=30)
+            stderr_task = asyncio.ensure_future(self._drain(proc.stderr, stderr_tail))
+            try:
+                yield proc, stderr_tail
+            finally:
+                await self.terminate(proc)
+                stderr_task.cancel()
+                self.running -= 1
+                trace_span("ffmpeg", time.monotonic() - started, output="pipe")
+
+    async def _run(self, input_args, output_args, duration, progress, usage):
+        cmd = [
+            "ffmpeg", "-hide_banner", "-nostdin", "-y",
+            "-progress", "pipe:1", "-nostats",
+            *input_args,
+            "-threads", str(self.threads),
+            *output_args,
+        ]
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True
+        )
+        stderr_tail = deque(maxlen=30)
+        stderr_task = asyncio.ensure_future(self._drain(proc.stderr, stderr_tail))
+        try:
+            await self._read_progress(proc, duration, progress, usage)
+            returncode = await proc.wait()
+            await stderr_task
+        except BaseException:
+            # ביטול או שגיאה בקולבק - לא משאירים ffmpeg רץ ברקע
+            await self.terminate(proc)
+            stderr_task.cancel()
+            raise
+        if returncode != 0:
+            raise TranscodeError(returncode, "\n".join(stderr_tail))
+
+    @staticmethod
+    async def terminate(proc: asyncio.subprocess.Process):
+        # ffmpeg רץ בקבוצת תהליכים משלו - עוצרים את כל הקבוצה: SIGTERM (ffmpeg סוגר את הקבצים),
+        # ואם לא יצא תוך KILL_TIMEOUT - SIGKILL. כך המשבצת מתפנה בזמן חסום גם בביטול
+        if proc.returncode is not None:
+            return
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(proc.wait()), KILL_TIMEOUT)
+        except asyncio.TimeoutError:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+
+    @staticmethod
+    async def _drain(stream: asyncio.StreamReader, tail: deque):
+        async for line in stream:
+            tail.append(line.decode(errors="replace").rstrip())
+
+    @staticmethod
+    def _cpu_time(pid: int) -> Optional[float]:
+        # utime+stime של ffmpeg (כל ה-threads שלו) מ-/proc; None כשאין /proc (לא לינוקס)
+        try:
+            with open(f"/proc/{pid}/stat", "r") as f:
+                fields = f.read().rpartition(")")[2].split()
+        except OSError:
+            return None
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+    @classmethod
+    async def _read_progress(cls, proc: asyncio.subprocess.Process, duration, progress, usage: Dict):
+        # הפלט של -progress הוא בלוקים של key=value שמסתיימים בשורת progress=continue/end.
+        # זמן ה-CPU נדגם בסוף כל בלוק - הבלוק האחרון (end) נכתב רגע לפני ש-ffmpeg יוצא
+        out_time = 0.0
+        async for raw in proc.stdout:
+            key, _, value = raw.decode(errors="replace").strip().partition("=")
+            if key == "out_time_us" and value.isdigit():
+                # עם כמה פלטים הבלוק האחרון מדווח את הפלט הקצר ביותר (למשל התמונה) - לא חוזרים אחורה
+                out_time = max(out_time, int(value) / 1_000_000)
+            elif key == "progress":
+                usage["cpu"] = cls._cpu_time(proc.pid) or usage["cpu"]
+                if progress is not None:
+                    await progress(out_time, duration)
+
+# קודקים שטלגרם מנגן ישירות בתוך MP4
+COPY_VIDEO_CODECS = ("h264",)
+COPY_VIDEO_PIX_FMTS = ("yuv420p", "yuvj420p")
+COPY_AUDIO_CODECS = ("aac",)
+
+ENCODE_VIDEO_ARGS = ["-c:v", "libx264", "-crf", "23", "-preset", "veryfast"]
+ENCODE_AUDIO_ARGS = ["-c:a", "aac", "-b:a", "128k"]
+
+class ConversionPlan:
+    # passthrough - הקובץ כבר מתאים כמו שהוא
+    # remux - העתקת הזרמים למיכל MP4 עם +faststart
+    # audio - העתקת הווידאו והמרת האודיו בלבד
+    # encode - המרה מלאה
+    MODES = ("passthrough", "remux", "audio", "encode")
+
+    def __init__(self, mode: str, info: Optional[MediaInfo] = None):
+        assert mode in self.MODES, mode
+        self.mode = mode
+        self.info = info
+        self.profile = None  # EncodeProfile (profiles.py) - נקבע לכל עבודה לפני המרה מלאה
+
+    def output_args(self, output_path: str, frame: Optional[Tuple[str, str]] = None,
+                    audio_path: Optional[str] = None) -> List[str]:
+        # ה-MP4, ובאותה הרצה גם התוצרים הנוספים שהתבקשו: frame = (מסנן, נתיב) של תמונה ממוזערת,
+        # audio_path - אודיו בלבד. הקלט מפוענח פעם אחת; בהמרה מלאה הווידאו המפוענח מתפצל בגרף
+        # מסננים (split) בין המקודד לבין התמונה
+        passes = self.profile.pass_args(2) if self.profile else []
+        graph = frame is not None and self.mode == "encode"
+        args = []
+        if graph:
+            args += ["-filter_complex", self.filter_graph(frame[0])]
+        args += [*self.codec_args(graph), *passes, "-movflags", "+faststart", output_path]
+        if graph:
+            args += ["-map", "[thumb]", "-frames:v", "1", "-q:v", "4", frame[1]]
+        elif frame is not None:
+            args += ["-map", "0:v:0", "-vf", frame[0], "-frames:v", "1", "-q:v", "4", frame[1]]
+        if audio_path:
+            args += audio_output_args(self.info, audio_path, self.profile)
+        return args
+
+    def filter_graph(self, frame_filter: str) -> str:
+        scale = self.profile.video_filter() if self.profile else None
+        video = f"[main]{scale}[video]" if scale else "[main]null[video]"
+        return f"[0:v:0]split=2[main][frame];{video};[frame]{frame_filter}[thumb]"
+
+    def first_pass_args(self) -> List[str]:
+        # מעבר ראשון בקידוד דו-מעברי: רק איסוף סטטיסטיקות לקובץ הלוג, בלי אודיו ובלי פלט
+        return ["-map", "0:v:0", *self.profile.video_args(), *self.profile.pass_args(1), "-an", "-f", "null", os.devnull]
+
+    def stream_output_args(self) -> List[str]:
+        # MP4 מקוטע - נכתב לפלט הסטנדרטי בלי צורך לחזור לתחילת הקובץ
+        return [*self.codec_args(), "-movflags", "frag_keyframe+empty_moov+default_base_moof", "-f", "mp4", "pipe:1"]
+
+    def codec_args(self, graph: bool = False) -> List[str]:
+        # graph - הווידאו מגיע מפלט [video] של גרף המסננים ולא ישירות מהקלט
+        maps = ["-map", "[video]" if graph else "0:v:0", "-map", "0:a:0?"]
+        video_args = self.profile.video_args(in_graph=graph) if self.profile else ENCODE_VIDEO_ARGS
+        audio_args = self.profile.audio_args() if self.profile else ENCODE_AUDIO_ARGS
+        if self.mode in ("passthrough", "remux"):
+            codecs = ["-c", "copy"]
+        elif self.mode == "audio":
+            codecs = ["-c:v", "copy", *audio_args]
+        else:
+            codecs = [*video_args, *audio_args]
+        return [*maps, *codecs]
+
+    def __repr__(self):
+        if self.profile:
+            return f"ConversionPlan({self.mode!r}, {self.profile.level}/{self.profile.preset}/{self.profile.rate_control})"
+        return f"ConversionPlan({self.mode!r})"
+
+def audio_output_args(info: Optional[MediaInfo], audio_path: str, profile=None) -> List[str]:
+    # אודיו בלבד במיכל M4A: העתקה כשהמקור כבר AAC, אחרת המרה
+    if info is not None and info.audio_codec in COPY_AUDIO_CODECS:
+        codecs = ["-c:a", "copy"]
+    else:
+        codecs = profile.audio_args() if profile else ENCODE_AUDIO_ARGS
+    return ["-map", "0:a:0", "-vn", *codecs, "-movflags", "+faststart", audio_path]
+
+def plan_conversion(info: Optional[MediaInfo]) -> ConversionPlan:
+    # בוחר את הדרך הזולה ביותר שעדיין מפיקה MP4 תקין לטלגרם
+    if info is None or not info.video_codec:
+        return ConversionPlan("encode", info)
+    video_ok = info.video_codec in COPY_VIDEO_CODECS and info.pix_fmt in COPY_VIDEO_PIX_FMTS
+    audio_ok = info.audio_codec is None or info.audio_codec in COPY_AUDIO_CODECS
+    if not video_ok or not (info.is_mp4 or info.is_matroska):
+        return ConversionPlan("encode", info)
+    if not audio_ok:
+        return ConversionPlan("audio", info)
+    if info.is_mp4 and info.moov_at_start:
+        return ConversionPlan("passthrough", info)
+    return ConversionPlan("remux", info)
+
+transcoder = TranscodePool()
@@ -0,0 +1,214 @@
+# transfer.py
+import asyncio
+import logging
+import math
+import os
+from collections import deque
+from typing import Awaitable, Callable, Optional, Set, Union
+
+from pyrogram import Client, raw, types
+from pyrogram.errors import FloodWait
+from pyrogram.session import Session
+
+from config import TRANSFER_PARALLELISM, TRANSFER_SEGMENT_SIZE
+from jobqueue import JobCheckpoint
+from metrics import flood_waits
+from tracing import trace_count
+from streaming import PART_SIZE, BIG_FILE_THRESHOLD, PART_RETRIES
+
+logger = logging.getLogger(__name__)
+
+STREAM_CHUNK = 1024 * 1024  # client.stream_media מחזיר חלקים של 1MB, וה-offset וה-limit נמדדים בחלקים
+CLEANUP_TIMEOUT = 5  # שניות לסגירת זרם או session, כדי שביטול לא ייתקע על חיבור תקוע
+
+# on_progress(bytes_done_so_far)
+TransferProgress = Callable[[int], Awaitable[None]]
+
+class TransferIncomplete(OSError):
+    # pyrogram בולע שגיאות רשת בתוך get_file ופשוט מסיים את הזרם - מזהים לפי חוסר בחלקים
+    pass
+
+class ParallelDownload:
+    # הורדה בכמה חיבורים במקביל. הקובץ מחולק למקטעים רצופים; כל מקטע נפתח כזרם נפרד
+    # (ב-pyrogram כל זרם הוא session משלו), נכתב למקומו בקובץ שהוקצה מראש ומנוסה מחדש
+    # בנפרד מהחלק האחרון שנכתב. המקטעים שהושלמו נשמרים בנקודת החידוש של העבודה
+    def __init__(self, client: Client, message: types.Message, path: str, size: int,
+                 on_progress: TransferProgress, checkpoint: Optional[JobCheckpoint] = None,
+                 parallelism: int = TRANSFER_PARALLELISM, segment_size: int = TRANSFER_SEGMENT_SIZE):
+        self.client = client
+        self.message = message
+        self.path = path
+        self.size = size
+        self.on_progress = on_progress
+        self.checkpoint = checkpoint
+        self.parallelism = max(1, parallelism)
+        self.segment_chunks = max(1, segment_size // STREAM_CHUNK)
+        self.total_chunks = math.ceil(size / STREAM_CHUNK)
+        self.segments = math.ceil(self.total_chunks / self.segment_chunks)
+        self.done: Set[int] = set()
+        self.current = 0
+        self.retries = 0
+
+    def _segment_bytes(self, index: int) -> int:
+        start = index * self.segment_chunks * STREAM_CHUNK
+        return min(self.size, start + self.segment_chunks * STREAM_CHUNK) - start
+
+    def _restore(self) -> Set[int]:
+        # ממשיכים רק אם הקובץ המוקצה קיים ונקודת החידוש נשמרה עם אותה חלוקה
+        if not self.checkpoint or not os.path.exists(self.path) or os.path.getsize(self.path) != self.size:
+            return set()
+        if self.checkpoint.get("segment_chunks") != self.segment_chunks:
+            return set()
+        return set(self.checkpoint.get("segments", []))
+
+    def _preallocate(self):
+        with open(self.path, "r+b" if os.path.exists(self.path) else "wb") as f:
+            f.truncate(self.size)
+            if hasattr(os, "posix_fallocate"):
+                try:
+                    # הקצאה אמיתית של הבלוקים - דיסק מלא נכשל כאן ולא באמצע ההורדה
+                    os.posix_fallocate(f.fileno(), 0, self.size)
+                except OSError as e:
+                    logger.warning(f"לא ניתן להקצות מראש את {self.path}: {e}")
+
+    async def run(self) -> str:
+        self.done = self._restore()
+        if self.done:
+            logger.info(f"ממשיך הורדה של {self.path}: {len(self.done)}/{self.segments} מקטעים כבר בדיסק")
+        else:
+            self._preallocate()
+        self.current = sum(self._segment_bytes(index) for index in self.done)
+        pending = deque(index for index in range(self.segments) if index not in self.done)
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            lanes = [
+                asyncio.ensure_future(self._lane(fd, pending))
+                for _ in range(min(self.parallelism, len(pending)))
+            ]
+            try:
+                await asyncio.gather(*lanes)
+            except BaseException:
+                for lane in lanes:
+                    lane.cancel()
+                await asyncio.gather(*lanes, return_exceptions=True)
+                raise
+        finally:
+            os.close(fd)
+        return self.path
+
+    async def _lane(self, fd: int, pending: deque):
+        while pending:
+            await self._segment(fd, pending.popleft())
+
+    async def _segment(self, fd: int, index: int):
+        first = index * self.segment_chunks
+        count = min(self.segment_chunks, self.total_chunks - first)
+        written = 0  # חלקים של המקטע שכבר נכתבו - ניסיון חוזר ממשיך מהם
+        failures = 0
+        while written < count:
+            chunks = self.client.stream_media(self.message, offset=first + written, limit=count - written)
+            try:
+                async for chunk in chunks:
+                    os.pwrite(fd, chunk, (first + written) * STREAM_CHUNK)
+                    written += 1
+                    self.current += len(chunk)
+                    await self.on_progress(self.current)
+                if written < count:
+                    raise TransferIncomplete(f"segment {index} ended after {written}/{count} chunks")
+            except FloodWait as e:
+                flood_waits.inc(1, "download")
+                trace_count("flood_waits")
+                trace_count("flood_wait_seconds", e.value)
+                await asyncio.sleep(e.value)
+            except (OSError, asyncio.TimeoutError) as e:
+                failures += 1
+                self.retries += 1
+                trace_count("retries")
+                if failures >= PART_RETRIES:
+                    raise
+                logger.warning(f"ניסיון חוזר למקטע {index} של {self.path}: {e}")
+                await asyncio.sleep(failures)
+            finally:
+                await _bounded(chunks.aclose())
+        self.done.add(index)
+        if self.checkpoint:
+            self.checkpoint.save(segments=sorted(self.done), segment_chunks=self.segment_chunks)
+
+async def upload_parallel(client: Client, path: str, file_name: str, on_progress: TransferProgress,
+                          parallelism: int = TRANSFER_PARALLELISM) -> Union[raw.types.InputFile, raw.types.InputFileBig]:
+    # העלאה בכמה חיבורים במקביל: כל חיבור הוא session נפרד מול ה-DC של הבוט, החלקים
+    # נקראים מהקובץ לפי המיקום שלהם וכל חלק מנוסה מחדש בנפרד (save_file של pyrogram
+    # משתמש בחיבור אחד ומדלג בשקט על חלק שנכשל)
+    size = os.path.getsize(path)
+    total = math.ceil(size / PART_SIZE)
+    is_big = size > BIG_FILE_THRESHOLD
+    file_id = client.rnd_id()
+    pending = deque(range(total))
+    progress = {"current": 0}
+
+    async def lane(session: Session, fd: int):
+        while pending:
+            index = pending.popleft()
+            data = os.pread(fd, PART_SIZE, index * PART_SIZE)
+            if is_big:
+                query = raw.functions.upload.SaveBigFilePart(
+                    file_id=file_id, file_part=index, file_total_parts=total, bytes=data
+                )
+            else:
+                query = raw.functions.upload.SaveFilePart(file_id=file_id, file_part=index, bytes=data)
+            await _invoke_part(session, query)
+            progress["current"] += len(data)
+            await on_progress(progress["current"])
+
+    sessions = []
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        for _ in range(max(1, min(parallelism, total))):
+            session = Session(
+                client, await client.storage.dc_id(), await client.storage.auth_key(),
+                await client.storage.test_mode(), is_media=True
+            )
+            await session.start()
+            sessions.append(session)
+        lanes = [asyncio.ensure_future(lane(session, fd)) for session in sessions]
+        try:
+            await asyncio.gather(*lanes)
+        except BaseException:
+            for task in lanes:
+                task.cancel()
+            await asyncio.gather(*lanes, return_exceptions=True)
+            raise
+    finally:
+        os.close(fd)
+        for session in sessions:
+            await _bounded(session.stop())
+
+    if is_big:
+        return raw.types.InputFileBig(id=file_id, parts=total, name=file_name)
+    return raw.types.InputFile(id=file_id, parts=total, name=file_name, md5_checksum="")
+
+async def _bounded(cleanup):
+    try:
+        await asyncio.wait_for(cleanup, CLEANUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("סגירת חיבור העברה נמשכה יותר מדי - ממשיכים בלעדיה")
+    except Exception as e:
+        logger.warning(f"שגיאה בסגירת חיבור העברה: {e}")
+
+async def _invoke_part(session: Session, query):
+    failures = 0
+    while True:
+        try:
+            return await session.invoke(query)
+        except FloodWait as e:
+            flood_waits.inc(1, "upload")
+            trace_count("flood_waits")
+            trace_count("flood_wait_seconds", e.value)
+            await asyncio.sleep(e.value)
+        except (OSError, asyncio.TimeoutError) as e:
+            failures += 1
+            trace_count("retries")
+            if failures >= PART_RETRIES:
+                raise
+            logger.warning(f"ניסיון חוזר להעלאת חלק {query.file_part}: {e}")
+            await asyncio.sleep(failures)
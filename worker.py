@@ -0,0 +1,163 @@
+# worker.py
+import asyncio
+import logging
+import os
+import signal
+import sys
+import time
+from typing import Dict
+
+from pyrogram import Client
+
+from config import API_ID, API_HASH, BOT_TOKEN, WORKER_CONCURRENCY, JOB_LEASE, TRANSFER_PARALLELISM
+from jobqueue import jobqueue, ERROR_UNSUPPORTED, ERROR_ABORTED, ERROR_STORAGE
+from pipeline import RESUME_TEXT, Reporter, JobSpec, JobAborted, JobCancelled, UnsupportedFile, execute_job, job_control
+from scheduler import Ticket
+from storage import storage, StorageFull, job_size
+from tracing import trace_store
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 1.0  # שניות בין ניסיונות לתפוס עבודה כשהתור ריק
+REPORT_INTERVAL = 1.0  # לכל היותר כתיבת התקדמות אחת בשנייה לכל עבודה
+CANCEL_POLL_INTERVAL = 1.0  # שניות בין בדיקות של בקשות ביטול לעבודות שרצות
+
+class QueueReporter(Reporter):
+    # עבודה שרצה ב-worker כותבת התקדמות לתור; הבוט קורא ומעדכן את ההודעה
+    def __init__(self, job_id: int):
+        super().__init__(job_id)
+        self._action = None
+        self._reported_at = 0.0
+
+    def report(self, current, total, action):
+        now = time.monotonic()
+        if action == self._action and now - self._reported_at < REPORT_INTERVAL and current < total:
+            return
+        self._action = action
+        self._reported_at = now
+        jobqueue.report(self.job_id, current, total, action)
+
+    def status(self, text):
+        self._action = "status"
+        jobqueue.set_status(self.job_id, text)
+
+    def annotate(self, key, value):
+        super().annotate(key, value)
+        jobqueue.annotate(self.job_id, self.annotations)
+
+class Worker:
+    def __init__(self, index: int):
+        self.worker_id = f"worker-{index}:{os.getpid()}"
+        # המכסה (SCRATCH_QUOTA) היא לכל תהליך; הקבצים של כל עבודה בתיקייה שלה, כך ש-worker אחר
+        # יכול להמשיך אותה
+        # קובץ מעקב משלו - כמה תהליכים לא כותבים ומגלגלים את אותו קובץ
+        trace_store.open(f"worker-{index}")
+        # חיבור נפרד לאותו בוט, בלי קבלת עדכונים - רק הבוט הראשי מטפל בהודעות
+        self.client = Client(
+            f"worker_{index}", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN, no_updates=True,
+            max_concurrent_transmissions=WORKER_CONCURRENCY * TRANSFER_PARALLELISM
+        )
+        self.running: Dict[int, asyncio.Task] = {}
+        self.stopping = False
+
+    def stop(self):
+        logger.info(f"{self.worker_id} נעצר")
+        self.stopping = True
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stop)
+        await self.client.start()
+        heartbeat = asyncio.ensure_future(self._heartbeat())
+        cancels = asyncio.ensure_future(self._watch_cancels())
+        sweeper = asyncio.ensure_future(storage.sweeper(jobqueue.resumable_keys))
+        logger.info(f"{self.worker_id} מוכן")
+        try:
+            while not self.stopping:
+                if len(self.running) < WORKER_CONCURRENCY:
+                    job = jobqueue.claim(self.worker_id)
+                    if job is not None and self.running and not self._fits(job):
+                        # אין כרגע מקום לעבודה - חוזרת לתור עד שעבודה שרצה כאן תשחרר את המקום שלה
+                        jobqueue.release(job["id"])
+                    elif job is not None:
+                        self.running[job["id"]] = asyncio.ensure_future(self._run_job(job))
+                        continue
+                await asyncio.sleep(POLL_INTERVAL)
+        finally:
+            # עבודות שלא הסתיימו חוזרות לתור ויילקחו ע"י worker אחר
+            tasks = list(self.running.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            heartbeat.cancel()
+            cancels.cancel()
+            sweeper.cancel()
+            await self.client.stop()
+
+    @staticmethod
+    def _fits(job) -> bool:
+        spec = job["spec"]
+        return storage.fits(job_size(spec.get("file_size"), spec["upload_type"], spec.get("with_audio", False)))
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(JOB_LEASE / 3)
+            try:
+                jobqueue.renew(list(self.running), self.worker_id)
+            except Exception as e:
+                logger.error(f"שגיאה בחידוש lease: {e}")
+
+    async def _watch_cancels(self):
+        # הבוט רק מסמן ביטול בטבלה; כאן ה-task של העבודה נעצר (ffmpeg, העברות, קבצים)
+        while True:
+            await asyncio.sleep(CANCEL_POLL_INTERVAL)
+            try:
+                for job_id in jobqueue.cancel_requested(list(self.running)):
+                    job_control.cancel(job_id)
+            except Exception as e:
+                logger.error(f"שגיאה בבדיקת ביטולים: {e}")
+
+    async def _run_job(self, job):
+        job_id = job["id"]
+        spec = JobSpec(**job["spec"])
+        reporter = QueueReporter(job_id)
+        checkpoint = jobqueue.checkpoint(job_id)
+        try:
+            if checkpoint.resumed:
+                # עבודה שה-worker שלה נפל או נעצר באמצע - ממשיכים מהשלב השמור
+                logger.info(f"ממשיך עבודה {job_id} משלב {checkpoint.stage}")
+                await self.client.send_message(spec.user_id, RESUME_TEXT, reply_to_message_id=spec.original_msg_id)
+            file_id = await job_control.run(
+                job_id, execute_job(
+                    self.client, spec, reporter, Ticket(spec.user_id, spec.premium), checkpoint, job["created_at"]
+                )
+            )
+            jobqueue.finish(job_id, "done", result=file_id)
+        except asyncio.CancelledError:
+            jobqueue.release(job_id)
+            raise
+        except JobCancelled:
+            jobqueue.finish(job_id, "cancelled")
+        except UnsupportedFile:
+            jobqueue.finish(job_id, "failed", error=ERROR_UNSUPPORTED)
+        except StorageFull as e:
+            logger.warning(f"אין מקום לעבודה {job_id}: {e}")
+            jobqueue.finish(job_id, "failed", error=ERROR_STORAGE)
+        except JobAborted:
+            jobqueue.finish(job_id, "failed", error=ERROR_ABORTED)
+        except Exception as e:
+            logger.error(f"שגיאה בעבודה {job_id}: {e}")
+            jobqueue.finish(job_id, "failed", error=str(e))
+        finally:
+            self.running.pop(job_id, None)
+
+if __name__ == "__main__":
+    index = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    os.makedirs("thumbnails", exist_ok=True)
+    worker = Worker(index)
+    worker.client.run(worker.run())